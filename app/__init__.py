@@ -42,7 +42,36 @@ def create_app(config_class=Config):
     # [MỚI 3] Cập nhật init SocketIO
     # cors_allowed_origins="*": Cho phép kết nối từ mọi nguồn
     # async_mode='eventlet': Chỉ định rõ worker
-    socketio.init_app(app, cors_allowed_origins="*", async_mode="eventlet")
+    # message_queue: bắt buộc khi chạy nhiều worker, mọi emit (kể cả từ route / background task)
+    # đi qua queue để tới client của worker khác
+    if app.config.get('SOCKETIO_WORKERS', 1) > 1 and not app.config.get('SOCKETIO_MESSAGE_QUEUE'):
+        raise RuntimeError('WEB_CONCURRENCY > 1 requires SOCKETIO_MESSAGE_QUEUE (e.g. redis://...)')
+    # Presence + job tóm tắt phải dùng chung, nếu không route / event ở worker khác sẽ không thấy
+    if app.config.get('SOCKETIO_WORKERS', 1) > 1 and not app.config.get('PRESENCE_REDIS_URL'):
+        raise RuntimeError('WEB_CONCURRENCY > 1 requires PRESENCE_REDIS_URL (or a redis:// SOCKETIO_MESSAGE_QUEUE)')
+    socketio.init_app(app, cors_allowed_origins="*", async_mode="eventlet",
+                      message_queue=app.config.get('SOCKETIO_MESSAGE_QUEUE'))
+
+    # Presence online/offline: in-process, hoặc Redis nếu có PRESENCE_REDIS_URL (nhiều worker)
+    from app.presence import presence
+    presence.init_app(app)
+
+    # Nhiều worker: báo xóa cache trong process (membership, gợi ý kết bạn...) cho worker khác
+    from app.cache_bus import cache_bus
+    cache_bus.init_app(app)
+    cache_bus.start()
+
+    # Job tóm tắt nền: cùng Redis với presence để route tra trạng thái ở worker nào cũng thấy job
+    from app.summary_jobs import summary_jobs
+    summary_jobs.init_app(app)
+
+    # Cache kết quả SeaLion (RAM + file SQLite nếu có LLM_CACHE_PATH)
+    from app.llm_cache import llm_cache
+    llm_cache.init_app(app)
+
+    # 1 client SeaLion keep-alive cho cả process + giới hạn song song / hạn chót / retry
+    from app.llm_gateway import llm_gateway
+    llm_gateway.init_app(app)
     
     oauth.init_app(app)
 
@@ -91,8 +120,35 @@ def create_app(config_class=Config):
                 return None
         return None
 
-    # Create DB and Populate if empty
-    with app.app_context():
-        db.create_all()
+    # Tạo / nâng cấp schema qua migration có version (không dùng db.create_all nữa).
+    # Nhiều worker: không chạy ở đây (mỗi worker sẽ chạy DDL cùng lúc), `flask migrate` chạy trước gunicorn
+    if app.config.get('RUN_MIGRATIONS', True):
+        with app.app_context():
+            from app.migrations import run_migrations
+            run_migrations()
+
+    # CLI: `flask migrate`, `flask check-indexes`
+    from app.query_checks import register_cli
+    register_cli(app)
+
+    # [WRITE-BEHIND] Greenlet ghi điểm sở thích xuống DB định kỳ (+ flush lần cuối khi tắt)
+    from app.utils import interest_buffer
+    interest_buffer.start(app)
+
+    # [GROUP COMMIT] Greenlet gom tin nhắn chat thành batch INSERT (+ flush lần cuối khi tắt)
+    from app.message_writer import message_writer
+    message_writer.start(app)
+
+    # Greenlet gom trạng thái "đang nhập" thành 1 frame / phòng / tick
+    from app.typing_aggregator import typing_aggregator
+    typing_aggregator.start()
+
+    # Presence dùng chung: heartbeat của worker này + dọn sid của worker đã chết (báo offline)
+    from app.events import broadcast_departures
+    presence.start(app, broadcast_departures)
+
+    # [WRITE-BEHIND] Greenlet ghi read cursor theo batch + đẩy số tin chưa đọc tới user_<id>
+    from app.read_cursors import read_cursors
+    read_cursors.start(app)
 
     return app
\ No newline at end of file
@@ -1,33 +1,109 @@
 import json
 import re
-from typing import List, Dict
-from openai import OpenAI
-from config import Config
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Dict
+from app.llm_cache import llm_cache
+from app.llm_gateway import SEALION_MODEL, llm_gateway
+
+# _call_model không raise mà trả về chuỗi lỗi -> caller dùng is_error() trước khi lưu kết quả
+API_ERROR_PREFIX = "Lỗi API SeaLion"
+
+PAPER_STAGES = 4    # Số bước của process() (simple_process: 1 bước)
+
+# Báo cáo cuối (stage 4 của paper pipeline, bước cuối của map-reduce)
+REPORT_SYSTEM_PROMPT = """Bạn là một thành viên trong nhóm, tóm tắt lại nội dung buổi trò chuyện hôm nay cho những người 'lặn' lâu không đọc tin nhắn.
+Văn phong: Thân thiện, hài hước, sử dụng ngôn ngữ của giới trẻ (nhưng vẫn dễ hiểu). Có thể dùng emoji phù hợp.
+
+CẤU TRÚC BÁO CÁO:
+🔥 CÓ GÌ HOT: (Tóm tắt nhanh những drama hoặc sự kiện nổi bật nhất)
+💬 CHI TIẾT CÁC KÈO: 
+   - [Tên kèo/vụ]: Kể lại ngắn gọn ai đã nói gì, chốt hạ ra sao. 
+✅ VIỆC CẦN LÀM: (Liệt kê danh sách ai cần làm gì, ví dụ: 'Thằng Nam nhớ mang tiền', 'Tối nay 7h tập trung'...)"""
+
+# [NEW] Hướng dẫn gộp khi đã có bản tóm tắt trước (tóm tắt cuốn chiếu: chỉ gửi phần hội thoại mới)
+FOLD_INSTRUCTION = """
+Nếu đầu vào có phần 'BẢN TÓM TẮT TRƯỚC': đó là tóm tắt của đoạn chat cũ hơn. Hãy viết lại MỘT bản tóm tắt duy nhất
+bao trùm cả hai: giữ các ý cũ còn hiệu lực, gộp nội dung mới vào, cập nhật trạng thái/việc cần làm nếu nội dung mới thay đổi chúng."""
+
+
+# ============================================================================
+# MAP-REDUCE (cửa sổ chat dài)
+# ============================================================================
+MAP_REDUCE_STAGES = 2           # map (tóm tắt từng chunk) -> reduce (gộp thành 1 báo cáo)
+CHUNK_TOKEN_BUDGET = 1500       # Token tối đa của 1 chunk gửi cho bước map
+REDUCE_TOKEN_BUDGET = 3000      # Tổng ghi chú vượt ngưỡng này thì gộp thêm 1 tầng trước báo cáo cuối
+CHUNK_ANCHOR_EVERY = 30         # Trung bình cứ ~N tin có 1 điểm cắt cố định (theo id tin nhắn)
+MAP_REDUCE_CONCURRENCY = 4      # Số chunk tóm tắt song song (llm_gateway vẫn giới hạn chung toàn process)
+MAP_CACHE_TTL = 3 * 24 * 3600   # Kết quả map của 1 chunk giữ lâu hơn: recap nhiều ngày dùng lại chunk cũ
+
+
+def estimate_tokens(text: str) -> int:
+    """Ước lượng số token (~4 ký tự / token), đủ để chia chunk, không cần tokenizer"""
+    return len(text) // 4 + 1
+
+
+def chunk_messages(raw_chat: List[Dict], token_budget: int = CHUNK_TOKEN_BUDGET) -> List[str]:
+    """
+    Chia hội thoại thành các chunk 'Tên: Nội dung' không vượt token_budget.
+    Điểm cắt chủ yếu đặt sau các tin có crc32(id) % CHUNK_ANCHOR_EVERY == 0 -> không phụ thuộc
+    vị trí bắt đầu cửa sổ, nên 2 cửa sổ chồng nhau sinh ra cùng các chunk ở phần chung
+    (kết quả map của các chunk đó lấy lại từ llm_cache).
+    """
+    chunks, current, tokens = [], [], 0
+    for msg in raw_chat:
+        line = f"{msg['speaker']}: {msg['text']}"
+        line_tokens = estimate_tokens(line)
+        if current and tokens + line_tokens > token_budget:
+            chunks.append("\n".join(current))
+            current, tokens = [], 0
+        current.append(line)
+        tokens += line_tokens
+        if msg.get('id') is not None and zlib.crc32(str(msg['id']).encode()) % CHUNK_ANCHOR_EVERY == 0:
+            chunks.append("\n".join(current))
+            current, tokens = [], 0
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
 
 
 class SeaLionDialogueSystem:
     def __init__(self):
-        # Giữ nguyên cách khởi tạo bảo mật từ file new
-        self.client = OpenAI(
-            api_key=Config.SEALION_API_KEY,
-            base_url=Config.SEALION_BASE_URL
-        )
-        self.model_name = "aisingapore/Gemma-SEA-LION-v4-27B-IT"
-
-    def _call_model(self, prompt: str, system_prompt: str) -> str:
+        # [TỐI ƯU] Không tạo OpenAI client mỗi request: mọi lời gọi đi qua llm_gateway dùng chung
+        self.model_name = SEALION_MODEL
+
+    def _call_model(self, prompt: str, system_prompt: str, stage: str = 'default', cache_ttl: float = None) -> str:
+        # [TỐI ƯU] Cache theo nội dung (model, stage, system prompt, input): cùng input -> không gọi lại API
+        cache_key = llm_cache.key(self.model_name, stage, system_prompt, prompt)
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            return cached
         try:
-            response = self.client.chat.completions.create(
-                model=self.model_name,
+            result = llm_gateway.complete(
                 messages=[
                     {"role": "system", "content": system_prompt},
                     {"role": "user", "content": prompt}
                 ],
+                stage=stage,
+                model=self.model_name,
                 temperature=0.0,  # Giảm nhiệt độ để Output ổn định hơn (đặc biệt là JSON)
                 max_tokens=2048
             )
-            return response.choices[0].message.content.strip()
         except Exception as e:
-            return f"Lỗi API SeaLion: {e}"
+            return f"{API_ERROR_PREFIX}: {e}"  # Lỗi không vào cache
+        llm_cache.set(cache_key, result, ttl=cache_ttl)
+        return result
+
+    @staticmethod
+    def is_error(result: str) -> bool:
+        return not result or result.startswith(API_ERROR_PREFIX)
+
+    @staticmethod
+    def _with_previous(content: str, previous_summary: str = None) -> str:
+        """Ghép bản tóm tắt trước (nếu có) vào đầu vào của bước tóm tắt cuối"""
+        if not previous_summary:
+            return content
+        return f"BẢN TÓM TẮT TRƯỚC:\n{previous_summary}\n\nNỘI DUNG MỚI:\n{content}"
 
     def _clean_json_output(self, raw_string: str):
         """Hàm phụ trợ để làm sạch chuỗi JSON do AI sinh ra (xử lý Markdown)"""
@@ -48,7 +124,7 @@ class SeaLionDialogueSystem:
 2. Chuyển teencode/viết tắt thành tiếng Việt chuẩn.
 ĐẦU RA: Chỉ trả về nội dung chat đã làm sạch, định dạng 'Tên: Nội dung'."""
 
-        return self._call_model(chat_str, sys_prompt)
+        return self._call_model(chat_str, sys_prompt, stage='cleansing')
 
     # --- STAGE 2: DIALOGUE ACT TAGGING (Theo ai_summary.py) ---
     def stage_2_tagging(self, clean_chat: str) -> str:
@@ -62,7 +138,7 @@ Gán nhãn 'Dialogue Act' cho từng câu thoại để xây dựng cấu trúc
 
 ĐẦU RA JSON duy nhất: [{"s": "Tên người", "a": "Nhãn hành động", "t": "Nội dung"}]"""
 
-        result = self._call_model(clean_chat, sys_prompt)
+        result = self._call_model(clean_chat, sys_prompt, stage='tagging')
         return self._clean_json_output(result)
 
     # --- STAGE 3: DYNAMIC SEGMENTATION (Theo ai_summary.py) ---
@@ -77,37 +153,78 @@ Với mỗi sự việc, xác định:
 
 ĐẦU RA JSON: {"events": [{"topic": "...", "flow": "...", "status": "..."}]}"""
 
-        result = self._call_model(tagged_json, sys_prompt)
+        result = self._call_model(tagged_json, sys_prompt, stage='segmentation')
         return self._clean_json_output(result)
 
     # --- STAGE 4: ABSTRACTIVE SUMMARY GENERATION (Theo ai_summary.py) ---
-    def stage_4_summarization(self, segments_json: str) -> str:
-        sys_prompt = """Bạn là một thành viên trong nhóm, tóm tắt lại nội dung buổi trò chuyện hôm nay cho những người 'lặn' lâu không đọc tin nhắn.
-Văn phong: Thân thiện, hài hước, sử dụng ngôn ngữ của giới trẻ (nhưng vẫn dễ hiểu). Có thể dùng emoji phù hợp.
+    def stage_4_summarization(self, segments_json: str, previous_summary: str = None) -> str:
+        sys_prompt = REPORT_SYSTEM_PROMPT + FOLD_INSTRUCTION
 
-CẤU TRÚC BÁO CÁO:
-🔥 CÓ GÌ HOT: (Tóm tắt nhanh những drama hoặc sự kiện nổi bật nhất)
-💬 CHI TIẾT CÁC KÈO: 
-   - [Tên kèo/vụ]: Kể lại ngắn gọn ai đã nói gì, chốt hạ ra sao. 
-✅ VIỆC CẦN LÀM: (Liệt kê danh sách ai cần làm gì, ví dụ: 'Thằng Nam nhớ mang tiền', 'Tối nay 7h tập trung'...)"""
-
-        return self._call_model(segments_json, sys_prompt)
+        return self._call_model(self._with_previous(segments_json, previous_summary), sys_prompt, stage='summarization')
 
     # --- MAIN PROCESS (PAPER PIPELINE) ---
-    def process(self, raw_chat: List[Dict]):
-        # Pipeline thực thi tuần tự 4 bước theo paper
+    def process(self, raw_chat: List[Dict], previous_summary: str = None, on_stage: Callable = None):
+        # Pipeline thực thi tuần tự PAPER_STAGES bước theo paper
+        # [TỐI ƯU] raw_chat chỉ là phần tin mới; bước 4 gộp vào previous_summary (nếu có)
+        # on_stage(số thứ tự, tên bước): báo tiến độ trước mỗi bước (vd: job nền đẩy qua Socket.IO)
+        on_stage = on_stage or (lambda index, name: None)
+        on_stage(1, 'cleansing')
         s1_clean = self.stage_1_cleansing(raw_chat)
+        on_stage(2, 'tagging')
         s2_tagged = self.stage_2_tagging(s1_clean)
+        on_stage(3, 'segmentation')
         s3_segments = self.stage_3_segmentation(s2_tagged)
-        s4_final = self.stage_4_summarization(s3_segments)
+        on_stage(4, 'summarization')
+        s4_final = self.stage_4_summarization(s3_segments, previous_summary)
         return s4_final
 
+    # --- MAP-REDUCE PROCESS (cửa sổ dài: hàng trăm / hàng nghìn tin) ---
+    def _summarize_chunk(self, chunk: str) -> str:
+        sys_prompt = """Bạn nhận MỘT đoạn trích từ nhóm chat dài.
+Ghi chú ngắn gọn dạng gạch đầu dòng: ai đề xuất / hỏi / chốt gì, con số, thời gian, địa điểm, việc được giao cho ai.
+Giữ nguyên tên người. Không bình luận, không mở bài."""
+        return self._call_model(chunk, sys_prompt, stage='map', cache_ttl=MAP_CACHE_TTL)
+
+    def _merge_notes(self, notes: str) -> str:
+        sys_prompt = """Gộp các ghi chú sau (của các đoạn chat liên tiếp, theo thứ tự thời gian) thành MỘT bản ghi chú gọn hơn.
+Giữ các quyết định, việc cần làm và người phụ trách; bỏ chi tiết lặp lại. Định dạng gạch đầu dòng."""
+        return self._call_model(notes, sys_prompt, stage='reduce')
+
+    def _map_concurrently(self, fn: Callable, items: List[str]) -> List[str]:
+        with ThreadPoolExecutor(max_workers=min(MAP_REDUCE_CONCURRENCY, len(items))) as pool:
+            return list(pool.map(fn, items))
+
+    def map_reduce_process(self, raw_chat: List[Dict], on_stage: Callable = None) -> str:
+        """
+        Map: chia hội thoại thành chunk theo token, tóm tắt song song (mỗi chunk 1 lời gọi, có cache).
+        Reduce: ghi chú còn dài quá REDUCE_TOKEN_BUDGET thì gộp theo nhóm (cũng song song),
+        cuối cùng viết 1 báo cáo theo cấu trúc của stage 4.
+        """
+        on_stage = on_stage or (lambda index, name: None)
+        on_stage(1, 'map')
+        notes = self._map_concurrently(self._summarize_chunk, chunk_messages(raw_chat))
+        on_stage(2, 'reduce')
+        while True:
+            failed = next((note for note in notes if self.is_error(note)), None)
+            if failed:
+                return failed
+            if len(notes) == 1 or estimate_tokens("\n\n".join(notes)) <= REDUCE_TOKEN_BUDGET:
+                break
+            groups = chunk_messages([{'speaker': f'Đoạn {i + 1}', 'text': note} for i, note in enumerate(notes)],
+                                    REDUCE_TOKEN_BUDGET)
+            if len(groups) >= len(notes):
+                break  # Từng ghi chú đã chạm ngưỡng, gộp thêm cũng không ngắn hơn
+            notes = self._map_concurrently(self._merge_notes, groups)
+        return self._call_model("\n\n".join(notes), REPORT_SYSTEM_PROMPT, stage='map_reduce_final')
+
     # --- SIMPLE PROCESS (Giữ lại từ file new) ---
-    def simple_process(self, raw_chat: List[Dict]) -> str:
+    def simple_process(self, raw_chat: List[Dict], previous_summary: str = None, on_stage: Callable = None) -> str:
+        if on_stage:
+            on_stage(1, 'summarization')
         chat_str = "\n".join([f"{msg['speaker']}: {msg['text']}" for msg in raw_chat])
         sys_prompt = """
 Bạn là trợ lý ảo tổng hợp tin nhắn nhóm.
 Nhiệm vụ: Đọc đoạn hội thoại và tóm tắt lại 3 ý chính quan trọng nhất một cách ngắn gọn, súc tích.
-Không cần phân tích sâu, chỉ cần nắm bắt thông tin bề mặt nhanh chóng."""
+Không cần phân tích sâu, chỉ cần nắm bắt thông tin bề mặt nhanh chóng.""" + FOLD_INSTRUCTION
 
-        return self._call_model(f"Hội thoại:\n{chat_str}", sys_prompt)
\ No newline at end of file
+        return self._call_model(self._with_previous(f"Hội thoại:\n{chat_str}", previous_summary), sys_prompt, stage='simple')
\ No newline at end of file
@@ -1,10 +1,13 @@
 from flask import Blueprint, render_template, redirect, url_for, flash, request, session
 from flask_login import login_user, logout_user, current_user, login_required
 from app.extensions import db, oauth
-from app.models import User, Post, UserTagScore
+from app.models import User, Post, UserTagScore, Tag
 # [QUAN TRỌNG] Đảm bảo đã import OnboardingForm
 from app.forms import LoginForm, RegisterForm, UpdateAccountForm, OnboardingForm
 from app.utils import save_picture
+from app.interest_cache import interest_cache
+from app.tags import normalize_tags
+from app.events import on_user_profile_changed
 import secrets
 
 auth_bp = Blueprint('auth', __name__)
@@ -35,22 +38,25 @@ def onboarding():
     form = OnboardingForm()
 
     if form.validate_on_submit():
-        selected_tags = form.interests.data
+        # Chuẩn hóa qua normalizer chung, chỉ giữ tag có trong bảng tag
+        selected_tags = Tag.resolve(form.interests.data)
         
         if selected_tags:
             # 1. Lưu dạng chuỗi (để hiển thị profile cho dễ)
-            current_user.interests = ','.join(selected_tags)
+            current_user.interests = ','.join(t.name for t in selected_tags)
             
             # 2. [FIX QUAN TRỌNG] Khởi tạo điểm số ban đầu vào bảng UserTagScore
             # Cho điểm cao (ví dụ 5.0) vì đây là cái họ chủ động chọn
             for tag in selected_tags:
                 # Kiểm tra tránh duplicate
-                exists = UserTagScore.query.filter_by(user_id=current_user.id, tag=tag).first()
+                exists = UserTagScore.query.filter_by(user_id=current_user.id, tag_id=tag.id).first()
                 if not exists:
-                    init_score = UserTagScore(user_id=current_user.id, tag=tag, score=5.0)
+                    init_score = UserTagScore(user_id=current_user.id, tag_id=tag.id, tag=tag.name, score=5.0)
                     db.session.add(init_score)
             
             db.session.commit()
+            # Điểm sở thích vừa thay đổi -> bỏ vector cũ trong cache
+            interest_cache.invalidate(current_user.id)
             flash('Welcome! Your profile is ready.', 'success')
             return redirect(url_for('main.index'))
         else:
@@ -201,9 +207,10 @@ def profile(username):
             # Cập nhật Interests
             # validate_interests trong forms.py đã đảm bảo data không rỗng
             if form.interests.data:
-                current_user.interests = ','.join(form.interests.data)
+                current_user.interests = ','.join(normalize_tags(form.interests.data))
             
             db.session.commit()
+            on_user_profile_changed(current_user)  # Socket đang mở dùng username mới
             flash('Your account has been updated!', 'success')
             return redirect(url_for('auth.profile', username=current_user.username))
         
@@ -226,8 +233,9 @@ def account():
             current_user.image_file = picture_file
         current_user.username = form.username.data
         if form.interests.data:
-            current_user.interests = ','.join(form.interests.data)
+            current_user.interests = ','.join(normalize_tags(form.interests.data))
         db.session.commit()
+        on_user_profile_changed(current_user)  # Socket đang mở dùng username mới
         flash('Account updated!', 'success')
         return redirect(url_for('auth.account'))
     elif request.method == 'GET':
@@ -1,10 +1,16 @@
 from flask import Blueprint, render_template, redirect, url_for, flash, request, current_app, jsonify
 from flask_login import current_user, login_required
 from app.extensions import db, socketio
-from app.models import Room, Message, Activity, Constraint, Transaction, User, RoomRequest 
+from app.models import Room, Message, Activity, Constraint, Transaction, User, RoomRequest, ReadCursor
 from app.forms import CreateRoomForm, ActivityForm, ConstraintForm, TransactionForm
-from app.utils import auto_update_user_interest, score_from_matrix_personalized, check_conflicts, UserTagScore
-from app.ai_summary import SeaLionDialogueSystem 
+from app.utils import admin_required, auto_update_user_interest, check_conflicts, get_user_interest_vector, build_item_tag_matrix, score_items_batch
+from app.summary_jobs import parse_window, stored_summary, summary_jobs
+from app.llm_cache import llm_cache
+from app.llm_gateway import llm_gateway
+from app.events import HISTORY_PAGE_SIZE, forget_room, on_membership_changed, post_room_message, room_channel
+from app.message_writer import message_writer
+from app.membership_cache import membership_cache
+from app.read_cursors import read_cursors
 # [NEW] Import Client để gọi API Hugging Face
 from gradio_client import Client
 import requests
@@ -12,6 +18,8 @@ import os
 
 chat_bp = Blueprint('chat', __name__)
 
+MAX_HISTORY_PAGE = 100   # Giới hạn limit của /chat/<room_id>/messages
+
 # --- CẤU HÌNH CLIENT HUGGING FACE ---
 HF_SPACE_ID = "Whelxi/bartpho-teencode"
 hf_client = None
@@ -65,47 +73,71 @@ def suggest_text():
         hf_client = None
         return jsonify({'suggestion': ''})
 
+@chat_bp.route('/chat/<int:room_id>/messages')
+@login_required
+def room_messages(room_id):
+    """Lịch sử chat dạng JSON: ?before_id=<id cũ nhất đang hiển thị>&limit=N (mới nhất trước)"""
+    room = Room.query.get_or_404(room_id)
+    if room.is_private and current_user not in room.members:
+        return jsonify({'status': 'error', 'message': 'Unauthorized'}), 403
+
+    before_id = request.args.get('before_id', type=int)
+    limit = min(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), MAX_HISTORY_PAGE)
+    messages, has_more = Message.history(room.id, before_id=before_id, limit=max(limit, 1))
+    return jsonify({
+        'status': 'success',
+        'messages': [m.to_dict() for m in messages],
+        'has_more': has_more
+    })
+
 @chat_bp.route('/chat/summary/<int:room_id>', methods=['GET'])
 @login_required
 def get_chat_summary(room_id):
-    mode = request.args.get('mode', 'normal') # Mặc định là normal
+    mode = request.args.get('mode')
+    if mode not in ('paper', 'long'):
+        mode = 'normal' # Mặc định là normal
     room = Room.query.get_or_404(room_id)
     
     # Check quyền truy cập (nếu private)
     if room.is_private and current_user not in room.members:
         return {"error": "Unauthorized"}, 403
 
-    # Lấy 40 tin nhắn gần nhất
-    messages = Message.query.filter_by(room=room.name)\
-                            .order_by(Message.timestamp.desc())\
-                            .limit(40).all()
-    
-    messages.reverse()
-    
-    if not messages:
-        return {"short": "Chưa có tin nhắn", "full": "Chưa có nội dung để tóm tắt"}
+    window = None
+    if mode == 'long':
+        # Map-reduce trên cửa sổ dài: ?hours=24 (từ hôm qua) và/hoặc ?limit=1000 (N tin gần nhất)
+        window = parse_window(request.args.get('hours', type=int), request.args.get('limit', type=int))
+    else:
+        # Không có tin mới -> trả luôn bản tóm tắt đã lưu, không cần job
+        cached = stored_summary(room, mode)
+        if cached:
+            return dict(cached, status='done')
 
-    chat_history = [{"speaker": msg.author.username, "text": msg.body} for msg in messages]
+    # [TỐI ƯU] Các lần gọi AI chạy trong job nền, tiến độ + kết quả đẩy qua Socket.IO (user_<id>)
+    job = summary_jobs.submit(current_app._get_current_object(), room.id, mode, current_user.id, window)
+    return job.to_dict(), 202
 
-    try:
-        sealion = SeaLionDialogueSystem()
-        
-        if mode == 'paper':
-            # Paper Version: Deep Processing (Normalize -> Coref -> Topic)
-            final_report = sealion.process(chat_history)
-            short_msg = "🦁 SeaLion (Paper Mode) đã phân tích sâu hội thoại!"
-        else:
-            # Normal Version: Fast Summarization
-            final_report = sealion.simple_process(chat_history)
-            short_msg = "⚡ AI Recap (Fast Mode) đã tóm tắt nhanh!"
-
-        return {
-            "short": short_msg,
-            "full": final_report
-        }
-    except Exception as e:
-        print(f"AI Error: {e}")
-        return {"short": "Lỗi AI", "full": "Hệ thống đang bận, vui lòng thử lại sau."}
+@chat_bp.route('/chat/summary/job/<string:job_id>', methods=['GET'])
+@login_required
+def summary_job_status(job_id):
+    """Trạng thái job tóm tắt cho client bị mất socket"""
+    job = summary_jobs.get(job_id, current_user.id)
+    if job is None:
+        return {"error": "Job not found"}, 404
+    return job.to_dict()
+
+@chat_bp.route('/api/llm_cache/stats')
+@login_required
+@admin_required
+def llm_cache_stats():
+    """Số liệu hit/miss của cache kết quả AI (RAM + đĩa)"""
+    return jsonify({'status': 'success', 'stats': llm_cache.stats()})
+
+@chat_bp.route('/api/llm_gateway/stats')
+@login_required
+@admin_required
+def llm_gateway_stats():
+    """Độ trễ, số token, lỗi / retry theo từng stage của các lời gọi SeaLion"""
+    return jsonify({'status': 'success', 'stats': llm_gateway.stats()})
 
 @chat_bp.route('/chat', methods=['GET', 'POST'])
 @login_required
@@ -113,41 +145,36 @@ def chat():
     form = CreateRoomForm()
     if form.validate_on_submit():
         is_private_bool = True if form.privacy.data == 'private' else False
-        tags_str = ",".join(form.tags.data) if form.tags.data else ""
-        
         # [NEW] Thêm tham số allow_auto_join lấy từ form
         new_room = Room(
             name=form.name.data, 
             description=form.description.data, 
             is_private=is_private_bool, 
             allow_auto_join=form.allow_auto_join.data, # <--- Dòng mới
-            tags=tags_str, 
             creator=current_user
         )
+        new_room.set_tags(form.tags.data or [])
         new_room.members.append(current_user)
         db.session.add(new_room)
         db.session.commit()
+        read_cursors.seed(current_user.id, new_room.id)
         return redirect(url_for('chat.chat_room', room_name=new_room.name))
 
     my_rooms = current_user.rooms.all()
     my_room_ids = [r.id for r in my_rooms]
     raw_public_rooms = Room.query.filter(Room.is_private == False).filter(Room.id.notin_(my_room_ids)).all()
 
-    # [TỐI ƯU] Lấy sở thích user 1 lần duy nhất
-    current_user_scores = UserTagScore.query.filter_by(user_id=current_user.id).all()
-
     # [DEMO ALGORITHM] Chỉ chạy thuật toán khi bấm nút tìm kiếm
     import random
     if request.args.get('sort') == 'match':
-        ranked_rooms = []
-        for room in raw_public_rooms:
-            room_tags = room.tags.split(',') if room.tags else []
-            # Truyền list sở thích vào đây
-            score = score_from_matrix_personalized(current_user.id, room_tags, user_scores_cache=current_user_scores)
-            ranked_rooms.append((room, score))
-        
+        # [TỐI ƯU] Vector sở thích lấy từ cache, chấm điểm mọi phòng bằng 1 phép toán ma trận
+        user_vector = get_user_interest_vector(current_user.id)
+        room_tag_ids = Room.tag_ids_for([room.id for room in raw_public_rooms])
+        room_matrix = build_item_tag_matrix([room_tag_ids[room.id] for room in raw_public_rooms])
+        scores = score_items_batch(user_vector, room_matrix)
+
         # Sort giảm dần theo điểm (Matching)
-        ranked_rooms.sort(key=lambda x: x[1], reverse=True)
+        ranked_rooms = sorted(zip(raw_public_rooms, scores), key=lambda x: x[1], reverse=True)
         public_rooms = [x[0] for x in ranked_rooms] 
         flash('✨ Algorithm activated! Rooms sorted by compatibility.', 'success')
     else:
@@ -163,8 +190,12 @@ def chat():
     # Status = 'pending_user' nghĩa là Creator đã duyệt hoặc Creator mời trực tiếp
     my_invitations = RoomRequest.query.filter_by(user_id=current_user.id, status='pending_user').all()
 
+    # [TỐI ƯU] Số tin chưa đọc của mọi phòng trong 1 query GROUP BY; sau đó socket đẩy 'unread_update'
+    unread_counts = read_cursors.unread_counts(current_user.id, my_room_ids)
+
     return render_template('chat_lobby.html', title='Chat Lobby', form=form, 
                            my_rooms=my_rooms, 
+                           unread_counts=unread_counts,
                            public_rooms=public_rooms,
                            pending_room_ids=pending_room_ids,
                            my_invitations=my_invitations) # Truyền biến này ra Lobby
@@ -183,6 +214,8 @@ def chat_room(room_name):
     if current_user not in room.members and not room.is_private:
         room.members.append(current_user)
         db.session.commit()
+        read_cursors.seed(current_user.id, room.id)  # Lịch sử trước khi vào không tính là chưa đọc
+        on_membership_changed(room.id, current_user.id, current_user.username, 'offline')
         flash(f'Joined room: {room.name}', 'info')
 
     # 1. Lấy danh sách ID thành viên đang có trong phòng
@@ -287,9 +320,14 @@ def delete_chat_room(room_id):
         return redirect(url_for('chat.chat'))
         
     try:
-        Message.query.filter_by(room=room_to_delete.name).delete()
+        message_writer.discard_room(room_to_delete.id)  # Bỏ tin chưa kịp ghi của phòng này
+        read_cursors.discard_room(room_to_delete.id)
+        Message.query.filter_by(room_id=room_to_delete.id).delete()
+        ReadCursor.query.filter_by(room_id=room_to_delete.id).delete()
         db.session.delete(room_to_delete)
         db.session.commit()
+        membership_cache.invalidate(room_to_delete.id)
+        forget_room(room_to_delete.id)
         flash(f'Room "{room_to_delete.name}" has been deleted.', 'success')
     except Exception as e:
         db.session.rollback()
@@ -312,10 +350,9 @@ def leave_chat_room(room_id):
         db.session.commit()
         
         # Gửi thông báo socket là user này đã thoát hẳn
-        socketio.emit('status', {'msg': f'{current_user.username} left the group.'}, to=room.name)
-        # Cập nhật lại danh sách member cho những người còn lại
-        from app.events import broadcast_user_list # Import hàm helper chúng ta sẽ viết ở events.py
-        broadcast_user_list(room.name)
+        socketio.emit('status', {'msg': f'{current_user.username} left the group.'}, to=room_channel(room.id))
+        # Cập nhật lại danh sách member cho những người còn lại (xóa cache + presence_delta)
+        on_membership_changed(room.id, current_user.id, current_user.username, 'removed')
 
         flash(f'You have left the room "{room.name}".', 'warning')
     
@@ -335,17 +372,18 @@ def request_join_room(room_id):
         room.members.append(current_user)
         
         # Cập nhật sở thích AI (User thích phòng này)
-        if room.tags:
-            tags_list = room.tags.split(',')
-            auto_update_user_interest(current_user.id, tags_list, weight_increment=2.0)
+        auto_update_user_interest(current_user.id, room.tag_ids, weight_increment=2.0)
 
-        # Thông báo vào phòng
-        sys_msg = Message(body=f"has joined the room directly.", room=room.name, author=current_user)
-        db.session.add(sys_msg)
         db.session.commit()
+        read_cursors.seed(current_user.id, room.id)
+        on_membership_changed(room.id, current_user.id, current_user.username, 'offline')
+
+        # Thông báo vào phòng (id tin nhắn do writer cấp -> ghi qua hàng đợi, không INSERT trực tiếp)
+        post_room_message(room.id, room.name, current_user.id, current_user.username,
+                          "has joined the room directly.")
         
         # Bắn socket cập nhật danh sách
-        socketio.emit('status', {'msg': f'{current_user.username} joined.'}, to=room.name)
+        socketio.emit('status', {'msg': f'{current_user.username} joined.'}, to=room_channel(room.id))
         
         flash(f'Welcome aboard! You have joined {room.name}.', 'success')
         return redirect(url_for('chat.chat_room', room_name=room.name))
@@ -360,12 +398,10 @@ def request_join_room(room_id):
     # Tạo yêu cầu mới -> Chờ chủ phòng duyệt
     req = RoomRequest(room_id=room.id, user_id=current_user.id, status='pending_owner')
     db.session.add(req)
-    
-    sys_msg = Message(body=f"System: {current_user.username} wants to join this room.", 
-                      room=room.name, user_id=current_user.id) 
-    db.session.add(sys_msg)
-    
     db.session.commit()
+
+    post_room_message(room.id, room.name, current_user.id, current_user.username,
+                      f"System: {current_user.username} wants to join this room.")
     flash('Join request sent to the room owner.', 'success')
     return redirect(url_for('chat.chat'))
 
@@ -389,11 +425,11 @@ def manage_request(req_id, action):
             db.session.delete(req) # Xóa request vì đã hoàn tất
             
             # (Tùy chọn) Cập nhật sở thích cho User vì đã được vào phòng
-            if room.tags:
-                tags_list = room.tags.split(',')
-                auto_update_user_interest(req.user_id, tags_list, weight_increment=2.0)
+            auto_update_user_interest(req.user_id, room.tag_ids, weight_increment=2.0)
 
             db.session.commit()
+            read_cursors.seed(req.user_id, room.id)
+            on_membership_changed(room.id, req.user_id, req.user.username, 'offline')
             
             # Gửi thông báo SocketIO để User biết mình đã được vào (nếu đang online)
             socketio.emit('request_approved', {
@@ -443,17 +479,18 @@ def respond_invite(req_id, action):
         room.members.append(current_user)
         db.session.delete(req) # Xóa request
 
-        if room.tags:
-            tags_list = room.tags.split(',')
-            # Tăng trọng số mạnh (+2.0) vì hành động join room thể hiện sự quan tâm cao
-            auto_update_user_interest(current_user.id, tags_list, weight_increment=2.0)
+        # Tăng trọng số mạnh (+2.0) vì hành động join room thể hiện sự quan tâm cao
+        auto_update_user_interest(current_user.id, room.tag_ids, weight_increment=2.0)
         
-        # Notify Room
-        msg = Message(body=f"joined the room via invitation.", room=room.name, author=current_user)
-        db.session.add(msg)
         db.session.commit()
+        read_cursors.seed(current_user.id, room.id)
+        on_membership_changed(room.id, current_user.id, current_user.username, 'offline')
+
+        # Notify Room
+        post_room_message(room.id, room.name, current_user.id, current_user.username,
+                          "joined the room via invitation.")
         
-        socketio.emit('status', {'msg': f'{current_user.username} joined.'}, to=room.name)
+        socketio.emit('status', {'msg': f'{current_user.username} joined.'}, to=room_channel(room.id))
         flash(f'You joined {room.name}.', 'success')
         return redirect(url_for('chat.chat_room', room_name=room.name))
         
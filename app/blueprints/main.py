@@ -6,34 +6,48 @@ from sqlalchemy import func, or_ # [NEW] Import để query OR cho tìm kiếm
 from app.extensions import db
 from app.models import Post, Review, Location, User, FriendRequest, Comment
 from app.forms import PostForm, CommentForm
-from app.utils import score_from_matrix_personalized, auto_update_user_interest
+from app.utils import admin_required, auto_update_user_interest
+from app.feed_engine import get_feed_page
+from app.interest_cache import interest_cache
+from app.suggestion_engine import suggest_friends
+from app.user_search import search_users
+from app.tags import normalize_tags
 
 main_bp = Blueprint('main', __name__)
 
+EMBEDDED_COMMENTS = 3     # Số comment mới nhất nhúng sẵn trong mỗi post của feed
+COMMENTS_PAGE_SIZE = 10   # Số comment mỗi lần bấm "Xem bình luận cũ hơn"
+MAX_COMMENTS_PAGE = 50
+
+def _feed_context(posts):
+    """Dữ liệu phụ cho post_card.html: batch query cho cả trang thay vì query theo từng post"""
+    post_ids = [p.id for p in posts]
+    return {
+        'liked_post_ids': Post.liked_post_ids(current_user.id, post_ids),
+        'latest_comments': Comment.latest_for_posts(post_ids, per_post=EMBEDDED_COMMENTS),
+    }
+
 # --- 1. Route xử lý LIKE ---
 @main_bp.route('/post/<int:post_id>/like', methods=['POST'])
 @login_required
 def like_post(post_id):
     post = Post.query.get_or_404(post_id)
     
-    # Lấy tags để tính toán
-    tags_list = post.tags.split(',') if post.tags else []
+    # Lấy tag_id để tính toán
+    tags_list = post.tag_ids
 
-    if post.is_liked_by(current_user):
-        # --- UNLIKE ---
-        post.likes.remove(current_user)
-        action = 'unliked'
+    # Toggle trực tiếp trên post_likes + like_count (atomic), không load danh sách người like
+    action = Post.toggle_like(post.id, current_user.id)
+    if action == 'unliked':
         # [ALGORITHM] Bỏ like -> Giảm sự quan tâm (-1.0)
         auto_update_user_interest(current_user.id, tags_list, weight_increment=-1.0)
     else:
-        # --- LIKE ---
-        post.likes.append(current_user)
-        action = 'liked'
         # [ALGORITHM] Like -> Tăng sự quan tâm (+1.0)
         auto_update_user_interest(current_user.id, tags_list, weight_increment=1.0)
 
     db.session.commit()
-    return jsonify({'status': 'success', 'action': action, 'count': len(post.likes)})
+    count = db.session.query(Post.like_count).filter(Post.id == post.id).scalar()
+    return jsonify({'status': 'success', 'action': action, 'count': count})
 
 # --- 2. Route xử lý COMMENT ---
 @main_bp.route('/post/<int:post_id>/comment', methods=['POST'])
@@ -45,10 +59,10 @@ def comment_post(post_id):
     if form.validate_on_submit():
         comment = Comment(body=form.body.data, author=current_user, post=post)
         db.session.add(comment)
+        Post.bump_counter(post.id, 'comment_count', 1)
         
         # [ALGORITHM] Comment thể hiện sự quan tâm sâu -> Tăng trọng số rất mạnh (+2.0)
-        if post.tags:
-            auto_update_user_interest(current_user.id, post.tags.split(','), weight_increment=2.0)
+        auto_update_user_interest(current_user.id, post.tag_ids, weight_increment=2.0)
             
         db.session.commit()
         return redirect(url_for('main.index')) # Hoặc dùng Ajax nếu muốn xịn hơn
@@ -56,6 +70,31 @@ def comment_post(post_id):
     flash('Error posting comment.', 'danger')
     return redirect(url_for('main.index'))
 
+# --- Route lấy COMMENT cũ hơn (lazy load khi mở khung bình luận) ---
+@main_bp.route('/post/<int:post_id>/comments')
+@login_required
+def post_comments(post_id):
+    post = Post.query.get_or_404(post_id)
+    before_id = request.args.get('before', type=int)
+    limit = min(max(request.args.get('limit', COMMENTS_PAGE_SIZE, type=int), 1), MAX_COMMENTS_PAGE)
+
+    comments = Comment.page_for_post(post.id, before_id=before_id, limit=limit)
+    comments.reverse() # Hiển thị từ cũ -> mới
+    html = ''.join(render_template('comment_item.html', comment=c, post=post) for c in comments)
+
+    return jsonify({
+        'status': 'success',
+        'html': html,
+        'comments': [{
+            'id': c.id,
+            'body': c.body,
+            'timestamp': c.timestamp.strftime('%Y-%m-%d %H:%M'),
+            'username': c.author.username
+        } for c in comments],
+        'comment_count': post.comment_count,
+        'next_before': comments[0].id if len(comments) == limit else None
+    })
+
 # --- Route xử lý DELETE COMMENT ---
 @main_bp.route('/comment/<int:comment_id>/delete', methods=['POST'])
 @login_required
@@ -70,10 +109,10 @@ def delete_comment(comment_id):
     post = comment.post 
     # [ALGORITHM] Xóa comment -> Giảm mạnh sự quan tâm (-2.0)
     # Logic: Nếu lúc comment được +2, thì xóa comment (hết quan tâm/ghét) sẽ bị trừ 2
-    if post.tags:
-        auto_update_user_interest(current_user.id, post.tags.split(','), weight_increment=-2.0)
+    auto_update_user_interest(current_user.id, post.tag_ids, weight_increment=-2.0)
 
     db.session.delete(comment)
+    Post.bump_counter(post.id, 'comment_count', -1)
     db.session.commit()
     
     flash('Comment deleted.', 'success')
@@ -85,14 +124,15 @@ def delete_comment(comment_id):
 @login_required
 def share_post(post_id):
     post = Post.query.get_or_404(post_id)
-    post.shares_count += 1
+    # Tăng atomic trong SQL (tránh mất lượt share khi 2 request chạy song song)
+    Post.bump_counter(post.id, 'shares_count', 1)
     
     # [ALGORITHM] Share là hành động cao nhất -> Tăng trọng số (+3.0)
-    if post.tags:
-        auto_update_user_interest(current_user.id, post.tags.split(','), weight_increment=3.0)
+    auto_update_user_interest(current_user.id, post.tag_ids, weight_increment=3.0)
         
     db.session.commit()
-    return jsonify({'status': 'success', 'shares': post.shares_count})
+    shares = db.session.query(Post.shares_count).filter(Post.id == post.id).scalar()
+    return jsonify({'status': 'success', 'shares': shares})
 
 @main_bp.route('/update_interests', methods=['POST'])
 @login_required
@@ -103,9 +143,9 @@ def update_interests():
     if not isinstance(interests, list):
         return jsonify({'status': 'error', 'message': 'Invalid data format'}), 400
     
-    # Chuyển list thành string CSV để lưu vào DB
+    # Chuyển list thành string CSV (qua normalizer chung) để lưu vào DB
     # Ví dụ: "du lịch bụi,ẩm thực"
-    interests_str = ",".join(interests)
+    interests_str = ",".join(normalize_tags(interests))
     
     current_user.interests = interests_str
     db.session.commit()
@@ -119,13 +159,19 @@ def track_interest():
     tag = data.get('tag')
     
     if tag:
-        # Tăng nhẹ (+0.5) cho hành động click xem/filter tag
-        from app.utils import auto_update_user_interest
+        # Tăng nhẹ (+0.5) cho hành động click xem/filter tag (chỉ ghi vào buffer, không I/O)
         auto_update_user_interest(current_user.id, [tag], weight_increment=0.5)
         return jsonify({'status': 'success', 'msg': f'Interest in {tag} recorded'})
     
     return jsonify({'status': 'error'}), 400
 
+@main_bp.route('/api/interest_cache/stats')
+@login_required
+@admin_required
+def interest_cache_stats():
+    """Số liệu hit/miss của cache vector sở thích (để theo dõi feed có còn query user_tag_score không)"""
+    return jsonify({'status': 'success', 'stats': interest_cache.stats()})
+
 @main_bp.route('/', methods=['GET', 'POST'])
 @main_bp.route('/index', methods=['GET', 'POST'])
 @login_required
@@ -141,45 +187,50 @@ def index():
             if not os.path.exists(upload_folder): os.makedirs(upload_folder)
             file.save(os.path.join(upload_folder, filename))
 
-        tags_str = ''
-        if form.tags.data:
-            tags_str = ','.join(form.tags.data)
-
-        # Tạo post với tags
+        # Tạo post, tag được chuẩn hóa + ghi vào post_tags
         post = Post(
             body=form.body.data, 
             author=current_user, 
-            media_filename=filename,
-            tags=tags_str 
+            media_filename=filename
         )
+        post.set_tags(form.tags.data or [])
         db.session.add(post)
         db.session.commit()
         return redirect(url_for('main.index'))
     
-    all_posts = Post.query.order_by(Post.timestamp.desc()).all()
-    
-    ranked_posts = []
-    for p in all_posts:
-        post_tags = p.tags.split(',') if p.tags else []
-        # Dùng hàm tính điểm Personalize mới
-        score = score_from_matrix_personalized(current_user.id, post_tags)
-        ranked_posts.append((p, score))
-        
-    ranked_posts.sort(key=lambda x: x[1], reverse=True)
-    final_posts = [x[0] for x in ranked_posts]
+    # [FEED ENGINE] Chỉ xếp hạng trang đầu, các trang sau tải qua /feed (infinite scroll)
+    final_posts, next_cursor = get_feed_page(current_user.id)
 
-    # --- [THÊM ĐOẠN CODE NÀY ĐỂ ĐỊNH NGHĨA SUGGESTIONS] ---
-    # Lấy ngẫu nhiên 3 user không phải là mình để gợi ý kết bạn
-    # Lưu ý: Cần import func từ sqlalchemy nếu chưa có: from sqlalchemy import func
-    suggestions = User.query.filter(User.id != current_user.id).order_by(func.random()).limit(3).all()
-    # -------------------------------------------------------
+    # Gợi ý kết bạn: xếp theo số bạn chung + độ tương đồng sở thích (có cache theo user)
+    suggestions = suggest_friends(current_user.id, limit=3)
 
     return render_template('index.html', title='Home', 
                            form=form, 
                            comment_form=comment_form, 
                            posts=final_posts, 
+                           **_feed_context(final_posts),
+                           next_cursor=next_cursor,
                            suggestions=suggestions)
 
+@main_bp.route('/feed')
+@login_required
+def feed():
+    """Trả về trang tiếp theo của feed (JSON) cho infinite scroll ở index.html"""
+    try:
+        posts, next_cursor = get_feed_page(current_user.id, cursor=request.args.get('cursor'))
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid cursor'}), 400
+
+    comment_form = CommentForm()
+    context = _feed_context(posts)
+    html = ''.join(render_template('post_card.html', post=p, comment_form=comment_form, **context) for p in posts)
+    return jsonify({
+        'status': 'success',
+        'html': html,
+        'post_ids': [p.id for p in posts],
+        'next_cursor': next_cursor
+    })
+
 # --- FRIEND SYSTEM ROUTES ---
 
 @main_bp.route('/friends', methods=['GET', 'POST'])
@@ -189,11 +240,8 @@ def friends():
     search_query = request.args.get('q')
     search_results = []
     if search_query:
-        # Tìm User theo username hoặc email (trừ bản thân)
-        search_results = User.query.filter(
-            (User.username.ilike(f'%{search_query}%')) | (User.email.ilike(f'%{search_query}%')),
-            User.id != current_user.id
-        ).all()
+        # Tìm User theo username hoặc email (trừ bản thân) qua index FTS5 / pg_trgm
+        search_results = search_users(search_query, current_user.id)
 
     # 2. Lấy danh sách bạn bè & Lời mời
     my_friends = current_user.friends.all()
@@ -224,10 +272,8 @@ def accept_friend_request(req_id):
 @main_bp.route('/friend/reject/<int:req_id>')
 @login_required
 def reject_friend_request(req_id):
-    req = FriendRequest.query.get_or_404(req_id)
-    if req.receiver_id == current_user.id:
-        db.session.delete(req)
-        db.session.commit()
+    FriendRequest.query.get_or_404(req_id)
+    if current_user.reject_request(req_id):
         flash('Request declined.', 'info')
     return redirect(url_for('main.friends'))
 
@@ -0,0 +1,76 @@
+import json
+from typing import Callable, Dict
+from app.extensions import socketio
+from app.presence import WORKER_ID
+
+# ============================================================================
+# CẤU HÌNH
+# ============================================================================
+CACHE_BUS_CHANNEL = 'cache_invalidation'   # Kênh pub/sub trên Redis dùng chung
+CACHE_BUS_RETRY_DELAY = 1.0                # Giây chờ trước khi nối lại khi mất kết nối Redis
+
+
+class CacheInvalidationBus:
+    """
+    Báo cho các worker khác "cache <name>, key <key> vừa đổi" qua Redis pub/sub.
+    Mỗi cache trong process (membership, gợi ý kết bạn, tên phòng...) đăng ký 1 handler xóa entry;
+    worker thực hiện thay đổi tự cập nhật cache của mình rồi gọi notify_others().
+    1 worker (không có PRESENCE_REDIS_URL): notify_others() không làm gì.
+    """
+
+    def __init__(self):
+        self.client = None
+        self._handlers: Dict[str, Callable] = {}
+        self._started = False
+        self.published = 0
+        self.received = 0
+
+    def register(self, name: str, handler: Callable) -> None:
+        """handler(key) chạy trên worker nhận được thông báo (key đã qua JSON)."""
+        self._handlers[name] = handler
+
+    def init_app(self, app) -> None:
+        url = app.config.get('PRESENCE_REDIS_URL')
+        if app.config.get('SOCKETIO_WORKERS', 1) > 1 and url:
+            import redis
+            self.client = redis.Redis.from_url(url, decode_responses=True)
+
+    def notify_others(self, name: str, key) -> None:
+        if self.client is None:
+            return
+        try:
+            self.client.publish(CACHE_BUS_CHANNEL, json.dumps({'source': WORKER_ID, 'cache': name, 'key': key}))
+            self.published += 1
+        except Exception as e:
+            print(f"Cache bus publish error: {e}")
+
+    def _dispatch(self, raw: str) -> None:
+        data = json.loads(raw)
+        handler = self._handlers.get(data.get('cache'))
+        if data.get('source') == WORKER_ID or handler is None:
+            return
+        self.received += 1
+        handler(data['key'])
+
+    def _run(self) -> None:
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CACHE_BUS_CHANNEL)
+                for message in pubsub.listen():
+                    if message.get('type') == 'message':
+                        self._dispatch(message['data'])
+            except Exception as e:
+                print(f"Cache bus listen error: {e}")
+            socketio.sleep(CACHE_BUS_RETRY_DELAY)
+
+    def start(self) -> None:
+        """Greenlet nghe thông báo của worker khác (chỉ khi có Redis dùng chung)."""
+        if self._started or self.client is None:
+            return
+        self._started = True
+        socketio.start_background_task(self._run)
+
+
+# Instance dùng chung cho toàn app
+cache_bus = CacheInvalidationBus()
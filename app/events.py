@@ -3,133 +3,300 @@ from flask_socketio import emit, join_room, leave_room
 from flask_login import current_user
 from app.extensions import db, socketio
 from app.models import Message, User, Room # Cần import Room
+from app.message_writer import message_writer
+from app.presence import presence
+from app.membership_cache import membership_cache
+from app.typing_aggregator import typing_aggregator
+from app.read_cursors import read_cursors
+from app.cache_bus import cache_bus
 
-# Global state for online users (map: room_name -> {sid: username})
-online_users_in_rooms = {}
+# Presence (ai đang online ở phòng nào) nằm trong app.presence: sid -> rooms, room -> user -> sids
+# Tên phòng (cột legacy message.room) nhớ lúc join, để gửi tin không phải query Room
+# Phòng bị xóa / đổi tên -> forget_room() bỏ entry trên mọi worker
+room_names = {}
 
-def get_online_usernames(room_name):
-    """Helper trả về list username đang online trong room"""
-    if room_name in online_users_in_rooms:
-        return list(set(online_users_in_rooms[room_name].values()))
-    return []
+HISTORY_PAGE_SIZE = 50   # Số tin nhắn mới nhất gửi khi vào phòng / mỗi lần "tải cũ hơn"
+CATCH_UP_LIMIT = 200     # Reconnect lỡ nhiều hơn số tin này -> báo client tải lại từ đầu
 
-def broadcast_user_list(room_name):
+def room_channel(room_id):
+    """Tên Socket.IO room của 1 phòng chat (theo id, không theo tên phòng)"""
+    return f"chat_{room_id}"
+
+class SocketUser:
+    """User của 1 kết nối socket, resolve 1 lần lúc connect (handler không chạm tới current_user / DB)"""
+    __slots__ = ('id', 'username')
+
+    def __init__(self, user_id, username):
+        self.id = user_id
+        self.username = username
+
+# sid -> SocketUser, user_id -> {sid} (để cập nhật khi user đổi username)
+socket_users = {}
+_sids_by_user = {}
+
+def socket_user():
+    """SocketUser của sid hiện tại, None nếu chưa connect/đã disconnect"""
+    return socket_users.get(request.sid)
+
+def _forget_socket_user(sid):
+    user = socket_users.pop(sid, None)
+    if user is not None:
+        sids = _sids_by_user.get(user.id)
+        if sids is not None:
+            sids.discard(sid)
+            if not sids:
+                del _sids_by_user[user.id]
+
+def on_user_profile_changed(user):
     """
-    Hàm này lấy tất cả thành viên từ DB, so sánh với list online
-    để phân loại Online/Offline và gửi về Client.
+    Gọi sau khi commit thay đổi profile (vd: đổi username ở auth.profile / auth.account):
+    cập nhật record của các socket đang mở (trong worker này) + xóa cache thành viên các phòng của user.
+    Tab nối vào worker khác nhận tên mới khi kết nối lại.
     """
-    # [BẢO VỆ] Thêm try-except để tránh sập socket nếu DB mất kết nối tạm thời
+    for sid in _sids_by_user.get(user.id, ()):
+        socket_users[sid].username = user.username
+        for room_id in presence.rooms_of(sid):
+            presence.join(room_id, user.id, user.username, sid)  # Ghi đè tên hiển thị trong presence
+    for room in user.rooms:
+        membership_cache.invalidate(room.id)
+
+def _room_id(data):
+    """Đọc room_id (int) từ payload client gửi lên, sai định dạng -> None"""
     try:
-        room = Room.query.filter_by(name=room_name).first()
-        if not room:
-            return
+        return int(data['room_id'])
+    except (KeyError, TypeError, ValueError):
+        return None
 
-        # 1. Lấy tất cả thành viên từ DB
-        all_members = [m.username for m in room.members]
-        
-        # 2. Lấy danh sách đang online từ biến toàn cục
-        online_usernames = get_online_usernames(room_name)
-        
-        # 3. Tính toán offline (có trong DB nhưng không có trong list online)
-        offline_members = list(set(all_members) - set(online_usernames))
-        
-        # Gửi về client object chứa cả 2 danh sách
-        socketio.emit('user_list', {
-            'online': online_usernames,
-            'offline': offline_members,
-            'total_count': len(all_members)
-        }, to=room_name)
+def presence_snapshot(room_id):
+    """
+    Danh sách Online/Offline đầy đủ của phòng: thành viên lấy từ membership_cache (không query
+    mỗi lần), online lấy từ presence. Chỉ gửi 1 lần cho sid vừa join, sau đó client nhận delta.
+    """
+    members = membership_cache.get(room_id)
+    online = presence.online_users(room_id)
+    return {
+        'online': sorted(set(online.values())),
+        'offline': [name for uid, name in members.items() if uid not in online],
+        'total_count': len(members)
+    }
+
+def broadcast_presence_delta(room_id, user_id, username, status, skip_sid=None):
+    """
+    Gửi 1 thay đổi nhỏ thay cho cả danh sách. status: 'online' | 'offline' | 'removed'.
+    Người rời mạng mà không phải thành viên (xem phòng public) thì coi như 'removed'.
+    """
+    # [BẢO VỆ] Thêm try-except để tránh sập socket nếu DB mất kết nối tạm thời
+    try:
+        members = membership_cache.get(room_id)
+        if status == 'offline' and user_id not in members:
+            status = 'removed'
+        socketio.emit('presence_delta', {
+            'username': username,
+            'status': status,
+            'total_count': len(members)
+        }, to=room_channel(room_id), skip_sid=skip_sid)
     except Exception as e:
-        print(f"Error broadcasting user list: {e}")
+        print(f"Error broadcasting presence delta: {e}")
+
+def forget_room(room_id):
+    """Gọi sau khi xóa / đổi tên phòng: bỏ tên đã nhớ trên mọi worker (lần join sau đọc lại từ DB)."""
+    room_names.pop(room_id, None)
+    cache_bus.notify_others('room_names', room_id)
+
+cache_bus.register('room_names', lambda room_id: room_names.pop(room_id, None))
+
+def on_membership_changed(room_id, user_id, username, status):
+    """
+    Gọi sau khi commit thay đổi thành viên phòng (route HTTP): xóa cache + báo cho phòng.
+    status: 'offline' khi vừa thêm thành viên (chưa mở phòng), 'removed' khi rời phòng.
+    """
+    membership_cache.invalidate(room_id)
+    if status == 'offline' and user_id in presence.online_users(room_id):
+        status = 'online'
+    broadcast_presence_delta(room_id, user_id, username, status)
+
+def broadcast_departures(departures):
+    """Báo 'has left' + presence offline cho các phòng mà user vừa hết kết nối (disconnect / worker chết)"""
+    for room_id, user_id, username, went_offline in departures:
+        if went_offline:
+            typing_aggregator.stopped(room_id, username)
+            socketio.emit('status', {'msg': f'{username} has left.'}, to=room_channel(room_id))
+            broadcast_presence_delta(room_id, user_id, username, 'offline')
+
+def send_history(room_id):
+    """Trang lịch sử mới nhất cho sid vừa join"""
+    # Load lịch sử chat: N tin mới nhất (author eager-load), client cuộn lên thì gọi 'load_older'
+    try:
+        messages, has_more = Message.history(room_id, limit=HISTORY_PAGE_SIZE)
+        payload = [m.to_dict() for m in messages]
+        # Ghép thêm tin đã broadcast nhưng writer chưa kịp ghi xuống DB
+        payload += message_writer.pending_payloads(room_id, after_id=payload[-1]['id'] if payload else 0)
+        has_more = has_more or len(payload) > HISTORY_PAGE_SIZE
+        payload = payload[-HISTORY_PAGE_SIZE:]
+        emit('load_history', {'messages': payload, 'has_more': has_more}, to=request.sid)
+        return payload[-1]['id'] if payload else None
+    except Exception as e: print(f"Error history: {e}")
+
+def send_catch_up(room_id, since_id):
+    """
+    Các tin id > since_id (DB + tin writer chưa ghi), theo thứ tự id.
+    Lỡ quá CATCH_UP_LIMIT tin -> too_far_behind, client tự tải lại trang mới nhất (rồi gửi 'mark_read').
+    Trả về id lớn nhất client đã nhận (None nếu too_far_behind).
+    """
+    payload = [m.to_dict() for m in Message.since(room_id, since_id, limit=CATCH_UP_LIMIT)]
+    payload += message_writer.pending_payloads(room_id, after_id=payload[-1]['id'] if payload else since_id)
+    if len(payload) > CATCH_UP_LIMIT:
+        emit('catch_up', {'messages': [], 'too_far_behind': True}, to=request.sid)
+        return None
+    emit('catch_up', {'messages': payload, 'too_far_behind': False}, to=request.sid)
+    return payload[-1]['id'] if payload else since_id
+
+def track_unread(room_id, message_id):
+    """
+    Tin mới trong phòng: thành viên đang mở phòng coi như đã đọc (cursor tiến trong RAM),
+    thành viên còn lại được đánh dấu để tick sau nhận 'unread_update'. Không query DB.
+    """
+    online = presence.online_users(room_id)
+    members = membership_cache.get(room_id)
+    for user_id in online:
+        if user_id in members:
+            read_cursors.advance(user_id, room_id, message_id)
+    read_cursors.touch([user_id for user_id in members if user_id not in online], room_id)
+
+def post_room_message(room_id, room_name, user_id, username, body):
+    """
+    Tin gửi từ HTTP route (thông báo vào phòng / xin vào phòng): ghi qua hàng đợi của writer
+    rồi broadcast + đánh dấu chưa đọc giống handle_send_message.
+    """
+    payload = message_writer.enqueue(room_id, room_name, user_id, username, body)
+    socketio.emit('receive_message', payload, to=room_channel(room_id))
+    track_unread(room_id, payload['id'])
+    return payload
 
 def register_socketio_events(socketio):
     @socketio.on('connect')
     def handle_connect():
+        # Chỗ duy nhất đọc current_user (session + load_user), các event sau dùng socket_user()
         if not current_user.is_authenticated: return False
+        socket_users[request.sid] = SocketUser(current_user.id, current_user.username)
+        _sids_by_user.setdefault(current_user.id, set()).add(request.sid)
         join_room(f"user_{current_user.id}")
 
     @socketio.on('join')
     def handle_join(data):
-        if not current_user.is_authenticated: return
-        room_name = data['room']
+        user = socket_user()
+        if user is None: return
+        room_id = _room_id(data)
+        room = Room.query.get(room_id) if room_id is not None else None
+        if room is None or (room.is_private and user.id not in membership_cache.get(room_id)): return
         
-        if room_name not in online_users_in_rooms: 
-            online_users_in_rooms[room_name] = {}
+        # Mỗi tab là 1 sid riêng; tab cũ (refresh) tự được gỡ khi disconnect -> không cần quét phòng
+        first_connection = presence.join(room_id, user.id, user.username, request.sid)
+        room_names[room_id] = room.name
+        join_room(room_channel(room_id))
         
-        # Clean up old connections for this user (nếu user refresh tab)
-        current_sids = [sid for sid, user in online_users_in_rooms[room_name].items() if user == current_user.username]
-        for old_sid in current_sids:
-            del online_users_in_rooms[room_name][old_sid]
-
-        online_users_in_rooms[room_name][request.sid] = current_user.username
-        join_room(room_name)
+        if first_connection:
+            emit('status', {'msg': f'{user.username} has joined.'}, to=room_channel(room_id))
+            broadcast_presence_delta(room_id, user.id, user.username, 'online', skip_sid=request.sid)
         
-        emit('status', {'msg': f'{current_user.username} has joined.'}, to=room_name)
+        # Reconnect: client gửi since_id (id lớn nhất đã thấy) -> chỉ gửi phần bị lỡ
+        since_id = data.get('since_id')
+        last_seen_id = None
+        if isinstance(since_id, int) and since_id >= 0:
+            try:
+                last_seen_id = send_catch_up(room_id, since_id)
+            except Exception as e: print(f"Error catch up: {e}")
+        else:
+            last_seen_id = send_history(room_id)
+        # [NEW] Mở phòng = đã đọc tới tin mới nhất vừa gửi (ghi DB theo batch, lobby các tab khác về 0)
+        if last_seen_id:
+            read_cursors.advance(user.id, room_id, last_seen_id)
+            read_cursors.touch([user.id], room_id)
         
-        # Load lịch sử chat
+        # [NEW] Snapshot Online/Offline chỉ cho sid vừa vào, những người khác đã nhận presence_delta
         try:
-            messages = Message.query.filter_by(room=room_name).order_by(Message.timestamp.asc()).limit(50).all()
-            history = [{'msg': m.body, 'username': m.author.username, 'timestamp': m.timestamp.strftime('%Y-%m-%d %H:%M')} for m in messages]
-            emit('load_history', history, to=request.sid)
-        except Exception as e: print(f"Error history: {e}")
-        
-        # [NEW] Gửi danh sách Online/Offline
-        broadcast_user_list(room_name)
+            emit('user_list', presence_snapshot(room_id), to=request.sid)
+        except Exception as e: print(f"Error user list: {e}")
+
+    @socketio.on('load_older')
+    def handle_load_older(data):
+        """Infinite scroll: trang tin nhắn cũ hơn before_id (keyset trên index (room, id))"""
+        if socket_user() is None: return
+        room_id = _room_id(data)
+        # Chỉ socket đã join phòng mới được đọc lịch sử
+        if not presence.is_joined(room_id, request.sid): return
+        try:
+            messages, has_more = Message.history(room_id, before_id=int(data['before_id']), limit=HISTORY_PAGE_SIZE)
+            emit('older_history', {'messages': [m.to_dict() for m in messages], 'has_more': has_more}, to=request.sid)
+        except (KeyError, TypeError, ValueError): return
+        except Exception as e: print(f"Error older history: {e}")
 
     @socketio.on('send_message')
     def handle_send_message(data):
-        if current_user.is_authenticated:
+        user = socket_user()
+        if user is not None:
+            room_id = _room_id(data)
+            # Chỉ gửi được vào phòng mà socket này đã join
+            if not presence.is_joined(room_id, request.sid): return
+            body = data.get('msg')
+            if not body: return
             try:
-                new_msg = Message(body=data['msg'], room=data['room'], author=current_user)
-                db.session.add(new_msg)
-                db.session.commit()
-                emit('receive_message', {
-                    'msg': new_msg.body, 'username': new_msg.author.username,
-                    'timestamp': new_msg.timestamp.strftime('%Y-%m-%d %H:%M')
-                }, to=data['room'])
-            except Exception: db.session.rollback()
+                # [GROUP COMMIT] Không commit ở đây: id + timestamp cấp ngay, writer nền ghi DB theo batch
+                payload = message_writer.enqueue(room_id, room_names.get(room_id), user.id,
+                                                 user.username, body)
+                emit('receive_message', payload, to=room_channel(room_id))
+                typing_aggregator.stopped(room_id, user.username)
+                track_unread(room_id, payload['id'])
+            except Exception as e: print(f"Error send message: {e}")
+
+    @socketio.on('mark_read')
+    def handle_mark_read(data):
+        """Client báo đã đọc tới message_id (vd: sau khi tải lại trang mới nhất bằng HTTP)"""
+        user = socket_user()
+        if user is None: return
+        room_id = _room_id(data)
+        message_id = data.get('message_id')
+        if isinstance(message_id, int) and presence.is_joined(room_id, request.sid):
+            read_cursors.advance(user.id, room_id, message_id)
+            read_cursors.touch([user.id], room_id)
 
     @socketio.on('leave')
     def handle_leave(data):
-        if not current_user.is_authenticated: return
-        room_name = data['room']
-        leave_room(room_name)
+        if socket_user() is None: return
+        room_id = _room_id(data)
+        leave_room(room_channel(room_id))
         
-        # Xóa user khỏi list online
-        if room_name in online_users_in_rooms and request.sid in online_users_in_rooms[room_name]:
-            username = online_users_in_rooms[room_name].pop(request.sid)
-            emit('status', {'msg': f'{username} has left.'}, to=room_name)
-            
-            # [NEW] Cập nhật lại list
-            broadcast_user_list(room_name)
+        # Xóa sid khỏi presence; chỉ báo "left" khi user không còn tab nào khác trong phòng
+        departure = presence.leave(room_id, request.sid)
+        if departure:
+            _, user_id, username, went_offline = departure
+            if went_offline:
+                typing_aggregator.stopped(room_id, username)
+                emit('status', {'msg': f'{username} has left.'}, to=room_channel(room_id))
+                broadcast_presence_delta(room_id, user_id, username, 'offline')
 
     # --- [FIX QUAN TRỌNG] Sửa hàm handle_disconnect ---
     # Thêm *args để nhận bất kỳ tham số nào (EngineIO thường gửi lý do disconnect)
     # Khắc phục lỗi: "TypeError: handle_disconnect() takes 0 positional arguments but 1 was given"
     @socketio.on('disconnect')
     def handle_disconnect(*args):
-        # Có thể không truy cập được current_user lúc disconnect nếu session đã chết
-        # Nên dùng try-except hoặc kiểm tra kỹ
-        try:
-            if not current_user.is_authenticated: return
-        except:
-            return # Nếu lỗi truy cập user, thoát luôn
-
-        for room_name, users in online_users_in_rooms.items():
-            if request.sid in users:
-                username = users.pop(request.sid)
-                emit('status', {'msg': f'{username} has left.'}, to=room_name)
-                
-                # [NEW] Cập nhật lại list
-                broadcast_user_list(room_name)
-                break
+        # Presence tra theo sid (sid -> rooms), không cần current_user và không quét mọi phòng
+        _forget_socket_user(request.sid)
+        typing_aggregator.forget_sid(request.sid)
+        broadcast_departures(presence.disconnect(request.sid))
 
+    # [TỐI ƯU] Không fan-out mỗi phím gõ: chỉ cập nhật typing_aggregator (RAM),
+    # greenlet nền gửi 1 frame 'typing_status' / phòng / tick khi tập người gõ thay đổi
     @socketio.on('typing')
     def handle_typing(data):
-        if current_user.is_authenticated:
-            emit('typing_status', {'username': current_user.username, 'isTyping': True}, to=data['room'], include_self=False)
+        user = socket_user()
+        if user is None or not typing_aggregator.allow(request.sid): return
+        room_id = _room_id(data)
+        if presence.is_joined(room_id, request.sid):
+            typing_aggregator.typing(room_id, user.username)
 
     @socketio.on('stopped_typing')
     def handle_stopped_typing(data):
-        if current_user.is_authenticated:
-            emit('typing_status', {'username': current_user.username, 'isTyping': False}, to=data['room'], include_self=False)
\ No newline at end of file
+        user = socket_user()
+        if user is not None:
+            typing_aggregator.stopped(_room_id(data), user.username)
@@ -0,0 +1,251 @@
+import base64
+import bisect
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+from sqlalchemy import and_, func, or_
+from app.extensions import db
+from app.models import Post
+from app.utils import build_item_tag_matrix, get_user_interest_vector, score_items_batch
+
+# ============================================================================
+# CẤU HÌNH FEED
+# ============================================================================
+FEED_PAGE_SIZE = 10       # Số post trả về mỗi trang (mỗi lần cuộn)
+FEED_WINDOW_SIZE = 200    # Số ứng viên lấy từ DB mỗi lượt (bounded window)
+FEED_HORIZON = 1000       # Chỉ xếp hạng cá nhân hóa trong N post mới nhất
+FEED_RANK_CACHE_SIZE = 512   # Số (user, ảnh chụp head_id) giữ bảng xếp hạng horizon trong RAM
+FEED_RANK_CACHE_TTL = 600    # Giây; quá hạn / worker khác -> chấm lại horizon, cursor vẫn dùng được
+
+# Khóa xếp hạng: (điểm, thời gian, id) -> luôn duy nhất nhờ id
+RankKey = Tuple[float, datetime, int]
+
+
+# ============================================================================
+# CURSOR (Keyset pagination)
+# ============================================================================
+def encode_cursor(state: Dict) -> str:
+    """Mã hóa trạng thái phân trang thành chuỗi an toàn cho URL."""
+    raw = json.dumps(state, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode_cursor(cursor: Optional[str]) -> Dict:
+    """
+    Giải mã cursor do encode_cursor tạo ra.
+    Cursor rỗng -> trang đầu tiên. Cursor hỏng / thiếu khóa / sai kiểu theo mode -> ValueError.
+    """
+    if not cursor:
+        return {}
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception as e:
+        raise ValueError(f"Invalid feed cursor: {e}")
+    if not isinstance(state, dict):
+        raise ValueError("Invalid feed cursor: not an object")
+
+    mode = state.get('m', 'r')
+    if mode not in ('r', 'c'):
+        raise ValueError(f"Invalid feed cursor: unknown mode {mode!r}")
+    if 'h' in state and not _is_int(state['h']):
+        raise ValueError("Invalid feed cursor: 'h' must be an integer")
+    # Mode 'r': (s, t, i) đi cùng nhau (không có = trang đầu); mode 'c': bắt buộc (t, i)
+    required = ('s', 't', 'i') if mode == 'r' and 's' in state else ('t', 'i') if mode == 'c' else ()
+    missing = [k for k in required if k not in state]
+    if missing:
+        raise ValueError(f"Invalid feed cursor: missing {', '.join(missing)}")
+    if required:
+        if 's' in required and (not isinstance(state['s'], (int, float)) or isinstance(state['s'], bool)):
+            raise ValueError("Invalid feed cursor: 's' must be a number")
+        if not _is_int(state['i']) or not isinstance(state['t'], str):
+            raise ValueError("Invalid feed cursor: bad 't' / 'i'")
+        try:
+            state['t'] = datetime.fromisoformat(state['t'])
+        except ValueError as e:
+            raise ValueError(f"Invalid feed cursor: {e}")
+    return state
+
+
+def _is_int(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _cursor_state(mode: str, head_id: int, key: Optional[RankKey] = None,
+                  position: Optional[Tuple[datetime, int]] = None) -> str:
+    state = {'m': mode, 'h': head_id}
+    if key is not None:
+        state.update({'s': float(key[0]), 't': key[1].isoformat(), 'i': key[2]})
+    elif position is not None:
+        state.update({'t': position[0].isoformat(), 'i': position[1]})
+    return encode_cursor(state)
+
+
+# ============================================================================
+# CANDIDATE WINDOWS
+# ============================================================================
+def _iter_candidate_windows(head_id: int, after: Optional[Tuple[datetime, int]] = None,
+                            max_items: Optional[int] = None,
+                            window: Optional[int] = None) -> Iterator[List]:
+    """
+    Lấy ứng viên theo từng cửa sổ (timestamp desc, id desc) bằng keyset,
+    chỉ load các cột cần để xếp hạng (id, timestamp).
+    head_id cố định "ảnh chụp" feed ở trang đầu để post mới không làm lệch trang.
+    """
+    max_items = FEED_HORIZON if max_items is None else max_items
+    window = FEED_WINDOW_SIZE if window is None else window
+    scanned = 0
+    last = after
+    while scanned < max_items:
+        q = db.session.query(Post.id, Post.timestamp).filter(Post.id <= head_id)
+        if last is not None:
+            q = q.filter(or_(Post.timestamp < last[0],
+                             and_(Post.timestamp == last[0], Post.id < last[1])))
+        size = min(window, max_items - scanned)
+        batch = q.order_by(Post.timestamp.desc(), Post.id.desc()).limit(size).all()
+        if not batch:
+            return
+        yield batch
+        scanned += len(batch)
+        last = (batch[-1].timestamp, batch[-1].id)
+        if len(batch) < size:
+            return
+
+
+def _score_window(rows: List, user_vector) -> List[float]:
+    """Chấm điểm cả cửa sổ ứng viên bằng 1 phép toán ma trận (tag_id lấy từ post_tags, 1 query)."""
+    if not user_vector.any():
+        return [0.0] * len(rows)  # User chưa có sở thích -> khỏi query tag
+    tag_ids = Post.tag_ids_for([row.id for row in rows])
+    item_matrix = build_item_tag_matrix([tag_ids[row.id] for row in rows])
+    return score_items_batch(user_vector, item_matrix).tolist()
+
+
+# ============================================================================
+# RANKING
+# ============================================================================
+# (keys tăng dần, vị trí cuối horizon, horizon còn post phía sau hay không)
+RankedHorizon = Tuple[List[RankKey], Optional[Tuple[datetime, int]], bool]
+
+
+class RankedHorizonCache:
+    """
+    (user_id, head_id) -> bảng xếp hạng cả horizon, tính 1 lần ở trang đầu.
+    Các trang sau chỉ cắt lát bảng theo khóa trong cursor thay vì đọc + chấm điểm lại FEED_HORIZON post.
+    Cache theo process: miss (hết hạn, request sang worker khác) thì chấm lại, kết quả vẫn khớp cursor.
+    """
+
+    def __init__(self, max_size: int = FEED_RANK_CACHE_SIZE, ttl: float = FEED_RANK_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[Tuple[int, int], Tuple[float, RankedHorizon]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int, head_id: int) -> Optional[RankedHorizon]:
+        key = (user_id, head_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, user_id: int, head_id: int, ranked: RankedHorizon) -> None:
+        with self._lock:
+            self._entries[(user_id, head_id)] = (time.monotonic() + self.ttl, ranked)
+            self._entries.move_to_end((user_id, head_id))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+ranked_horizon_cache = RankedHorizonCache()
+
+
+def _rank_horizon(user_id: int, head_id: int) -> RankedHorizon:
+    """Duyệt horizon theo cửa sổ, chấm điểm từng cửa sổ bằng 1 phép toán ma trận rồi sắp xếp cả horizon."""
+    user_vector = get_user_interest_vector(user_id)
+    keys: List[RankKey] = []
+    boundary = None
+
+    for batch in _iter_candidate_windows(head_id):
+        scores = _score_window(batch, user_vector)
+        keys.extend((score, row.timestamp, row.id) for row, score in zip(batch, scores))
+        boundary = (batch[-1].timestamp, batch[-1].id)
+
+    keys.sort()
+    return keys, boundary, len(keys) >= FEED_HORIZON
+
+
+def _rank_page(user_id: int, head_id: int, limit: int,
+               below: Optional[RankKey] = None) -> Tuple[List[RankKey], Optional[Tuple[datetime, int]], bool]:
+    """
+    limit khóa lớn nhất còn nhỏ hơn below (đã trả ở các trang trước), sắp xếp giảm dần.
+    Trả về (keys, vị trí cuối horizon, horizon còn post phía sau hay không).
+    """
+    ranked = ranked_horizon_cache.get(user_id, head_id)
+    if ranked is None:
+        ranked = _rank_horizon(user_id, head_id)
+        ranked_horizon_cache.set(user_id, head_id, ranked)
+    keys, boundary, has_tail = ranked
+    end = bisect.bisect_left(keys, below) if below is not None else len(keys)
+    return keys[max(end - limit, 0):end][::-1], boundary, has_tail
+
+
+def _load_posts(post_ids: List[int]) -> List[Post]:
+    """Load đầy đủ các post được chọn, giữ đúng thứ tự xếp hạng."""
+    if not post_ids:
+        return []
+    by_id = {p.id: p for p in Post.query.filter(Post.id.in_(post_ids)).all()}
+    return [by_id[i] for i in post_ids if i in by_id]
+
+
+def get_feed_page(user_id: int, cursor: Optional[str] = None,
+                  limit: Optional[int] = None) -> Tuple[List[Post], Optional[str]]:
+    """
+    Trả về (posts, next_cursor) cho feed cá nhân hóa.
+
+    - Mode 'r': xếp hạng theo điểm trong FEED_HORIZON post mới nhất (chấm 1 lần, giữ trong
+      ranked_horizon_cache), cursor là khóa (score, timestamp, id) của post cuối trang.
+    - Mode 'c': khi horizon đã hết, đi tiếp theo dòng thời gian phía sau horizon.
+    next_cursor = None nghĩa là đã hết feed.
+    """
+    limit = limit or FEED_PAGE_SIZE
+    state = decode_cursor(cursor)
+    head_id = state.get('h') or db.session.query(func.max(Post.id)).scalar()
+    if head_id is None:
+        return [], None
+
+    mode = state.get('m', 'r')
+    keys: List[RankKey] = []
+    chrono_after = None
+
+    if mode == 'r':
+        below = (state['s'], state['t'], state['i']) if 's' in state else None
+        keys, boundary, has_tail = _rank_page(user_id, head_id, limit, below)
+        if len(keys) == limit:
+            post_ids = [k[2] for k in keys]
+            return _load_posts(post_ids), _cursor_state('r', head_id, key=keys[-1])
+        if not has_tail:
+            return _load_posts([k[2] for k in keys]), None
+        # Horizon đã cạn -> lấp phần còn lại bằng các post cũ hơn (theo thời gian)
+        chrono_after = boundary
+    else:
+        chrono_after = (state['t'], state['i'])
+
+    remaining = limit - len(keys)
+    tail = []
+    for batch in _iter_candidate_windows(head_id, after=chrono_after, max_items=remaining, window=remaining):
+        tail.extend(batch)
+
+    post_ids = [k[2] for k in keys] + [row.id for row in tail]
+    next_cursor = None
+    if tail and len(tail) == remaining:
+        next_cursor = _cursor_state('c', head_id, position=(tail[-1].timestamp, tail[-1].id))
+    return _load_posts(post_ids), next_cursor
@@ -0,0 +1,162 @@
+import atexit
+import datetime
+import threading
+from collections import defaultdict
+from typing import Dict, Iterable, Tuple
+from sqlalchemy import Float, and_, bindparam, case, exists, select
+from sqlalchemy.dialects import postgresql, sqlite
+from app.extensions import db, socketio
+from app.models import UserTagScore
+from app.interest_cache import interest_cache
+from app.tags import tag_registry
+
+# ============================================================================
+# CẤU HÌNH
+# ============================================================================
+INTEREST_FLUSH_INTERVAL = 2.0   # Giây giữa 2 lần ghi xuống DB
+
+
+class InterestScoreBuffer:
+    """
+    Write-behind buffer cho điểm sở thích.
+    Các lượt like/comment/share/click chỉ cộng dồn vào RAM theo key (user_id, tag_id),
+    greenlet nền sẽ ghi xuống DB định kỳ bằng executemany: delta dương đi qua 1 lệnh upsert
+    (ON CONFLICT (user_id, tag_id), SQLite/PostgreSQL), delta âm chỉ UPDATE dòng đã có.
+    Việc kẹp điểm trong khoảng [0, max_score] làm luôn trong SQL.
+    """
+
+    def __init__(self, max_score: float, flush_interval: float = INTEREST_FLUSH_INTERVAL):
+        self.max_score = max_score
+        self.flush_interval = flush_interval
+        self._pending: Dict[Tuple[int, int], float] = defaultdict(float)
+        self._lock = threading.Lock()
+        self._started = False
+        self.flushed_rows = 0
+
+    # ------------------------------------------------------------------
+    # ENQUEUE
+    # ------------------------------------------------------------------
+    def add(self, user_id: int, tag_ids: Iterable[int], weight_increment: float) -> None:
+        with self._lock:
+            for tag_id in set(tag_ids):
+                self._pending[(user_id, tag_id)] += weight_increment
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def _drain(self) -> Dict[Tuple[int, int], float]:
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(float)
+        return pending
+
+    def _requeue(self, pending: Dict[Tuple[int, int], float]) -> None:
+        with self._lock:
+            for key, delta in pending.items():
+                self._pending[key] += delta
+
+    # ------------------------------------------------------------------
+    # FLUSH (cần app context)
+    # ------------------------------------------------------------------
+    def _statements(self):
+        t = UserTagScore.__table__
+        delta = bindparam('b_delta', type_=Float)
+        new_score = t.c.score + delta
+        clamped = case((new_score > self.max_score, self.max_score),
+                       (new_score < 0.0, 0.0),
+                       else_=new_score)
+
+        # Record đã có: cộng dồn + kẹp giá trị, chỉ cập nhật thời gian nếu là hành động tích cực
+        update_stmt = t.update().where(
+            and_(t.c.user_id == bindparam('b_user_id'), t.c.tag_id == bindparam('b_tag_id'))
+        ).values(
+            score=clamped,
+            last_interaction=case((delta > 0, bindparam('b_now')), else_=t.c.last_interaction)
+        )
+
+        # Record chưa có: chỉ tạo mới khi tổng điểm dương (giống logic cũ)
+        initial = case((delta > self.max_score, self.max_score), else_=delta)
+        dialect_insert = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}.get(
+            db.session.get_bind().dialect.name)
+        if dialect_insert is not None:
+            # Dựa vào unique index uq_user_tag_score_user_tag: 1 lệnh cho cả dòng mới lẫn dòng cũ
+            upsert_stmt = dialect_insert(t).values(
+                user_id=bindparam('b_user_id'), tag_id=bindparam('b_tag_id'), tag=bindparam('b_tag'),
+                score=initial, last_interaction=bindparam('b_now')
+            )
+            upsert_stmt = upsert_stmt.on_conflict_do_update(
+                index_elements=['user_id', 'tag_id'],
+                set_={'score': clamped, 'last_interaction': bindparam('b_now')}
+            )
+            return update_stmt, upsert_stmt, True
+
+        insert_stmt = t.insert().from_select(
+            ['user_id', 'tag_id', 'tag', 'score', 'last_interaction'],
+            select(
+                bindparam('b_user_id'), bindparam('b_tag_id'), bindparam('b_tag'),
+                initial,
+                bindparam('b_now')
+            ).where(~exists().where(and_(t.c.user_id == bindparam('b_user_id'),
+                                         t.c.tag_id == bindparam('b_tag_id'))))
+        )
+        return update_stmt, insert_stmt, False
+
+    def flush(self) -> int:
+        pending = {k: v for k, v in self._drain().items() if v != 0}
+        if not pending:
+            return 0
+
+        now = datetime.datetime.utcnow()
+        params = [{'b_user_id': uid, 'b_tag_id': tag_id, 'b_tag': tag_registry.name(tag_id),
+                   'b_delta': delta, 'b_now': now}
+                  for (uid, tag_id), delta in pending.items()]
+        update_stmt, insert_stmt, is_upsert = self._statements()
+        positive = [p for p in params if p['b_delta'] > 0 and p['b_tag']]
+        try:
+            if is_upsert:
+                negative = [p for p in params if p['b_delta'] < 0]
+                if negative:
+                    db.session.execute(update_stmt, negative)
+                if positive:
+                    db.session.execute(insert_stmt, positive)
+            else:
+                db.session.execute(update_stmt, params)
+                if positive:
+                    db.session.execute(insert_stmt, positive)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            self._requeue(pending)  # Không làm mất điểm, lần flush sau thử lại
+            raise
+
+        for uid in {uid for uid, _ in pending}:
+            interest_cache.invalidate(uid)
+        self.flushed_rows += len(params)
+        return len(params)
+
+    # ------------------------------------------------------------------
+    # BACKGROUND GREENLET
+    # ------------------------------------------------------------------
+    def _run(self, app) -> None:
+        while True:
+            socketio.sleep(self.flush_interval)
+            with app.app_context():
+                try:
+                    self.flush()
+                except Exception as e:
+                    print(f"Interest flush error: {e}")
+
+    def _flush_on_exit(self, app) -> None:
+        with app.app_context():
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Interest final flush error: {e}")
+
+    def start(self, app) -> None:
+        """Chạy greenlet flush định kỳ + flush lần cuối khi tắt server."""
+        if self._started:
+            return
+        self._started = True
+        socketio.start_background_task(self._run, app)
+        atexit.register(self._flush_on_exit, app)
@@ -0,0 +1,81 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+import numpy as np
+
+# ============================================================================
+# CẤU HÌNH CACHE
+# ============================================================================
+INTEREST_CACHE_SIZE = 2048   # Số user tối đa giữ trong bộ nhớ (LRU)
+INTEREST_CACHE_TTL = 600     # Giây, hết hạn thì load lại từ bảng user_tag_score
+
+
+class InterestVectorCache:
+    """
+    LRU cache trong process cho vector sở thích (float32, căn theo TAG_INDEX), key = user_id.
+    Vector trả về là read-only (dùng chung giữa các request). Khi điểm trong DB thay đổi
+    thì invalidate entry, lần đọc sau sẽ load lại.
+    """
+
+    def __init__(self, max_size: int = INTEREST_CACHE_SIZE, ttl: float = INTEREST_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()  # user_id -> (expires_at, vector)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _freeze(vector: np.ndarray) -> np.ndarray:
+        vector = np.array(vector, dtype=np.float32, copy=True)
+        vector.flags.writeable = False
+        return vector
+
+    def get(self, user_id: int) -> Optional[np.ndarray]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[user_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, user_id: int, vector: np.ndarray) -> np.ndarray:
+        frozen = self._freeze(vector)
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, frozen)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return frozen
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hit_rate': round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+# Instance dùng chung cho toàn app
+interest_cache = InterestVectorCache()
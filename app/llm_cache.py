@@ -0,0 +1,121 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+# ============================================================================
+# CẤU HÌNH CACHE
+# ============================================================================
+LLM_CACHE_SIZE = 512        # Số kết quả tối đa giữ trong bộ nhớ (LRU)
+LLM_CACHE_TTL = 6 * 3600    # Giây, TTL mặc định của 1 entry (set() có thể truyền TTL riêng)
+
+
+def normalize_text(text: str) -> str:
+    """Bỏ khoảng trắng thừa / dòng trống để input chỉ khác nhau về khoảng trắng vẫn trùng key."""
+    lines = (' '.join(line.split()) for line in (text or '').strip().splitlines())
+    return '\n'.join(line for line in lines if line)
+
+
+class LLMResultCache:
+    """
+    Cache kết quả gọi LLM theo nội dung: key = sha256(model, stage, system prompt, input đã chuẩn hóa).
+    Tầng 1: LRU trong process. Tầng 2 (tùy chọn, LLM_CACHE_PATH): file SQLite riêng, còn nguyên
+    sau khi restart và dùng chung giữa các worker trên cùng máy; hit ở tầng 2 được đưa lên tầng 1.
+    Mỗi entry mang expires_at riêng. Chỉ lưu kết quả thành công (caller tự lọc lỗi).
+    """
+
+    def __init__(self, max_size: int = LLM_CACHE_SIZE, ttl: float = LLM_CACHE_TTL, path: str = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._disk: Optional[sqlite3.Connection] = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if path:
+            self.open_disk(path)
+
+    def init_app(self, app) -> None:
+        self.max_size = app.config.get('LLM_CACHE_SIZE', self.max_size)
+        self.ttl = app.config.get('LLM_CACHE_TTL', self.ttl)
+        if app.config.get('LLM_CACHE_PATH'):
+            self.open_disk(app.config['LLM_CACHE_PATH'])
+
+    def open_disk(self, path: str) -> None:
+        conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')  # Nhiều worker đọc/ghi cùng file
+        conn.execute('CREATE TABLE IF NOT EXISTS llm_cache '
+                     '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)')
+        conn.execute('DELETE FROM llm_cache WHERE expires_at < ?', (time.time(),))
+        with self._lock:
+            self._disk = conn
+
+    @staticmethod
+    def key(model: str, stage: str, system_prompt: str, prompt: str) -> str:
+        raw = json.dumps([model, stage, normalize_text(system_prompt), normalize_text(prompt)],
+                         ensure_ascii=False)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] >= now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            row = self._disk.execute('SELECT value, expires_at FROM llm_cache WHERE key = ? AND expires_at >= ?',
+                                     (key, now)).fetchone() if self._disk else None
+            if row is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, row[0], row[1])
+            return row[0]
+
+    def set(self, key: str, value: str, ttl: float = None) -> None:
+        expires_at = time.time() + (ttl if ttl is not None else self.ttl)
+        with self._lock:
+            self._remember(key, value, expires_at)
+            if self._disk:
+                self._disk.execute('INSERT OR REPLACE INTO llm_cache (key, value, expires_at) VALUES (?, ?, ?)',
+                                   (key, value, expires_at))
+
+    def _remember(self, key: str, value: str, expires_at: float) -> None:
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            if self._disk:
+                self._disk.execute('DELETE FROM llm_cache')
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = self.hits + self.disk_hits + self.misses
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'disk': self._disk is not None,
+                'hit_rate': round((self.hits + self.disk_hits) / total, 4) if total else 0.0,
+            }
+
+
+# Instance dùng chung cho toàn app
+llm_cache = LLMResultCache()
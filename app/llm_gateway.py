@@ -0,0 +1,169 @@
+import random
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+# ============================================================================
+# CẤU HÌNH
+# ============================================================================
+SEALION_MODEL = "aisingapore/Gemma-SEA-LION-v4-27B-IT"
+LLM_MAX_CONCURRENCY = 4       # Số lời gọi model đang chạy tối đa trong 1 process
+LLM_TIMEOUT = 60.0            # Giây, hạn chót cho 1 lời gọi (tính cả thời gian chờ slot + retry)
+LLM_MAX_RETRIES = 2           # Số lần thử lại tối đa cho 1 lời gọi (lỗi mạng / 429 / 5xx)
+LLM_BACKOFF_BASE = 0.5        # Giây, backoff = random(0, base * 2^lần thử) (full jitter)
+LLM_RETRY_BUDGET_RATIO = 0.1  # Mỗi lời gọi thành công nạp 0.1 lượt retry vào quỹ
+LLM_RETRY_BUDGET_MAX = 10.0   # Quỹ retry tối đa (cũng là số lượt có sẵn lúc khởi động)
+
+
+class LLMDeadlineExceeded(Exception):
+    """Hết hạn chót trước khi có slot / trước khi thử lại được."""
+
+
+class RetryBudget:
+    """
+    Token bucket cho retry: thành công thì nạp ratio lượt, mỗi lần retry tiêu 1 lượt.
+    API sập hẳn thì quỹ cạn nhanh -> không nhân số request lên (retry storm).
+    """
+
+    def __init__(self, ratio: float = LLM_RETRY_BUDGET_RATIO, max_tokens: float = LLM_RETRY_BUDGET_MAX):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self._lock = threading.Lock()
+
+    def deposit(self) -> None:
+        with self._lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class LLMGateway:
+    """
+    Điểm gọi LLM dùng chung cho cả process (ai_summary, planner_engine):
+    - 1 OpenAI client duy nhất (connection pool keep-alive, không bắt tay TLS lại mỗi request)
+    - BoundedSemaphore giới hạn số lời gọi đang chạy
+    - Hạn chót cho từng lời gọi, retry có jitter trong giới hạn của RetryBudget
+    - Số liệu theo stage: số lần gọi / lỗi / retry, độ trễ, token vào-ra
+    Lỗi cuối cùng được raise lại cho caller (caller tự quyết định thông báo gì).
+    """
+
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY, timeout: float = LLM_TIMEOUT,
+                 max_retries: int = LLM_MAX_RETRIES):
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.api_key = None
+        self.base_url = None
+        self.budget = RetryBudget()
+        self._client = None
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+
+    def init_app(self, app) -> None:
+        self.api_key = app.config.get('SEALION_API_KEY')
+        self.base_url = app.config.get('SEALION_BASE_URL')
+        self.timeout = app.config.get('LLM_TIMEOUT', self.timeout)
+        self.max_concurrency = app.config.get('LLM_MAX_CONCURRENCY', self.max_concurrency)
+        self._semaphore = threading.BoundedSemaphore(self.max_concurrency)
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from openai import OpenAI
+            from config import Config
+            with self._lock:
+                if self._client is None:
+                    # Retry do gateway tự làm (có budget), SDK không retry thêm
+                    self._client = OpenAI(api_key=self.api_key or Config.SEALION_API_KEY,
+                                          base_url=self.base_url or Config.SEALION_BASE_URL,
+                                          max_retries=0, timeout=self.timeout)
+        return self._client
+
+    @staticmethod
+    def _retryable(error: Exception) -> bool:
+        from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+        return isinstance(error, (APIConnectionError, APITimeoutError, InternalServerError, RateLimitError))
+
+    # ------------------------------------------------------------------
+    # CALL
+    # ------------------------------------------------------------------
+    def complete(self, messages: List[Dict], stage: str = 'default', model: str = SEALION_MODEL,
+                 temperature: float = 0.0, max_tokens: int = 2048, timeout: Optional[float] = None) -> str:
+        """Gọi chat completion, trả về nội dung (đã strip). Raise nếu hết retry / hết hạn chót."""
+        deadline = time.monotonic() + (timeout or self.timeout)
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self._semaphore.acquire(timeout=remaining):
+                self._record(stage, 'deadline_exceeded')
+                raise LLMDeadlineExceeded(f"LLM call '{stage}' timed out waiting for a slot")
+            started = time.monotonic()
+            try:
+                response = self.client.with_options(timeout=max(deadline - started, 0.1)).chat.completions.create(
+                    model=model, messages=messages, temperature=temperature, max_tokens=max_tokens)
+            except Exception as e:
+                self._record(stage, 'errors', latency=time.monotonic() - started)
+                backoff = random.uniform(0, LLM_BACKOFF_BASE * (2 ** attempt))
+                if (not self._retryable(e) or attempt >= self.max_retries
+                        or time.monotonic() + backoff >= deadline or not self.budget.withdraw()):
+                    raise
+                attempt += 1
+                self._record(stage, 'retries')
+            else:
+                self.budget.deposit()
+                usage = getattr(response, 'usage', None)
+                self._record(stage, 'calls', latency=time.monotonic() - started,
+                             prompt_tokens=getattr(usage, 'prompt_tokens', 0) or 0,
+                             completion_tokens=getattr(usage, 'completion_tokens', 0) or 0)
+                return response.choices[0].message.content.strip()
+            finally:
+                self._semaphore.release()
+            time.sleep(backoff)  # Ngoài semaphore: không giữ slot trong lúc chờ
+
+    # ------------------------------------------------------------------
+    # METRICS
+    # ------------------------------------------------------------------
+    def _record(self, stage: str, counter: str, latency: float = None, **tokens) -> None:
+        with self._lock:
+            m = self._metrics[stage]
+            m[counter] += 1
+            if latency is not None:
+                m['latency_total'] += latency
+                m['latency_max'] = max(m['latency_max'], latency)
+                m['timed'] += 1
+            for name, value in tokens.items():
+                m[name] += value
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stages = {}
+            for stage, m in self._metrics.items():
+                stages[stage] = {
+                    'calls': int(m['calls']),
+                    'errors': int(m['errors']),
+                    'retries': int(m['retries']),
+                    'deadline_exceeded': int(m['deadline_exceeded']),
+                    'avg_latency': round(m['latency_total'] / m['timed'], 3) if m['timed'] else 0.0,
+                    'max_latency': round(m['latency_max'], 3),
+                    'prompt_tokens': int(m['prompt_tokens']),
+                    'completion_tokens': int(m['completion_tokens']),
+                }
+            return {
+                'max_concurrency': self.max_concurrency,
+                'timeout': self.timeout,
+                'retry_budget': round(self.budget.tokens, 2),
+                'stages': stages,
+            }
+
+
+# Instance dùng chung cho toàn app
+llm_gateway = LLMGateway()
@@ -0,0 +1,78 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+from app.extensions import db
+from app.cache_bus import cache_bus
+
+# ============================================================================
+# CẤU HÌNH CACHE
+# ============================================================================
+MEMBERSHIP_CACHE_SIZE = 1024   # Số phòng tối đa giữ trong bộ nhớ (LRU)
+MEMBERSHIP_CACHE_TTL = 300     # Giây; lưới an toàn nếu mất thông báo invalidate từ worker khác
+
+
+class RoomMembershipCache:
+    """
+    LRU cache trong process: room_id -> {user_id: username} của thành viên phòng.
+    Các route đổi thành viên (join / leave / duyệt / nhận lời mời) gọi invalidate(room_id),
+    lần đọc sau load lại bằng 1 query trên index (room_id, user_id) của room_members.
+    Nhiều worker: invalidate() báo thêm cho worker khác qua cache_bus (kiểm tra quyền vào phòng
+    private đọc cache này, không thể chờ hết TTL).
+    """
+
+    def __init__(self, max_size: int = MEMBERSHIP_CACHE_SIZE, ttl: float = MEMBERSHIP_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()  # room_id -> (expires_at, members)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _load(room_id: int) -> Dict[int, str]:
+        from app.models import User, room_members
+        rows = db.session.query(User.id, User.username)\
+            .join(room_members, room_members.c.user_id == User.id)\
+            .filter(room_members.c.room_id == room_id).all()
+        return {uid: username for uid, username in rows}
+
+    def _get_cached(self, room_id: int) -> Optional[Dict[int, str]]:
+        with self._lock:
+            entry = self._entries.get(room_id)
+            if entry is None or entry[0] < time.monotonic():
+                self._entries.pop(room_id, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(room_id)
+            self.hits += 1
+            return entry[1]
+
+    def get(self, room_id: int) -> Dict[int, str]:
+        """{user_id: username} của phòng (cần app context khi cache miss). Không sửa dict trả về."""
+        members = self._get_cached(room_id)
+        if members is None:
+            members = self._load(room_id)
+            with self._lock:
+                self._entries[room_id] = (time.monotonic() + self.ttl, members)
+                self._entries.move_to_end(room_id)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return members
+
+    def invalidate(self, room_id: int) -> None:
+        self._drop(room_id)
+        cache_bus.notify_others('membership', room_id)
+
+    def _drop(self, room_id: int) -> None:
+        with self._lock:
+            self._entries.pop(room_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+# Instance dùng chung cho toàn app
+membership_cache = RoomMembershipCache()
+cache_bus.register('membership', membership_cache._drop)
@@ -0,0 +1,224 @@
+import atexit
+import datetime
+import threading
+from collections import deque
+from typing import Deque, Dict, List, Set, Tuple
+from sqlalchemy.exc import IntegrityError
+from app.extensions import db, socketio
+from app.models import IdSequence, Message
+
+# ============================================================================
+# CẤU HÌNH
+# ============================================================================
+MESSAGE_FLUSH_INTERVAL = 0.02   # Giây tối đa 1 tin nằm trong hàng đợi trước khi ghi DB
+MESSAGE_FLUSH_BATCH = 200       # Đủ N tin thì ghi luôn (và mỗi lệnh INSERT tối đa N dòng)
+MESSAGE_ID_BLOCK = 100          # Số id xin trước mỗi lần từ bảng id_sequence (1 worker)
+MESSAGE_ID_KEY = 'id_sequence:message'   # Bộ đếm id dùng chung trên Redis (nhiều worker)
+MESSAGE_ID_SEED_GAP = 10000     # Redis mất bộ đếm (restart) -> khởi tạo lại cách id cao nhất đã biết 1 khoảng
+
+
+class MessageWriter:
+    """
+    Group-commit cho tin nhắn chat.
+    Socket handler chỉ cấp id + timestamp ngay trong RAM rồi broadcast luôn, tin nhắn được
+    đưa vào hàng đợi FIFO; greenlet nền gom cả hàng đợi thành 1 lệnh executemany + 1 commit
+    (mỗi MESSAGE_FLUSH_INTERVAL giây hoặc khi đủ MESSAGE_FLUSH_BATCH tin).
+    Id cấp theo thứ tự vào hàng đợi nên thứ tự trong từng phòng được giữ nguyên.
+    Nhiều worker: id lấy từ 1 bộ đếm INCR trên Redis thay cho block riêng của từng worker, để id vẫn
+    tăng theo thứ tự gửi trên toàn cụm (catch-up, đếm chưa đọc, tóm tắt đều dựa vào id > mốc).
+    """
+
+    def __init__(self, flush_interval: float = MESSAGE_FLUSH_INTERVAL,
+                 max_batch: int = MESSAGE_FLUSH_BATCH, id_block: int = MESSAGE_ID_BLOCK):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.id_block = id_block
+        # Mỗi phần tử: (dòng INSERT, username) - username chỉ để dựng payload khi còn trong hàng đợi
+        self._queue: Deque[Tuple[Dict, str]] = deque()
+        # Batch đã lấy khỏi hàng đợi nhưng chưa commit xong: vẫn tính là "chưa ghi" cho tới khi
+        # commit (hoặc bị trả lại hàng đợi), để lúc đang flush tin không biến mất khỏi lịch sử
+        self._inflight: List[Tuple[Dict, str]] = []
+        # Phòng bị xóa trong lúc 1 batch đang ghi: dòng của phòng đó bị lọc / xóa lại khi batch xong
+        self._discarded: Set[int] = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._next_id = 0
+        self._block_end = 0
+        self._id_client = None      # Redis client của bộ đếm dùng chung (None = block từ id_sequence)
+        self._id_floor = None       # Id cao nhất đã biết từ DB, để khởi tạo bộ đếm Redis
+        self._last_id = 0
+        self._started = False
+        self.flushed_rows = 0
+        self.commits = 0
+
+    # ------------------------------------------------------------------
+    # ENQUEUE (cần app context lúc hết block id)
+    # ------------------------------------------------------------------
+    def use_shared_ids(self, client) -> None:
+        """Cấp id từ bộ đếm Redis dùng chung (client: redis.Redis hoặc stand-in cùng API)."""
+        self._id_client = client
+
+    def _allocate_shared_id(self) -> int:
+        if self._id_floor is None:
+            # Vượt qua mọi id đã cấp bằng id_sequence / đã ghi xuống DB
+            self._id_floor = IdSequence.reserve(Message.__tablename__, 1)
+        pipe = self._id_client.pipeline()
+        # SET NX chỉ có tác dụng khi chưa có bộ đếm; MULTI: khởi tạo + INCR là 1 bước với worker khác
+        pipe.set(MESSAGE_ID_KEY, max(self._id_floor, self._last_id) + MESSAGE_ID_SEED_GAP, nx=True)
+        pipe.incr(MESSAGE_ID_KEY)
+        self._last_id = pipe.execute()[1]
+        return self._last_id
+
+    def _allocate_id(self) -> int:
+        if self._id_client is not None:
+            return self._allocate_shared_id()
+        if self._next_id >= self._block_end:
+            self._next_id = IdSequence.reserve(Message.__tablename__, self.id_block)
+            self._block_end = self._next_id + self.id_block
+        self._next_id += 1
+        return self._next_id - 1
+
+    def enqueue(self, room_id: int, room_name: str, user_id: int, username: str, body: str) -> Dict:
+        """Đưa 1 tin vào hàng đợi ghi, trả về payload (đã có id, timestamp) để broadcast ngay."""
+        now = datetime.datetime.utcnow()
+        with self._lock:
+            message_id = self._allocate_id()
+            self._queue.append(({
+                'id': message_id, 'body': body, 'timestamp': now,
+                'room_id': room_id, 'room': room_name, 'user_id': user_id,
+            }, username))
+            full = len(self._queue) >= self.max_batch
+        if full:
+            self._wakeup.set()
+        return Message.payload(message_id, body, username, now)
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return len(self._queue) + len(self._inflight)
+
+    def pending_rooms(self) -> Set[int]:
+        """Các phòng đang có tin chưa commit (đếm chưa đọc của phòng này lúc này sẽ thiếu)."""
+        with self._lock:
+            return {row['room_id'] for row, _ in self._inflight} | {row['room_id'] for row, _ in self._queue}
+
+    def pending_payloads(self, room_id: int, after_id: int = 0) -> List[Dict]:
+        """Tin của phòng đã broadcast nhưng chưa commit xuống DB (để ghép vào lịch sử vừa đọc)."""
+        with self._lock:
+            return [Message.payload(row['id'], row['body'], username, row['timestamp'])
+                    for row, username in self._inflight + list(self._queue)
+                    if row['room_id'] == room_id and row['id'] > after_id]
+
+    def discard_room(self, room_id: int) -> None:
+        """Phòng bị xóa -> bỏ các tin chưa ghi của phòng đó (cả batch đang ghi dở)."""
+        with self._lock:
+            self._queue = deque(item for item in self._queue if item[0]['room_id'] != room_id)
+            self._discarded.add(room_id)
+
+    def _take(self) -> List[Tuple[Dict, str]]:
+        with self._lock:
+            self._inflight = [self._queue.popleft() for _ in range(min(len(self._queue), self.max_batch))]
+            return self._inflight
+
+    def _done(self) -> Set[int]:
+        """Batch đang ghi đã commit xong (hoặc đã bỏ dòng hỏng). Trả về các phòng bị xóa trong lúc ghi."""
+        with self._lock:
+            self._inflight = []
+            discarded, self._discarded = self._discarded, set()
+            return discarded
+
+    def _requeue(self, batch: List[Tuple[Dict, str]]) -> None:
+        with self._lock:
+            batch = [item for item in batch if item[0]['room_id'] not in self._discarded]
+            self._queue.extendleft(reversed(batch))  # Trả về đầu hàng đợi, giữ nguyên thứ tự
+            self._inflight = []
+            self._discarded = set()
+
+    def _delete_discarded(self, rows: List[Dict], discarded: Set[int]) -> None:
+        """Phòng bị xóa khi INSERT đang chạy: xóa lại các dòng vừa ghi của phòng đó."""
+        ids = [row['id'] for row in rows if row['room_id'] in discarded]
+        if ids:
+            db.session.execute(Message.__table__.delete().where(Message.__table__.c.id.in_(ids)))
+            db.session.commit()
+
+    # ------------------------------------------------------------------
+    # FLUSH (cần app context)
+    # ------------------------------------------------------------------
+    def _insert_rows_one_by_one(self, rows: List[Dict]) -> int:
+        """Batch lỗi ràng buộc (vd: phòng vừa bị xóa) -> ghi từng dòng, bỏ dòng hỏng thay vì kẹt cả hàng đợi."""
+        written = 0
+        for row in rows:
+            try:
+                db.session.execute(Message.__table__.insert(), row)
+                db.session.commit()
+                written += 1
+            except IntegrityError as e:
+                db.session.rollback()
+                print(f"Dropped chat message {row['id']} (room {row['room_id']}): {e.orig}")
+        self.commits += written
+        return written
+
+    def flush(self) -> int:
+        """Ghi toàn bộ hàng đợi, mỗi batch MESSAGE_FLUSH_BATCH dòng = 1 commit. Trả về số dòng đã ghi."""
+        total = 0
+        while True:
+            batch = self._take()
+            if not batch:
+                return total
+            with self._lock:
+                rows = [row for row, _ in batch if row['room_id'] not in self._discarded]
+            try:
+                if rows:
+                    db.session.execute(Message.__table__.insert(), rows)
+                    db.session.commit()
+                    self.commits += 1
+                written = len(rows)
+            except IntegrityError:
+                db.session.rollback()
+                written = self._insert_rows_one_by_one(rows)
+            except Exception:
+                db.session.rollback()
+                self._requeue(batch)  # DB tạm lỗi: không làm mất tin, lần flush sau thử lại
+                raise
+            discarded = self._done()
+            if discarded:
+                self._delete_discarded(rows, discarded)
+            self.flushed_rows += written
+            total += written
+
+    # ------------------------------------------------------------------
+    # BACKGROUND GREENLET
+    # ------------------------------------------------------------------
+    def _run(self, app) -> None:
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            if not self.pending_count():
+                continue
+            with app.app_context():
+                try:
+                    self.flush()
+                except Exception as e:
+                    print(f"Message flush error: {e}")
+                    socketio.sleep(1)  # Tránh retry dồn dập khi DB đang lỗi
+
+    def _flush_on_exit(self, app) -> None:
+        with app.app_context():
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Message final flush error: {e}")
+
+    def start(self, app) -> None:
+        """Chạy greenlet ghi tin nhắn + flush lần cuối khi tắt server."""
+        if self._started:
+            return
+        self._started = True
+        self.id_block = app.config.get('MESSAGE_ID_BLOCK', self.id_block)
+        if app.config.get('SOCKETIO_WORKERS', 1) > 1 and app.config.get('PRESENCE_REDIS_URL'):
+            import redis
+            self.use_shared_ids(redis.Redis.from_url(app.config['PRESENCE_REDIS_URL'], decode_responses=True))
+        socketio.start_background_task(self._run, app)
+        atexit.register(self._flush_on_exit, app)
+
+
+message_writer = MessageWriter()
@@ -0,0 +1,375 @@
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, List, Tuple
+from sqlalchemy import inspect, text
+from app.extensions import db
+
+# ============================================================================
+# VERSIONED SCHEMA MIGRATIONS
+# ============================================================================
+# create_app không gọi db.create_all() nữa, mọi thay đổi schema đi qua đây:
+# - DB trống hoàn toàn: tạo schema theo model hiện tại (baseline) rồi chạy
+#   toàn bộ migration (để có cả phần không phải bảng: FTS5, trigger, seed tag...).
+# - DB đã có dữ liệu: chỉ chạy các migration chưa áp dụng.
+# Mỗi migration có số version tăng dần, chạy đúng 1 lần và được ghi lại
+# trong bảng schema_version. Migration phải idempotent (kiểm tra trước khi
+# ALTER/CREATE) vì DB tạo từ baseline đã có sẵn bảng/cột/index theo model.
+# Bảng mới thì migration tự tạo bằng _create_table, index mới bằng _create_index.
+
+Migration = Tuple[int, str, Callable]
+MIGRATIONS: List[Migration] = []
+BACKFILLS: List[Tuple[str, Callable]] = []
+BACKFILL_BATCH_SIZE = 2000
+MIGRATION_LOCK_KEY = 0x46555331   # pg_advisory_lock key ("FUS1") giữ trong lúc migrate
+
+
+def migration(version: int, description: str):
+    """Decorator đăng ký 1 migration: fn(conn) chạy trong transaction riêng."""
+    def decorator(fn):
+        MIGRATIONS.append((version, description, fn))
+        return fn
+    return decorator
+
+
+def backfill(name: str):
+    """
+    Decorator đăng ký 1 backfill online: fn(engine) tự chia batch, mỗi batch 1 transaction ngắn
+    (không khóa bảng lâu), chạy lại được nhiều lần - xong rồi thì chỉ tốn 1 query kiểm tra.
+    Chạy sau các migration mỗi lần khởi động. Trả về số dòng đã cập nhật.
+    """
+    def decorator(fn):
+        BACKFILLS.append((name, fn))
+        return fn
+    return decorator
+
+
+def _columns(conn, table: str) -> set:
+    return {c['name'] for c in inspect(conn).get_columns(table)}
+
+
+def _add_column(conn, table: str, column: str, ddl: str) -> None:
+    if column not in _columns(conn, table):
+        conn.execute(text(f'ALTER TABLE "{table}" ADD COLUMN {column} {ddl}'))
+
+
+def _create_table(conn, table) -> None:
+    """Tạo bảng (kèm index khai báo trong model) nếu chưa có."""
+    table.create(conn, checkfirst=True)
+
+
+def _create_index(conn, table, name: str, columns: Tuple[str, ...] = ()) -> None:
+    """
+    Tạo index đã khai báo trong __table_args__ của model nếu DB chưa có.
+    columns: dùng cho index cũ đã bị bỏ khỏi model (migration sau sẽ drop).
+    """
+    if name in {ix['name'] for ix in inspect(conn).get_indexes(table.name)}:
+        return
+    index = next((ix for ix in table.indexes if ix.name == name), None)
+    if index is None:
+        index = db.Index(name, *(table.c[c] for c in columns))
+    index.create(conn)
+
+
+def _ensure_version_table(conn) -> None:
+    conn.execute(text(
+        'CREATE TABLE IF NOT EXISTS schema_version ('
+        'version INTEGER PRIMARY KEY, description VARCHAR(200), applied_at TIMESTAMP)'
+    ))
+
+
+def current_version(conn) -> int:
+    _ensure_version_table(conn)
+    return conn.execute(text('SELECT COALESCE(MAX(version), 0) FROM schema_version')).scalar()
+
+
+def _bootstrap_empty(conn) -> bool:
+    """DB chưa có bảng nào của app -> tạo schema baseline theo model hiện tại."""
+    existing = set(inspect(conn).get_table_names()) - {'schema_version'}
+    if existing:
+        return False
+    db.metadata.create_all(conn)
+    return True
+
+
+@contextmanager
+def _migration_lock(engine):
+    """
+    PostgreSQL: advisory lock trên 1 connection riêng, 2 process cùng chạy migrate thì process sau
+    đợi rồi thấy version đã mới (không chạy DDL / INSERT schema_version 2 lần). Dialect khác: no-op.
+    """
+    if engine.dialect.name != 'postgresql':
+        yield
+        return
+    with engine.connect() as conn:
+        conn.execute(text('SELECT pg_advisory_lock(:key)'), {'key': MIGRATION_LOCK_KEY})
+        try:
+            yield
+        finally:
+            conn.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': MIGRATION_LOCK_KEY})
+            conn.commit()
+
+
+def run_migrations(engine=None) -> List[int]:
+    """Chạy các migration chưa áp dụng theo thứ tự version. Trả về list version vừa chạy."""
+    engine = engine or db.engine
+    with _migration_lock(engine):
+        return _run_migrations(engine)
+
+
+def _run_migrations(engine) -> List[int]:
+    applied = []
+    with engine.begin() as conn:
+        if _bootstrap_empty(conn):
+            print("[migrations] Empty database, created baseline schema")
+        version = current_version(conn)
+
+    for number, description, fn in sorted(MIGRATIONS, key=lambda m: m[0]):
+        if number <= version:
+            continue
+        with engine.begin() as conn:
+            fn(conn)
+            conn.execute(text('INSERT INTO schema_version (version, description, applied_at) '
+                              'VALUES (:v, :d, :t)'),
+                         {'v': number, 'd': description, 't': datetime.utcnow()})
+        applied.append(number)
+        print(f"[migrations] Applied {number}: {description}")
+
+    for name, fn in BACKFILLS:
+        updated = fn(engine)
+        if updated:
+            print(f"[migrations] Backfilled {updated} rows: {name}")
+    return applied
+
+
+# ============================================================================
+# MIGRATIONS
+# ============================================================================
+@migration(1, 'post.like_count / post.comment_count denormalized counters')
+def _post_counters(conn):
+    _add_column(conn, 'post', 'like_count', 'INTEGER NOT NULL DEFAULT 0')
+    _add_column(conn, 'post', 'comment_count', 'INTEGER NOT NULL DEFAULT 0')
+    conn.execute(text('UPDATE post SET shares_count = 0 WHERE shares_count IS NULL'))
+    conn.execute(text(
+        'UPDATE post SET '
+        'like_count = (SELECT COUNT(*) FROM post_likes WHERE post_likes.post_id = post.id), '
+        'comment_count = (SELECT COUNT(*) FROM comment WHERE comment.post_id = post.id)'
+    ))
+
+
+@migration(2, 'user search index (FTS5 on SQLite, pg_trgm on PostgreSQL)')
+def _user_search_index(conn):
+    dialect = conn.dialect.name
+    if dialect == 'sqlite':
+        try:
+            conn.execute(text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS user_fts USING fts5("
+                "username, email, content='user', content_rowid='id', "
+                "tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+            ))
+        except Exception as e:
+            # SQLite build không có FTS5 -> user_search tự dùng prefix LIKE
+            print(f"[migrations] FTS5 unavailable, user search falls back to LIKE: {e}")
+            return
+        conn.execute(text(
+            'CREATE TRIGGER IF NOT EXISTS user_fts_ai AFTER INSERT ON "user" BEGIN '
+            'INSERT INTO user_fts(rowid, username, email) VALUES (new.id, new.username, new.email); END'
+        ))
+        conn.execute(text(
+            'CREATE TRIGGER IF NOT EXISTS user_fts_ad AFTER DELETE ON "user" BEGIN '
+            "INSERT INTO user_fts(user_fts, rowid, username, email) "
+            "VALUES ('delete', old.id, old.username, old.email); END"
+        ))
+        conn.execute(text(
+            'CREATE TRIGGER IF NOT EXISTS user_fts_au AFTER UPDATE OF username, email ON "user" BEGIN '
+            "INSERT INTO user_fts(user_fts, rowid, username, email) "
+            "VALUES ('delete', old.id, old.username, old.email); "
+            'INSERT INTO user_fts(rowid, username, email) VALUES (new.id, new.username, new.email); END'
+        ))
+        conn.execute(text("INSERT INTO user_fts(user_fts) VALUES ('rebuild')"))
+    elif dialect == 'postgresql':
+        # Role không có quyền CREATE EXTENSION (DB managed) -> rollback về savepoint,
+        # migration vẫn xong và user_search tự dùng prefix LIKE (không thấy pg_trgm trong pg_extension)
+        savepoint = conn.begin_nested()
+        try:
+            conn.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+        except Exception as e:
+            savepoint.rollback()
+            print(f"[migrations] pg_trgm unavailable, user search falls back to LIKE: {e}")
+            return
+        savepoint.commit()
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_user_username_trgm '
+                          'ON "user" USING gin (username gin_trgm_ops)'))
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_user_email_trgm '
+                          'ON "user" USING gin (email gin_trgm_ops)'))
+
+
+@migration(3, 'tag dictionary: tag / post_tags / room_tags, user_tag_score.tag_id')
+def _tag_dictionary(conn):
+    from app.tags import CANONICAL_TAGS, normalize_tag, normalize_tags, tag_key
+    from app.utils import MAX_INTEREST_SCORE
+    from app.models import Tag, post_tags, room_tags
+
+    for table in (Tag.__table__, post_tags, room_tags):
+        _create_table(conn, table)
+    _add_column(conn, 'user_tag_score', 'tag_id', 'INTEGER REFERENCES tag (id)')
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_user_tag_score_tag_id ON user_tag_score (tag_id)'))
+
+    tag_ids = {key: tid for tid, key in conn.execute(text('SELECT id, key FROM tag'))}
+
+    def ensure(name):
+        key = tag_key(name)
+        if key not in tag_ids:
+            conn.execute(text('INSERT INTO tag (name, key) VALUES (:n, :k)'), {'n': name, 'k': key})
+            tag_ids[key] = conn.execute(text('SELECT id FROM tag WHERE key = :k'), {'k': key}).scalar()
+        return tag_ids[key]
+
+    # 1. Tag chuẩn được tạo trước -> id nhỏ, ổn định
+    for name in CANONICAL_TAGS:
+        ensure(name)
+
+    # 2. Post / Room: chuẩn hóa chuỗi CSV + điền bảng phụ
+    for table, assoc, fk in (('post', 'post_tags', 'post_id'), ('room', 'room_tags', 'room_id')):
+        linked = set(conn.execute(text(f'SELECT {fk}, tag_id FROM {assoc}')))
+        links = []
+        for item_id, raw in conn.execute(text(f'SELECT id, tags FROM {table}')).all():
+            names = normalize_tags(raw)
+            if ','.join(names) != (raw or ''):
+                conn.execute(text(f'UPDATE {table} SET tags = :t WHERE id = :i'),
+                             {'t': ','.join(names), 'i': item_id})
+            for name in names:
+                pair = (item_id, ensure(name))
+                if pair not in linked:
+                    linked.add(pair)
+                    links.append({'i': pair[0], 't': pair[1]})
+        if links:
+            conn.execute(text(f'INSERT INTO {assoc} ({fk}, tag_id) VALUES (:i, :t)'), links)
+
+    # 3. User.interests: chỉ chuẩn hóa chuỗi hiển thị
+    for user_id, raw in conn.execute(text('SELECT id, interests FROM "user"')).all():
+        normalized = ','.join(normalize_tags(raw))
+        if raw and normalized != raw:
+            conn.execute(text('UPDATE "user" SET interests = :t WHERE id = :i'), {'t': normalized, 'i': user_id})
+
+    # 4. user_tag_score: gộp các dòng trùng sau chuẩn hóa ('travel' + 'Travel'), gán tag_id
+    groups = {}
+    for row in conn.execute(text('SELECT id, user_id, tag, score, last_interaction '
+                                 'FROM user_tag_score ORDER BY id')).all():
+        name = normalize_tag(row.tag)
+        if name is None:
+            conn.execute(text('DELETE FROM user_tag_score WHERE id = :i'), {'i': row.id})
+            continue
+        groups.setdefault((row.user_id, tag_key(name)), (name, []))[1].append(row)
+
+    for (_, key), (name, rows) in groups.items():
+        keep, extra = rows[0], rows[1:]
+        score = min(sum(r.score or 0.0 for r in rows), MAX_INTEREST_SCORE)
+        last = max((r.last_interaction for r in rows if r.last_interaction is not None), default=None)
+        conn.execute(text('UPDATE user_tag_score SET tag = :n, tag_id = :t, score = :s, '
+                          'last_interaction = :l WHERE id = :i'),
+                     {'n': name, 't': ensure(name), 's': score, 'l': last, 'i': keep.id})
+        for r in extra:
+            conn.execute(text('DELETE FROM user_tag_score WHERE id = :i'), {'i': r.id})
+
+
+@migration(4, 'composite indexes for hot queries + unique (user_id, tag_id) on user_tag_score')
+def _hot_query_indexes(conn):
+    from app.utils import MAX_INTEREST_SCORE
+    from app.models import Activity, FriendRequest, Message, RoomRequest, Transaction, UserTagScore
+
+    # Gộp dòng trùng (user_id, tag_id) trước khi tạo unique index
+    dupes = conn.execute(text(
+        'SELECT user_id, tag_id, MIN(id), SUM(score), MAX(last_interaction) FROM user_tag_score '
+        'WHERE tag_id IS NOT NULL GROUP BY user_id, tag_id HAVING COUNT(*) > 1'
+    )).all()
+    for user_id, tag_id, keep_id, total, last in dupes:
+        conn.execute(text('UPDATE user_tag_score SET score = :s, last_interaction = :l WHERE id = :i'),
+                     {'s': min(total or 0.0, MAX_INTEREST_SCORE), 'l': last, 'i': keep_id})
+        conn.execute(text('DELETE FROM user_tag_score WHERE user_id = :u AND tag_id = :t AND id <> :i'),
+                     {'u': user_id, 't': tag_id, 'i': keep_id})
+
+    # Index của message được thay bằng ix_message_room_history ở migration 6
+    _create_index(conn, Message.__table__, 'ix_message_room_timestamp', ('room', 'timestamp'))
+    for model, name in (
+        (Transaction, 'ix_transaction_room_status'),
+        (Transaction, 'ix_transaction_room_sender'),
+        (Transaction, 'ix_transaction_room_receiver'),
+        (RoomRequest, 'ix_room_request_user_status'),
+        (RoomRequest, 'ix_room_request_room_status'),
+        (FriendRequest, 'ix_friend_request_receiver_status'),
+        (Activity, 'ix_activity_room_start'),
+        (UserTagScore, 'uq_user_tag_score_user_tag'),
+    ):
+        _create_index(conn, model.__table__, name)
+
+
+@migration(5, 'message(room, id) index for keyset chat history')
+def _message_history_index(conn):
+    from app.models import Message
+    _create_index(conn, Message.__table__, 'ix_message_room_id', ('room', 'id'))
+
+
+@migration(6, 'message.room_id integer FK (replaces room-name lookups)')
+def _message_room_id(conn):
+    from app.models import Message
+    _add_column(conn, 'message', 'room_id', 'INTEGER REFERENCES room (id)')
+    conn.execute(text('DROP INDEX IF EXISTS ix_message_room_timestamp'))
+    conn.execute(text('DROP INDEX IF EXISTS ix_message_room_id'))
+    _create_index(conn, Message.__table__, 'ix_message_room_history')
+
+
+@backfill('message.room_id from message.room (room name)')
+def _backfill_message_room_id(engine):
+    """Điền room_id cho tin nhắn cũ theo batch id tăng dần; tên phòng không còn tồn tại thì bỏ qua."""
+    updated, last_id = 0, 0
+    while True:
+        with engine.begin() as conn:
+            ids = [r[0] for r in conn.execute(text(
+                'SELECT id FROM message WHERE room_id IS NULL AND id > :last ORDER BY id LIMIT :n'
+            ), {'last': last_id, 'n': BACKFILL_BATCH_SIZE})]
+            if not ids:
+                return updated
+            updated += conn.execute(text(
+                'UPDATE message SET room_id = (SELECT room.id FROM room WHERE room.name = message.room) '
+                'WHERE id >= :lo AND id <= :hi AND room_id IS NULL '
+                'AND EXISTS (SELECT 1 FROM room WHERE room.name = message.room)'
+            ), {'lo': ids[0], 'hi': ids[-1]}).rowcount
+            last_id = ids[-1]
+
+
+@migration(7, 'id_sequence table (message ids assigned before the batched insert)')
+def _id_sequence(conn):
+    from app.models import IdSequence
+    _create_table(conn, IdSequence.__table__)
+    conn.execute(text(
+        "INSERT INTO id_sequence (name, next_id) "
+        "SELECT 'message', COALESCE(MAX(id), 0) + 1 FROM message "
+        "WHERE NOT EXISTS (SELECT 1 FROM id_sequence WHERE name = 'message')"
+    ))
+
+
+@migration(8, 'room_members(room_id, user_id) index for the membership cache')
+def _room_members_index(conn):
+    from app.models import room_members
+    _create_index(conn, room_members, 'ix_room_members_room_user')
+
+
+@migration(9, 'read_cursor table (per-member last read message, unread counts)')
+def _read_cursor(conn):
+    from app.models import ReadCursor
+    _create_table(conn, ReadCursor.__table__)
+
+
+@migration(10, 'seed read_cursor at the latest message for existing room members')
+def _seed_read_cursors(conn):
+    # Không có cursor = chưa đọc gì -> toàn bộ lịch sử cũ hiện thành "chưa đọc" sau khi nâng cấp.
+    # Coi mọi tin đã có là đã đọc; chỉ thêm cặp chưa có cursor (DB đã chạy migration 9 vẫn an toàn).
+    # Tin cũ có thể chưa được backfill room_id (backfill chạy sau migration) -> khớp thêm theo tên phòng
+    conn.execute(text(
+        'INSERT INTO read_cursor (user_id, room_id, last_read_message_id, updated_at) '
+        'SELECT rm.user_id, rm.room_id, MAX(m.id), :now FROM room_members rm '
+        'JOIN room r ON r.id = rm.room_id '
+        'JOIN message m ON m.room_id = r.id OR (m.room_id IS NULL AND m.room = r.name) '
+        'WHERE NOT EXISTS (SELECT 1 FROM read_cursor rc '
+        'WHERE rc.user_id = rm.user_id AND rc.room_id = rm.room_id) '
+        'GROUP BY rm.user_id, rm.room_id'
+    ), {'now': datetime.utcnow()})
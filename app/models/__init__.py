@@ -1,6 +1,7 @@
 # Import tất cả các model vào đây để expose ra ngoài
+from .tag import Tag, post_tags, room_tags
 from .user import User, UserTagScore, FriendRequest, friendship
-from .chat import Room, Message, RoomRequest, room_members
+from .chat import Room, Message, RoomRequest, IdSequence, ReadCursor, room_members
 from .post import Post, Comment, post_likes
 from .location import Location, Review, user_favorites
 from .finance import Outsider, Transaction
@@ -1,10 +1,16 @@
+import json
 from datetime import datetime
+from sqlalchemy import and_, case, func, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 from app.extensions import db
+from .tag import Tag, room_tags
 
 # Bảng phụ (Association Table) cho quan hệ Many-to-Many giữa User và Room
 room_members = db.Table('room_members',
     db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
-    db.Column('room_id', db.Integer, db.ForeignKey('room.id'), primary_key=True)
+    db.Column('room_id', db.Integer, db.ForeignKey('room.id'), primary_key=True),
+    db.Index('ix_room_members_room_user', 'room_id', 'user_id')  # PK (user_id, room_id) không phục vụ "thành viên của phòng"
 )
 
 class Room(db.Model):
@@ -13,7 +19,7 @@ class Room(db.Model):
     description = db.Column(db.String(200), nullable=True)
     is_private = db.Column(db.Boolean, default=False)
     allow_auto_join = db.Column(db.Boolean, default=False) # True: Vào luôn, False: Cần duyệt
-    tags = db.Column(db.String(200), default='') 
+    tags = db.Column(db.String(200), default='')  # CSV tên tag chuẩn, chỉ để hiển thị (nguồn chính: room_tags)
     summary = db.Column(db.Text, nullable=True)
 
     # ForeignKey trỏ đến bảng 'user'
@@ -24,24 +30,206 @@ class Room(db.Model):
     
     members = db.relationship('User', secondary=room_members,
                               back_populates='rooms', lazy='dynamic')
+    tag_items = db.relationship('Tag', secondary=room_tags, lazy='select')
+
+    def set_tags(self, names):
+        """Gán tag qua normalizer chung: cập nhật room_tags + chuỗi tags hiển thị."""
+        self.tag_items = Tag.resolve(names, create=True)
+        self.tags = ','.join(t.name for t in self.tag_items)
+
+    @property
+    def tag_ids(self):
+        return [t.id for t in self.tag_items]
+
+    @staticmethod
+    def tag_ids_for(room_ids):
+        """{room_id: [tag_id, ...]} cho nhiều phòng trong 1 query"""
+        return Tag.ids_by_item(room_tags.c.room_id, room_ids)
+
+    def _summaries(self):
+        """Room.summary lưu JSON {mode: {'full': ..., 'last_message_id': ...}}"""
+        try:
+            data = json.loads(self.summary or '{}')
+        except ValueError:
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def get_summary(self, mode):
+        """(bản tóm tắt, id tin cuối cùng nó bao trùm) của mode; (None, 0) nếu chưa có."""
+        entry = self._summaries().get(mode)
+        if not isinstance(entry, dict) or not entry.get('full'):
+            return None, 0
+        return entry['full'], entry.get('last_message_id', 0)
+
+    def set_summary(self, mode, full, last_message_id):
+        data = self._summaries()
+        data[mode] = {'full': full, 'last_message_id': last_message_id}
+        self.summary = json.dumps(data, ensure_ascii=False)
 
     def __repr__(self):
         return f"Room('{self.name}', Private={self.is_private})"
 
 class Message(db.Model):
+    __table_args__ = (
+        db.Index('ix_message_room_history', 'room_id', 'id'),  # Lịch sử chat: keyset theo id trong từng phòng
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
-    room = db.Column(db.String(50), nullable=False) 
+    room_id = db.Column(db.Integer, db.ForeignKey('room.id'))  # NULL chỉ với dòng cũ chưa backfill
+    # [LEGACY] Cột 'room' cũ lưu tên phòng (NOT NULL ở DB cũ) -> vẫn ghi kèm, không dùng để đọc
+    room_name = db.Column('room', db.String(50))
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
 
+    room = db.relationship('Room', backref=db.backref('messages', lazy='dynamic'))
+
     # Lưu ý: Relationship 'author' nên được định nghĩa ở User model (dùng backref) 
     # để tránh phải sửa file này.
+
+    @staticmethod
+    def history(room_id, before_id=None, limit=50):
+        """
+        N tin nhắn mới nhất của phòng (cũ hơn before_id nếu có), author được eager-load.
+        Trả về (messages theo thứ tự cũ -> mới, has_more).
+        """
+        q = Message.query.options(joinedload(Message.author)).filter(Message.room_id == room_id)
+        if before_id is not None:
+            q = q.filter(Message.id < before_id)
+        rows = q.order_by(Message.id.desc()).limit(limit + 1).all()
+        has_more = len(rows) > limit
+        return list(reversed(rows[:limit])), has_more
+
+    @staticmethod
+    def since(room_id, after_id, limit=200):
+        """
+        Tin nhắn của phòng có id > after_id (client reconnect bị lỡ), cũ -> mới, author eager-load.
+        Trả về tối đa limit + 1 dòng để caller biết có vượt ngưỡng hay không.
+        """
+        return Message.query.options(joinedload(Message.author))\
+            .filter(Message.room_id == room_id, Message.id > after_id)\
+            .order_by(Message.id).limit(limit + 1).all()
+
+    @staticmethod
+    def window(room_id, since=None, limit=1000, after_id=None):
+        """
+        Tối đa limit tin mới nhất của phòng (từ thời điểm since / sau tin after_id nếu có),
+        cũ -> mới, author eager-load.
+        """
+        q = Message.query.options(joinedload(Message.author)).filter(Message.room_id == room_id)
+        if since is not None:
+            q = q.filter(Message.timestamp >= since)
+        if after_id is not None:
+            q = q.filter(Message.id > after_id)
+        return list(reversed(q.order_by(Message.id.desc()).limit(limit).all()))
+
+    @staticmethod
+    def latest_id(room_id):
+        """Id tin mới nhất của phòng (0 nếu chưa có), chỉ đọc index (room_id, id)"""
+        return db.session.query(func.max(Message.id)).filter(Message.room_id == room_id).scalar() or 0
+
+    @staticmethod
+    def payload(message_id, body, username, timestamp):
+        """Dict gửi qua socket / API (dùng chung cho tin đã lưu và tin còn trong hàng đợi ghi)"""
+        return {
+            'id': message_id,
+            'msg': body,
+            'username': username,
+            'timestamp': timestamp.strftime('%Y-%m-%d %H:%M')
+        }
+
+    def to_dict(self):
+        return Message.payload(self.id, self.body, self.author.username, self.timestamp)
     
     def __repr__(self):
         return f"Message('{self.body}', User ID: {self.user_id})"
 
+class IdSequence(db.Model):
+    """
+    Cấp id theo block cho các bảng ghi qua hàng đợi (vd: message), để server biết id
+    trước khi INSERT. Mỗi lần xin 1 block chỉ tốn 1 transaction ngắn.
+    """
+    __tablename__ = 'id_sequence'
+
+    name = db.Column(db.String(50), primary_key=True)
+    next_id = db.Column(db.Integer, nullable=False)
+
+    @staticmethod
+    def reserve(table, count, _retry=True):
+        """
+        Xin `count` id liên tiếp cho bảng `table` (tên sequence = tên bảng), trả về id đầu tiên.
+        Dùng connection riêng + commit ngay, không đụng tới transaction của db.session.
+        Lần đầu (chưa có dòng) thì khởi tạo từ MAX(id) + 1 của bảng; nếu có dòng được INSERT
+        thẳng (không qua sequence) thì tự nhảy qua MAX(id) để không cấp trùng (MAX trên PK: O(1)).
+        """
+        try:
+            with db.engine.begin() as conn:
+                updated = conn.execute(text(
+                    f'UPDATE id_sequence SET next_id = :n + CASE '
+                    f'WHEN next_id > (SELECT COALESCE(MAX(id), 0) FROM "{table}") THEN next_id '
+                    f'ELSE (SELECT COALESCE(MAX(id), 0) + 1 FROM "{table}") END '
+                    f'WHERE name = :name'
+                ), {'n': count, 'name': table}).rowcount
+                if updated:
+                    return conn.execute(text('SELECT next_id FROM id_sequence WHERE name = :name'),
+                                        {'name': table}).scalar() - count
+                start = conn.execute(text(f'SELECT COALESCE(MAX(id), 0) + 1 FROM "{table}"')).scalar()
+                conn.execute(text('INSERT INTO id_sequence (name, next_id) VALUES (:name, :next)'),
+                             {'name': table, 'next': start + count})
+                return start
+        except IntegrityError:
+            if not _retry:
+                raise
+        # Worker khác vừa khởi tạo cùng lúc -> xin lại theo đường UPDATE
+        return IdSequence.reserve(table, count, _retry=False)
+
+class ReadCursor(db.Model):
+    """
+    Vị trí đã đọc của từng thành viên trong phòng: tin có id > last_read_message_id là chưa đọc.
+    Không ghi trực tiếp từ socket handler mà qua read_cursors (app/read_cursors.py) theo batch.
+    """
+    __tablename__ = 'read_cursor'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    room_id = db.Column(db.Integer, db.ForeignKey('room.id'), primary_key=True)
+    last_read_message_id = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    @staticmethod
+    def unread_counts(pairs, floors=None):
+        """
+        {(user_id, room_id): số tin chưa đọc} cho nhiều cặp trong 1 query GROUP BY.
+        Chỉ tính phòng user còn là thành viên, bỏ qua tin của chính user; chưa có cursor -> đếm từ đầu.
+        floors: {(user_id, room_id): id đã đọc chưa ghi xuống DB} -> lấy id lớn hơn giữa DB và floors.
+        """
+        counts = dict.fromkeys(pairs, 0)
+        if not counts:
+            return counts
+        last_read = func.coalesce(ReadCursor.last_read_message_id, 0)
+        if floors:
+            floor = case(*[(and_(room_members.c.user_id == uid, room_members.c.room_id == rid), message_id)
+                           for (uid, rid), message_id in floors.items()], else_=0)
+            last_read = case((last_read > floor, last_read), else_=floor)
+        rows = db.session.query(room_members.c.user_id, room_members.c.room_id, func.count(Message.id))\
+            .join(Message, Message.room_id == room_members.c.room_id)\
+            .outerjoin(ReadCursor, and_(ReadCursor.user_id == room_members.c.user_id,
+                                        ReadCursor.room_id == room_members.c.room_id))\
+            .filter(room_members.c.user_id.in_({uid for uid, _ in counts}),
+                    room_members.c.room_id.in_({rid for _, rid in counts}),
+                    Message.id > last_read,
+                    Message.user_id != room_members.c.user_id)\
+            .group_by(room_members.c.user_id, room_members.c.room_id).all()
+        for user_id, room_id, n in rows:
+            if (user_id, room_id) in counts:
+                counts[(user_id, room_id)] = n
+        return counts
+
 class RoomRequest(db.Model):
+    __table_args__ = (
+        db.Index('ix_room_request_user_status', 'user_id', 'status'),
+        db.Index('ix_room_request_room_status', 'room_id', 'status'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     room_id = db.Column(db.Integer, db.ForeignKey('room.id'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -11,6 +11,12 @@ class Outsider(db.Model):
         return f"<Outsider {self.name}>"
 
 class Transaction(db.Model):
+    __table_args__ = (
+        db.Index('ix_transaction_room_status', 'room_id', 'status'),
+        db.Index('ix_transaction_room_sender', 'room_id', 'sender_id'),
+        db.Index('ix_transaction_room_receiver', 'room_id', 'receiver_id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     amount = db.Column(db.Float, nullable=False)
     description = db.Column(db.String(200))
@@ -1,6 +1,10 @@
 from app.extensions import db
 
 class Activity(db.Model):
+    __table_args__ = (
+        db.Index('ix_activity_room_start', 'room_id', 'start_time'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     location = db.Column(db.String(100))
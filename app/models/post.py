@@ -1,5 +1,7 @@
 from datetime import datetime
+from sqlalchemy.orm import joinedload
 from app.extensions import db
+from .tag import Tag, post_tags
 
 post_likes = db.Table('post_likes',
     db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
@@ -14,6 +16,34 @@ class Comment(db.Model):
     post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
     author = db.relationship('User', backref='comments')
 
+    @staticmethod
+    def latest_for_posts(post_ids, per_post=3):
+        """
+        Lấy per_post comment mới nhất của mỗi post (1 query, ROW_NUMBER theo post_id),
+        author được eager-load. Trả về {post_id: [comment cũ -> mới]}.
+        """
+        if not post_ids:
+            return {}
+        rn = db.func.row_number().over(partition_by=Comment.post_id, order_by=Comment.id.desc()).label('rn')
+        latest = db.session.query(Comment.id.label('id'), rn).filter(Comment.post_id.in_(post_ids)).subquery()
+        comments = Comment.query.options(joinedload(Comment.author))\
+            .join(latest, Comment.id == latest.c.id)\
+            .filter(latest.c.rn <= per_post)\
+            .order_by(Comment.post_id, Comment.id).all()
+
+        grouped = {}
+        for c in comments:
+            grouped.setdefault(c.post_id, []).append(c)
+        return grouped
+
+    @staticmethod
+    def page_for_post(post_id, before_id=None, limit=10):
+        """Comment cũ hơn before_id (keyset theo id, mới nhất trước), author được eager-load."""
+        q = Comment.query.options(joinedload(Comment.author)).filter(Comment.post_id == post_id)
+        if before_id is not None:
+            q = q.filter(Comment.id < before_id)
+        return q.order_by(Comment.id.desc()).limit(limit).all()
+
 class Post(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     media_filename = db.Column(db.String(100), nullable=True)
@@ -22,15 +52,77 @@ class Post(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     latitude = db.Column(db.Float, nullable=True)
     longitude = db.Column(db.Float, nullable=True)
-    tags = db.Column(db.String(200), default='')
+    tags = db.Column(db.String(200), default='')  # CSV tên tag chuẩn, chỉ để hiển thị (nguồn chính: post_tags)
     shares_count = db.Column(db.Integer, default=0)
+    # Bộ đếm denormalized, chỉ cập nhật bằng SQL atomic (xem bump_counter)
+    like_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     # Relationships
     likes = db.relationship('User', secondary=post_likes, backref=db.backref('liked_posts', lazy='dynamic'))
     comments = db.relationship('Comment', backref='post', lazy='dynamic', cascade="all, delete-orphan")
+    tag_items = db.relationship('Tag', secondary=post_tags, lazy='select')
+
+    def set_tags(self, names):
+        """Gán tag qua normalizer chung: cập nhật post_tags + chuỗi tags hiển thị."""
+        self.tag_items = Tag.resolve(names, create=True)
+        self.tags = ','.join(t.name for t in self.tag_items)
+
+    @property
+    def tag_ids(self):
+        return [t.id for t in self.tag_items]
+
+    @staticmethod
+    def tag_ids_for(post_ids):
+        """{post_id: [tag_id, ...]} cho cả cửa sổ feed trong 1 query"""
+        return Tag.ids_by_item(post_tags.c.post_id, post_ids)
+
+    @staticmethod
+    def tagged(tag_name):
+        """Query các post có tag (vd: 'coffee', '#Coffee'), join qua index (tag_id, post_id)"""
+        tags = Tag.resolve([tag_name])
+        if not tags:
+            return Post.query.filter(db.false())
+        return Post.query.join(post_tags, post_tags.c.post_id == Post.id)\
+            .filter(post_tags.c.tag_id == tags[0].id)
     
     def is_liked_by(self, user):
-        return user in self.likes
+        # EXISTS trên post_likes thay vì load toàn bộ danh sách người like
+        return db.session.query(
+            db.exists().where(post_likes.c.post_id == self.id, post_likes.c.user_id == user.id)
+        ).scalar()
+
+    @staticmethod
+    def liked_post_ids(user_id, post_ids):
+        """Trả về set các post_id (trong post_ids) mà user đã like - 1 query cho cả trang"""
+        if not post_ids:
+            return set()
+        rows = db.session.query(post_likes.c.post_id).filter(
+            post_likes.c.user_id == user_id, post_likes.c.post_id.in_(post_ids)
+        ).all()
+        return {r.post_id for r in rows}
+
+    @staticmethod
+    def bump_counter(post_id, column, delta):
+        """UPDATE post SET <column> = <column> + delta (atomic, không read-modify-write)"""
+        col = getattr(Post, column)
+        Post.query.filter(Post.id == post_id).update({col: col + delta}, synchronize_session=False)
+
+    @staticmethod
+    def toggle_like(post_id, user_id):
+        """
+        Like/Unlike bằng SQL trực tiếp trên post_likes + cập nhật like_count cùng transaction.
+        Trả về 'liked' hoặc 'unliked' (caller tự commit).
+        """
+        deleted = db.session.execute(
+            post_likes.delete().where(post_likes.c.post_id == post_id, post_likes.c.user_id == user_id)
+        ).rowcount
+        if deleted:
+            Post.bump_counter(post_id, 'like_count', -1)
+            return 'unliked'
+        db.session.execute(post_likes.insert().values(post_id=post_id, user_id=user_id))
+        Post.bump_counter(post_id, 'like_count', 1)
+        return 'liked'
 
     def __repr__(self):
         return f"Post('{self.body}')"
\ No newline at end of file
@@ -0,0 +1,64 @@
+from sqlalchemy.exc import IntegrityError
+from app.extensions import db
+from app.tags import normalize_tags, tag_key
+
+# Bảng phụ Post <-> Tag và Room <-> Tag.
+# PK (item_id, tag_id) phục vụ "tag của post X", index (tag_id, item_id) phục vụ "post có tag Y".
+post_tags = db.Table('post_tags',
+    db.Column('post_id', db.Integer, db.ForeignKey('post.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'), primary_key=True),
+    db.Index('ix_post_tags_tag_post', 'tag_id', 'post_id')
+)
+
+room_tags = db.Table('room_tags',
+    db.Column('room_id', db.Integer, db.ForeignKey('room.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'), primary_key=True),
+    db.Index('ix_room_tags_tag_room', 'tag_id', 'room_id')
+)
+
+class Tag(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(50), unique=True, nullable=False)   # Tên hiển thị chuẩn: 'Travel'
+    key = db.Column(db.String(50), unique=True, nullable=False)    # Khóa so khớp: 'travel'
+
+    @staticmethod
+    def resolve(names, create=False):
+        """
+        Tên tag (CSV hoặc list, chưa chuẩn hóa) -> list Tag theo đúng thứ tự, bỏ trùng.
+        create=True: tạo tag mới trong savepoint (tránh đụng unique khi 2 request tạo cùng lúc).
+        """
+        normalized = normalize_tags(names)
+        if not normalized:
+            return []
+        keys = [tag_key(n) for n in normalized]
+        found = {t.key: t for t in Tag.query.filter(Tag.key.in_(keys)).all()}
+
+        if create:
+            for name, key in zip(normalized, keys):
+                if key in found:
+                    continue
+                try:
+                    with db.session.begin_nested():
+                        tag = Tag(name=name, key=key)
+                        db.session.add(tag)
+                    found[key] = tag
+                except IntegrityError:
+                    found[key] = Tag.query.filter_by(key=key).one()
+        return [found[k] for k in keys if k in found]
+
+    @staticmethod
+    def ids_by_item(item_column, item_ids):
+        """
+        item_column: post_tags.c.post_id hoặc room_tags.c.room_id.
+        Trả về {item_id: [tag_id, ...]} cho nhiều post/room trong 1 query (dùng PK của bảng phụ).
+        """
+        result = {item_id: [] for item_id in item_ids}
+        if item_ids:
+            rows = db.session.query(item_column, item_column.table.c.tag_id)\
+                .filter(item_column.in_(item_ids)).all()
+            for item_id, tag_id in rows:
+                result[item_id].append(tag_id)
+        return result
+
+    def __repr__(self):
+        return f"Tag({self.id}, '{self.name}')"
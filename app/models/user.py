@@ -9,9 +9,15 @@ friendship = db.Table('friendship',
 )
 
 class UserTagScore(db.Model):
+    __table_args__ = (
+        # Mỗi (user, tag) chỉ 1 dòng -> buffer ghi bằng upsert ON CONFLICT
+        db.Index('uq_user_tag_score_user_tag', 'user_id', 'tag_id', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    tag = db.Column(db.String(50), nullable=False, index=True)
+    tag = db.Column(db.String(50), nullable=False, index=True)  # Tên tag chuẩn (hiển thị)
+    tag_id = db.Column(db.Integer, db.ForeignKey('tag.id'), index=True)
     score = db.Column(db.Float, default=1.0)
     last_interaction = db.Column(db.DateTime, default=datetime.utcnow)
     user = db.relationship('User', backref=db.backref('tag_scores', lazy='dynamic'))
@@ -20,6 +26,10 @@ class UserTagScore(db.Model):
         return f"<UserTagScore {self.user.username} - {self.tag}: {self.score}>"
 
 class FriendRequest(db.Model):
+    __table_args__ = (
+        db.Index('ix_friend_request_receiver_status', 'receiver_id', 'status'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     sender_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     receiver_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -66,21 +76,40 @@ class User(UserMixin, db.Model):
             req = FriendRequest(sender_id=self.id, receiver_id=user.id)
             db.session.add(req)
             db.session.commit()
+            from app.suggestion_engine import on_request_changed
+            on_request_changed(self.id, user.id)
 
     def accept_request(self, request_id):
         req = FriendRequest.query.get(request_id)
         if req and req.receiver_id == self.id:
+            sender_id = req.sender_id
             req.status = 'accepted'
             self.friends.append(req.sender)
             req.sender.friends.append(self)
             db.session.delete(req) 
             db.session.commit()
+            # Cập nhật gợi ý kết bạn (friends-of-friends) cho những người bị ảnh hưởng
+            from app.suggestion_engine import on_friendship_changed
+            on_friendship_changed(self.id, sender_id, +1)
+
+    def reject_request(self, request_id):
+        req = FriendRequest.query.get(request_id)
+        if req and req.receiver_id == self.id:
+            sender_id = req.sender_id
+            db.session.delete(req)
+            db.session.commit()
+            from app.suggestion_engine import on_request_changed
+            on_request_changed(sender_id, self.id, pending=False)
+            return True
+        return False
 
     def remove_friend(self, user):
         if self.is_friend(user):
             self.friends.remove(user)
             user.friends.remove(self)
             db.session.commit()
+            from app.suggestion_engine import on_friendship_changed
+            on_friendship_changed(self.id, user.id, -1)
 
     def is_friend(self, user):
         return self.friends.filter(friendship.c.friend_id == user.id).count() > 0
@@ -5,9 +5,8 @@ import re
 from datetime import datetime, timedelta
 from typing import Dict, Any, List, Optional
 from dataclasses import dataclass
-from openai import OpenAI
 from flask import current_app
-from config import Config
+from app.llm_gateway import SEALION_MODEL, llm_gateway
 
 # Logger setup
 logging.basicConfig(level=logging.INFO)
@@ -146,11 +145,8 @@ class HybridSearcher:
 
 class SeaLionPlanner:
     def __init__(self):
-        self.client = OpenAI(
-            api_key=Config.SEALION_API_KEY, 
-            base_url=Config.SEALION_BASE_URL
-        )
-        self.model_name = "aisingapore/Gemma-SEA-LION-v4-27B-IT"
+        # [TỐI ƯU] Dùng client chung của llm_gateway thay vì tạo OpenAI client mỗi lần lập kế hoạch
+        self.model_name = SEALION_MODEL
         self.searcher = HybridSearcher()
 
     def generate_plan(self, user_prompt: str, context_data: Dict) -> Dict:
@@ -185,16 +181,16 @@ OUTPUT JSON (Bắt buộc):
 """
         try:
             logger.info("--- Calling SeaLion AI ---")
-            response = self.client.chat.completions.create(
-                model=self.model_name,
+            raw_content = llm_gateway.complete(
                 messages=[
                     {"role": "system", "content": system_prompt},
                     {"role": "user", "content": "Lên lịch trình chi tiết đi."}
                 ],
+                stage='planner',
+                model=self.model_name,
                 temperature=0.4,
                 max_tokens=1500
             )
-            raw_content = response.choices[0].message.content.strip()
             
             if "```json" in raw_content:
                 raw_content = raw_content.split("```json")[1].split("```")[0].strip()
@@ -0,0 +1,312 @@
+import atexit
+import os
+import threading
+import uuid
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+# ============================================================================
+# CẤU HÌNH
+# ============================================================================
+PRESENCE_KEY_PREFIX = 'presence'   # Tiền tố key trên shared store
+PRESENCE_GC_RETRIES = 5            # Số lần thử lại khi WATCH bị worker khác chen ngang
+PRESENCE_HEARTBEAT_INTERVAL = 10   # Giây giữa 2 lần worker gia hạn heartbeat + dọn sid của worker đã chết
+PRESENCE_WORKER_TTL = 30           # Giây, worker không gia hạn heartbeat trong khoảng này bị coi là đã chết
+
+# Id của process này (gắn vào sid trong shared store, và vào frame typing_status)
+WORKER_ID = f"{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+# (room_id, user_id, username, went_offline): kết quả 1 lần rời phòng
+Departure = Tuple[int, int, str, bool]
+
+
+# ============================================================================
+# IN-PROCESS BACKEND (1 worker)
+# ============================================================================
+class MemoryPresence:
+    """
+    Presence trong RAM với 2 chỉ mục: sid -> rooms và room -> user -> sids.
+    join / leave / disconnect đều O(1) theo số phòng của sid; entry rỗng bị xóa ngay.
+    """
+
+    def __init__(self):
+        self._sid_rooms: Dict[str, Set[int]] = defaultdict(set)
+        self._sid_user: Dict[str, Tuple[int, str]] = {}
+        self._rooms: Dict[int, Dict[int, Set[str]]] = defaultdict(dict)
+        self._usernames: Dict[Tuple[int, int], str] = {}
+        self._lock = threading.Lock()
+
+    def join(self, room_id: int, user_id: int, username: str, sid: str) -> bool:
+        """Trả về True nếu đây là kết nối đầu tiên của user trong phòng (vừa online)."""
+        with self._lock:
+            self._sid_user[sid] = (user_id, username)
+            self._sid_rooms[sid].add(room_id)
+            sids = self._rooms[room_id].setdefault(user_id, set())
+            first = not sids
+            sids.add(sid)
+            self._usernames[(room_id, user_id)] = username
+            return first
+
+    def _remove(self, room_id: int, sid: str) -> Optional[Departure]:
+        user = self._sid_user.get(sid)
+        users = self._rooms.get(room_id)
+        if user is None or users is None or sid not in users.get(user[0], ()):
+            return None
+        user_id = user[0]
+        users[user_id].discard(sid)
+        went_offline = not users[user_id]
+        username = self._usernames[(room_id, user_id)]
+        if went_offline:
+            del users[user_id]
+            del self._usernames[(room_id, user_id)]
+            if not users:
+                del self._rooms[room_id]
+        return room_id, user_id, username, went_offline
+
+    def leave(self, room_id: int, sid: str) -> Optional[Departure]:
+        with self._lock:
+            departure = self._remove(room_id, sid)
+            rooms = self._sid_rooms.get(sid)
+            if rooms is not None:
+                rooms.discard(room_id)
+                if not rooms:
+                    del self._sid_rooms[sid]
+                    self._sid_user.pop(sid, None)
+            return departure
+
+    def disconnect(self, sid: str) -> List[Departure]:
+        with self._lock:
+            departures = [self._remove(room_id, sid) for room_id in self._sid_rooms.pop(sid, ())]
+            self._sid_user.pop(sid, None)
+            return [d for d in departures if d is not None]
+
+    def is_joined(self, room_id: int, sid: str) -> bool:
+        return room_id in self._sid_rooms.get(sid, ())
+
+    def rooms_of(self, sid: str) -> Set[int]:
+        with self._lock:
+            return set(self._sid_rooms.get(sid, ()))
+
+    def online_users(self, room_id: int) -> Dict[int, str]:
+        with self._lock:
+            return {uid: self._usernames[(room_id, uid)] for uid in self._rooms.get(room_id, {})}
+
+    def heartbeat(self) -> None:
+        """1 process: sid chết cùng process, không cần heartbeat."""
+
+    def collect_stale(self) -> List[Departure]:
+        return []
+
+    def release(self) -> None:
+        pass
+
+
+# ============================================================================
+# SHARED BACKEND (nhiều worker, Redis hoặc client cùng API)
+# ============================================================================
+class RedisPresence:
+    """
+    Presence dùng chung giữa các worker. Key:
+      presence:sid:<sid>              hash  {user_id, username}
+      presence:sid:<sid>:rooms        set   room_id
+      presence:room:<rid>:u:<uid>     set   sid
+      presence:room:<rid>             hash  user_id -> username (chỉ user còn >= 1 sid)
+      presence:worker:<wid>           string heartbeat, hết hạn sau PRESENCE_WORKER_TTL giây
+      presence:worker:<wid>:sids      set   sid đang nối vào worker đó
+      presence:workers                set   worker id (để tìm worker đã chết)
+    Redis tự xóa key khi set/hash rỗng. Bước "user hết sid -> bỏ khỏi hash phòng" dùng
+    WATCH/MULTI để không xóa nhầm khi worker khác vừa thêm sid cho cùng user.
+    Worker chết (crash / bị kill) không chạy được disconnect: heartbeat của nó hết hạn, worker còn
+    sống thấy vậy trong collect_stale() thì gỡ toàn bộ sid của nó như disconnect bình thường.
+    client: redis.Redis (decode_responses=True) hoặc stand-in cùng API (vd: fakeredis).
+    """
+
+    def __init__(self, client, prefix: str = PRESENCE_KEY_PREFIX, worker_id: str = WORKER_ID,
+                 worker_ttl: int = PRESENCE_WORKER_TTL):
+        self.client = client
+        self.prefix = prefix
+        self.worker_id = worker_id
+        self.worker_ttl = worker_ttl
+
+    def _sid_key(self, sid: str) -> str:
+        return f'{self.prefix}:sid:{sid}'
+
+    def _room_key(self, room_id: int) -> str:
+        return f'{self.prefix}:room:{room_id}'
+
+    def _room_user_key(self, room_id: int, user_id: int) -> str:
+        return f'{self.prefix}:room:{room_id}:u:{user_id}'
+
+    def _worker_key(self, worker_id: str) -> str:
+        return f'{self.prefix}:worker:{worker_id}'
+
+    def join(self, room_id: int, user_id: int, username: str, sid: str) -> bool:
+        user_key = self._room_user_key(room_id, user_id)
+        pipe = self.client.pipeline()
+        pipe.hset(self._sid_key(sid), mapping={'user_id': user_id, 'username': username,
+                                               'worker': self.worker_id})
+        pipe.sadd(self._sid_key(sid) + ':rooms', room_id)
+        pipe.sadd(user_key, sid)
+        pipe.scard(user_key)
+        pipe.hset(self._room_key(room_id), user_id, username)  # Sau SADD: leave đồng thời không xóa mất
+        pipe.sadd(self._worker_key(self.worker_id) + ':sids', sid)
+        results = pipe.execute()
+        return results[2] == 1 and results[3] == 1
+
+    def _remove(self, room_id: int, user_id: int, username: str, sid: str) -> Optional[Departure]:
+        from redis.exceptions import WatchError  # Chỉ cần khi bật shared backend
+        user_key = self._room_user_key(room_id, user_id)
+        if not self.client.srem(user_key, sid):
+            return None
+        for _ in range(PRESENCE_GC_RETRIES):
+            with self.client.pipeline() as pipe:
+                try:
+                    pipe.watch(user_key)
+                    if pipe.scard(user_key):
+                        return room_id, user_id, username, False
+                    pipe.multi()
+                    pipe.hdel(self._room_key(room_id), user_id)
+                    pipe.execute()
+                    return room_id, user_id, username, True
+                except WatchError:
+                    continue
+        return room_id, user_id, username, False
+
+    def _sid_user(self, sid: str) -> Optional[Tuple[int, str]]:
+        data = self.client.hgetall(self._sid_key(sid))
+        if not data:
+            return None
+        return int(data['user_id']), data['username']
+
+    def leave(self, room_id: int, sid: str) -> Optional[Departure]:
+        user = self._sid_user(sid)
+        if user is None:
+            return None
+        departure = self._remove(room_id, user[0], user[1], sid)
+        rooms_key = self._sid_key(sid) + ':rooms'
+        self.client.srem(rooms_key, room_id)
+        if not self.client.scard(rooms_key):
+            self.client.delete(self._sid_key(sid))
+            self.client.srem(self._worker_key(self.worker_id) + ':sids', sid)
+        return departure
+
+    def disconnect(self, sid: str, worker_id: str = None) -> List[Departure]:
+        user = self._sid_user(sid)
+        rooms_key = self._sid_key(sid) + ':rooms'
+        room_ids = [int(r) for r in self.client.smembers(rooms_key)]
+        self.client.delete(self._sid_key(sid), rooms_key)
+        self.client.srem(self._worker_key(worker_id or self.worker_id) + ':sids', sid)
+        if user is None:
+            return []
+        departures = [self._remove(room_id, user[0], user[1], sid) for room_id in room_ids]
+        return [d for d in departures if d is not None]
+
+    def is_joined(self, room_id: int, sid: str) -> bool:
+        return bool(self.client.sismember(self._sid_key(sid) + ':rooms', room_id))
+
+    def rooms_of(self, sid: str) -> Set[int]:
+        return {int(r) for r in self.client.smembers(self._sid_key(sid) + ':rooms')}
+
+    def online_users(self, room_id: int) -> Dict[int, str]:
+        return {int(uid): name for uid, name in self.client.hgetall(self._room_key(room_id)).items()}
+
+    # ------------------------------------------------------------------
+    # HEARTBEAT / GC (sid của worker đã chết)
+    # ------------------------------------------------------------------
+    def heartbeat(self) -> None:
+        pipe = self.client.pipeline()
+        pipe.set(self._worker_key(self.worker_id), 1, ex=self.worker_ttl)
+        pipe.sadd(f'{self.prefix}:workers', self.worker_id)
+        pipe.execute()
+
+    def collect_stale(self) -> List[Departure]:
+        """Gỡ mọi sid của các worker đã hết heartbeat. Trả về departures để báo offline cho phòng."""
+        departures = []
+        for worker_id in self.client.smembers(f'{self.prefix}:workers'):
+            if worker_id == self.worker_id or self.client.exists(self._worker_key(worker_id)):
+                continue
+            sids_key = self._worker_key(worker_id) + ':sids'
+            for sid in self.client.smembers(sids_key):
+                # 2 worker cùng dọn 1 sid: lần thứ 2 không còn hash của sid -> không có departure
+                departures += self.disconnect(sid, worker_id)
+            self.client.delete(sids_key)
+            self.client.srem(f'{self.prefix}:workers', worker_id)
+        return departures
+
+    def release(self) -> None:
+        """Tắt worker êm: bỏ heartbeat để worker khác dọn sid của worker này ngay ở tick sau."""
+        self.client.delete(self._worker_key(self.worker_id))
+
+
+# ============================================================================
+# REGISTRY (chọn backend theo config)
+# ============================================================================
+class PresenceRegistry:
+    """
+    Điểm truy cập chung cho events.py. Mặc định in-process; có PRESENCE_REDIS_URL thì dùng Redis.
+    Có thể gán thẳng backend (vd: RedisPresence(fakeredis.FakeRedis(decode_responses=True))).
+    """
+
+    def __init__(self, backend=None, heartbeat_interval: float = PRESENCE_HEARTBEAT_INTERVAL):
+        self.backend = backend or MemoryPresence()
+        self.heartbeat_interval = heartbeat_interval
+        self._started = False
+
+    def init_app(self, app) -> None:
+        url = app.config.get('PRESENCE_REDIS_URL')
+        if url:
+            import redis
+            self.backend = RedisPresence(redis.Redis.from_url(url, decode_responses=True))
+
+    def _run(self, app, on_departures) -> None:
+        from app.extensions import socketio
+        while True:
+            socketio.sleep(self.heartbeat_interval)
+            with app.app_context():
+                try:
+                    self.backend.heartbeat()
+                    departures = self.backend.collect_stale()
+                    if departures:
+                        on_departures(departures)
+                except Exception as e:
+                    print(f"Presence heartbeat error: {e}")
+
+    def _release_on_exit(self) -> None:
+        try:
+            self.backend.release()
+        except Exception as e:
+            print(f"Presence release error: {e}")
+
+    def start(self, app, on_departures: Callable[[List[Departure]], None]) -> None:
+        """
+        Shared backend: heartbeat ngay (trước khi nhận sid nào), rồi greenlet gia hạn heartbeat +
+        dọn sid của worker đã chết, on_departures báo offline cho các phòng bị ảnh hưởng.
+        """
+        if self._started or isinstance(self.backend, MemoryPresence):
+            return
+        self._started = True
+        from app.extensions import socketio
+        self.backend.heartbeat()
+        socketio.start_background_task(self._run, app, on_departures)
+        atexit.register(self._release_on_exit)
+
+    def join(self, room_id: int, user_id: int, username: str, sid: str) -> bool:
+        return self.backend.join(room_id, user_id, username, sid)
+
+    def leave(self, room_id: int, sid: str) -> Optional[Departure]:
+        return self.backend.leave(room_id, sid)
+
+    def disconnect(self, sid: str) -> List[Departure]:
+        return self.backend.disconnect(sid)
+
+    def is_joined(self, room_id: int, sid: str) -> bool:
+        return self.backend.is_joined(room_id, sid)
+
+    def rooms_of(self, sid: str) -> Set[int]:
+        return self.backend.rooms_of(sid)
+
+    def online_users(self, room_id: int) -> Dict[int, str]:
+        return self.backend.online_users(room_id)
+
+
+presence = PresenceRegistry()
@@ -0,0 +1,82 @@
+import sys
+from typing import Callable, List, Tuple
+import click
+from sqlalchemy import select, text
+from app.extensions import db
+from app.models import Activity, FriendRequest, Message, RoomRequest, Transaction, UserTagScore, room_members
+
+# ============================================================================
+# REGRESSION CHECK: các query nóng phải dùng đúng index
+# ============================================================================
+# (tên query, index mong đợi, hàm dựng câu SELECT giống code thật)
+HOT_QUERIES: List[Tuple[str, str, Callable]] = [
+    ('chat history page (newest first)', 'ix_message_room_history',
+     lambda: select(Message).where(Message.room_id == 1, Message.id < 100).order_by(Message.id.desc()).limit(51)),
+    ('reconnect catch-up (since_id)', 'ix_message_room_history',
+     lambda: select(Message).where(Message.room_id == 1, Message.id > 100).order_by(Message.id).limit(201)),
+    ('pending transactions in room', 'ix_transaction_room_status',
+     lambda: select(Transaction).where(Transaction.room_id == 1, Transaction.status == 'pending')),
+    ('transactions sent in room', 'ix_transaction_room_sender',
+     lambda: select(Transaction).where(Transaction.room_id == 1, Transaction.sender_id == 1)),
+    ('transactions received in room', 'ix_transaction_room_receiver',
+     lambda: select(Transaction).where(Transaction.room_id == 1, Transaction.receiver_id == 1)),
+    ('room requests of user', 'ix_room_request_user_status',
+     lambda: select(RoomRequest).where(RoomRequest.user_id == 1, RoomRequest.status == 'pending_user')),
+    ('room requests of room', 'ix_room_request_room_status',
+     lambda: select(RoomRequest).where(RoomRequest.room_id == 1, RoomRequest.status == 'pending_owner')),
+    ('received friend requests', 'ix_friend_request_receiver_status',
+     lambda: select(FriendRequest).where(FriendRequest.receiver_id == 1, FriendRequest.status == 'pending')),
+    ('activities of room', 'ix_activity_room_start',
+     lambda: select(Activity).where(Activity.room_id == 1).order_by(Activity.start_time)),
+    ('members of room', 'ix_room_members_room_user',
+     lambda: select(room_members.c.user_id).where(room_members.c.room_id == 1)),
+    ('interest score upsert key', 'uq_user_tag_score_user_tag',
+     lambda: select(UserTagScore).where(UserTagScore.user_id == 1, UserTagScore.tag_id == 1)),
+]
+
+
+def explain(conn, stmt) -> str:
+    """Query plan dạng text (SQLite: EXPLAIN QUERY PLAN, PostgreSQL: EXPLAIN)."""
+    sql = str(stmt.compile(dialect=conn.dialect, compile_kwargs={'literal_binds': True}))
+    if conn.dialect.name == 'sqlite':
+        rows = conn.execute(text(f'EXPLAIN QUERY PLAN {sql}')).all()
+        return '\n'.join(str(row[-1]) for row in rows)
+    if conn.dialect.name == 'postgresql':
+        # Bảng nhỏ thì planner thích seq scan, tắt đi để xem index có dùng được không
+        conn.execute(text('SET LOCAL enable_seqscan = off'))
+    return '\n'.join(str(row[0]) for row in conn.execute(text(f'EXPLAIN {sql}')).all())
+
+
+def check_hot_query_indexes(engine=None) -> List[Tuple[str, str, bool, str]]:
+    """Trả về [(tên query, index mong đợi, có dùng không, plan)]."""
+    engine = engine or db.engine
+    results = []
+    with engine.connect() as conn:
+        for name, index, build in HOT_QUERIES:
+            with conn.begin():
+                plan = explain(conn, build())
+            results.append((name, index, index in plan, plan))
+    return results
+
+
+# ============================================================================
+# CLI
+# ============================================================================
+def register_cli(app) -> None:
+    @app.cli.command('migrate')
+    def migrate_command():
+        """Chạy các migration chưa áp dụng."""
+        from app.migrations import run_migrations
+        applied = run_migrations()
+        click.echo(f"Applied: {applied}" if applied else "Database is up to date.")
+
+    @app.cli.command('check-indexes')
+    def check_indexes_command():
+        """Kiểm tra các query nóng có dùng đúng index không (exit 1 nếu không)."""
+        failed = 0
+        for name, index, ok, plan in check_hot_query_indexes():
+            click.echo(f"[{'OK' if ok else 'MISSING'}] {name} -> {index}")
+            if not ok:
+                failed += 1
+                click.echo('    ' + plan.replace('\n', '\n    '))
+        sys.exit(1 if failed else 0)
@@ -0,0 +1,215 @@
+import atexit
+import datetime
+import threading
+from typing import Dict, Iterable, Set, Tuple
+from sqlalchemy import and_, bindparam, case, exists, select
+from sqlalchemy.dialects import postgresql, sqlite
+from app.extensions import db, socketio
+from app.models import Message, ReadCursor
+
+# ============================================================================
+# CẤU HÌNH
+# ============================================================================
+READ_CURSOR_FLUSH_INTERVAL = 1.0   # Giây giữa 2 lần ghi cursor xuống DB + đẩy số tin chưa đọc
+
+
+class ReadCursorBuffer:
+    """
+    Write-behind buffer cho read cursor + nguồn đẩy 'unread_update'.
+    Socket handler chỉ ghi nhớ trong RAM id lớn nhất đã đọc theo (user_id, room_id) và đánh dấu
+    user nào cần cập nhật số chưa đọc; greenlet nền mỗi tick ghi cursor bằng 1 lệnh upsert
+    (cursor không bao giờ lùi) rồi đếm chưa đọc cho mọi cặp bị đánh dấu bằng 1 query GROUP BY,
+    gửi 1 event / user tới channel user_<id>. Client không phải poll.
+    """
+
+    def __init__(self, flush_interval: float = READ_CURSOR_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._pending: Dict[Tuple[int, int], int] = {}   # (user_id, room_id) -> id lớn nhất đã đọc
+        self._flushing: Dict[Tuple[int, int], int] = {}  # Cursor đang được ghi (đã rút khỏi _pending)
+        self._dirty: Dict[int, Set[int]] = {}            # user_id -> các phòng cần đẩy lại số chưa đọc
+        self._lock = threading.Lock()
+        self._started = False
+        self.flushed_rows = 0
+        self.pushes = 0
+
+    # ------------------------------------------------------------------
+    # EVENTS (gọi từ socket handler, không I/O)
+    # ------------------------------------------------------------------
+    def advance(self, user_id: int, room_id: int, message_id: int) -> None:
+        """User đã thấy tới message_id trong phòng (chỉ tiến, không lùi)."""
+        key = (user_id, room_id)
+        with self._lock:
+            if message_id > self._pending.get(key, 0):
+                self._pending[key] = message_id
+
+    def seed(self, user_id: int, room_id: int) -> None:
+        """
+        [FIX] Thành viên mới vào phòng: cursor đặt ở tin mới nhất (kể cả tin còn trong hàng đợi ghi)
+        -> lịch sử trước khi vào không bị tính là chưa đọc.
+        """
+        from app.message_writer import message_writer
+        queued = [payload['id'] for payload in message_writer.pending_payloads(room_id)]
+        self.advance(user_id, room_id, max([Message.latest_id(room_id)] + queued))
+
+    def touch(self, user_ids: Iterable[int], room_id: int) -> None:
+        """Số chưa đọc của các user này trong phòng đã đổi (tin mới / vừa đọc) -> gửi lại ở tick sau."""
+        with self._lock:
+            for user_id in user_ids:
+                self._dirty.setdefault(user_id, set()).add(room_id)
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def discard_room(self, room_id: int) -> None:
+        """Phòng bị xóa -> bỏ cursor chưa ghi + các lượt đẩy của phòng đó."""
+        with self._lock:
+            self._pending = {k: v for k, v in self._pending.items() if k[1] != room_id}
+            for rooms in self._dirty.values():
+                rooms.discard(room_id)
+
+    def _drain(self) -> Dict[Tuple[int, int], int]:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._flushing = pending
+        return pending
+
+    def _requeue(self, pending: Dict[Tuple[int, int], int]) -> None:
+        with self._lock:
+            self._flushing = {}
+            for key, message_id in pending.items():
+                if message_id > self._pending.get(key, 0):
+                    self._pending[key] = message_id
+
+    # ------------------------------------------------------------------
+    # FLUSH (cần app context)
+    # ------------------------------------------------------------------
+    @staticmethod
+    def _statements():
+        t = ReadCursor.__table__
+        new_id = bindparam('b_message_id')
+        dialect_insert = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}.get(
+            db.session.get_bind().dialect.name)
+        if dialect_insert is not None:
+            # 1 lệnh cho cả cursor mới lẫn cũ, giữ giá trị lớn hơn (worker khác có thể đã ghi id mới hơn)
+            stmt = dialect_insert(t).values(
+                user_id=bindparam('b_user_id'), room_id=bindparam('b_room_id'),
+                last_read_message_id=new_id, updated_at=bindparam('b_now'))
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['user_id', 'room_id'],
+                set_={'last_read_message_id': case(
+                          (stmt.excluded.last_read_message_id > t.c.last_read_message_id,
+                           stmt.excluded.last_read_message_id),
+                          else_=t.c.last_read_message_id),
+                      'updated_at': stmt.excluded.updated_at})
+            return [stmt]
+
+        key = and_(t.c.user_id == bindparam('b_user_id'), t.c.room_id == bindparam('b_room_id'))
+        update_stmt = t.update().where(and_(key, t.c.last_read_message_id < new_id))\
+            .values(last_read_message_id=new_id, updated_at=bindparam('b_now'))
+        insert_stmt = t.insert().from_select(
+            ['user_id', 'room_id', 'last_read_message_id', 'updated_at'],
+            select(bindparam('b_user_id'), bindparam('b_room_id'), new_id, bindparam('b_now'))
+            .where(~exists().where(key))
+        )
+        return [update_stmt, insert_stmt]
+
+    def flush_cursors(self) -> int:
+        pending = self._drain()
+        if not pending:
+            return 0
+        now = datetime.datetime.utcnow()
+        params = [{'b_user_id': uid, 'b_room_id': rid, 'b_message_id': message_id, 'b_now': now}
+                  for (uid, rid), message_id in pending.items()]
+        try:
+            for stmt in self._statements():
+                db.session.execute(stmt, params)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            self._requeue(pending)  # Không làm mất vị trí đọc, lần flush sau thử lại
+            raise
+        with self._lock:
+            self._flushing = {}
+        self.flushed_rows += len(params)
+        return len(params)
+
+    def unread_counts(self, user_id: int, room_ids: Iterable[int]) -> Dict[int, int]:
+        """
+        {room_id: số tin chưa đọc} của 1 user (lobby). Không ghi DB trong request: cursor còn trong RAM
+        được gộp vào lúc đếm (greenlet nền vẫn là nơi duy nhất ghi). Lỗi DB -> lobby hiện không có số.
+        """
+        pairs = [(user_id, rid) for rid in room_ids]
+        with self._lock:
+            floors = {key: max(self._pending.get(key, 0), self._flushing.get(key, 0))
+                      for key in pairs if key in self._pending or key in self._flushing}
+        try:
+            counts = ReadCursor.unread_counts(pairs, floors)
+        except Exception as e:
+            db.session.rollback()
+            print(f"Unread count error: {e}")
+            return {}
+        return {rid: n for (_, rid), n in counts.items()}
+
+    def push_unread(self) -> int:
+        """Đếm lại + gửi 'unread_update' cho các user bị đánh dấu. Trả về số event đã gửi."""
+        from app.message_writer import message_writer
+        # Phòng còn tin chưa xuống DB thì đếm sẽ thiếu -> chỉ các cặp của phòng đó đợi tick sau
+        busy = message_writer.pending_rooms()
+        with self._lock:
+            marked, dirty, self._dirty = self._dirty, {}, {}
+            for uid, rooms in marked.items():
+                if rooms - busy:
+                    dirty[uid] = rooms - busy
+                if rooms & busy:
+                    self._dirty[uid] = rooms & busy
+        try:
+            counts = ReadCursor.unread_counts((uid, rid) for uid, rooms in dirty.items() for rid in rooms)
+        except Exception:
+            db.session.rollback()
+            with self._lock:
+                for uid, rooms in dirty.items():
+                    self._dirty.setdefault(uid, set()).update(rooms)  # Tick sau đếm lại
+            raise
+        by_user: Dict[int, Dict[int, int]] = {}
+        for (uid, rid), n in counts.items():
+            by_user.setdefault(uid, {})[rid] = n
+        for uid, room_counts in by_user.items():
+            socketio.emit('unread_update', {'counts': room_counts}, to=f"user_{uid}")
+        self.pushes += len(by_user)
+        return len(by_user)
+
+    def flush(self) -> int:
+        written = self.flush_cursors()
+        self.push_unread()
+        return written
+
+    # ------------------------------------------------------------------
+    # BACKGROUND GREENLET
+    # ------------------------------------------------------------------
+    def _run(self, app) -> None:
+        while True:
+            socketio.sleep(self.flush_interval)
+            with app.app_context():
+                try:
+                    self.flush()
+                except Exception as e:
+                    print(f"Read cursor flush error: {e}")
+
+    def _flush_on_exit(self, app) -> None:
+        with app.app_context():
+            try:
+                self.flush_cursors()
+            except Exception as e:
+                print(f"Read cursor final flush error: {e}")
+
+    def start(self, app) -> None:
+        """Chạy greenlet ghi cursor / đẩy số chưa đọc + flush lần cuối khi tắt server."""
+        if self._started:
+            return
+        self._started = True
+        socketio.start_background_task(self._run, app)
+        atexit.register(self._flush_on_exit, app)
+
+
+read_cursors = ReadCursorBuffer()
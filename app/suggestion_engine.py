@@ -0,0 +1,224 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from sqlalchemy import func, select, union
+from app.cache_bus import cache_bus
+from app.extensions import db
+from app.models import User, FriendRequest, UserTagScore, friendship
+from app.utils import build_user_interest_vector, get_user_interest_vector
+
+# ============================================================================
+# CẤU HÌNH
+# ============================================================================
+SUGGESTION_CANDIDATES = 50      # Số ứng viên giữ lại cho mỗi user
+SIMILARITY_WEIGHT = 2.0         # Điểm = số bạn chung + SIMILARITY_WEIGHT * cosine(sở thích)
+SUGGESTION_CACHE_SIZE = 4096
+SUGGESTION_CACHE_TTL = 1800     # Giây, để sở thích thay đổi cũng được cập nhật dần
+# Nhiều worker: worker khác chỉ xóa entry (qua cache_bus), không cộng/trừ mutual_count như worker gốc
+
+
+def _cosine(a: np.ndarray, b: np.ndarray) -> float:
+    na, nb = np.linalg.norm(a), np.linalg.norm(b)
+    if na == 0 or nb == 0:
+        return 0.0
+    return float(np.dot(a, b) / (na * nb))
+
+
+# ============================================================================
+# CACHE (precomputed per user)
+# ============================================================================
+class SuggestionCache:
+    """
+    user_id -> {candidate_id: [mutual_count, similarity]}.
+    Khi đồ thị bạn bè thay đổi, chỉ cộng/trừ mutual_count của các user liên quan
+    (bạn của 2 người vừa kết bạn / hủy kết bạn) thay vì tính lại toàn bộ.
+    Các worker khác nhận danh sách user liên quan qua cache_bus và xóa entry của họ.
+    """
+
+    def __init__(self, max_size: int = SUGGESTION_CACHE_SIZE, ttl: float = SUGGESTION_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[int, Tuple[float, Dict[int, list]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int) -> Optional[Dict[int, list]]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                self._entries.pop(user_id, None)
+                return None
+            self._entries.move_to_end(user_id)
+            return entry[1]
+
+    def set(self, user_id: int, candidates: Dict[int, list]) -> None:
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, candidates)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def adjust_mutual(self, user_id: int, candidate_id: int, delta: int,
+                      similarity: Optional[float] = None) -> None:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            candidates = entry[1]
+            if candidate_id in candidates:
+                candidates[candidate_id][0] += delta
+                if candidates[candidate_id][0] <= 0:
+                    del candidates[candidate_id]
+            elif delta > 0 and similarity is not None:
+                candidates[candidate_id] = [delta, similarity]
+
+    def discard(self, user_id: int, candidate_id: int) -> None:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                entry[1].pop(candidate_id, None)
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def invalidate_many(self, user_ids) -> None:
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+
+suggestion_cache = SuggestionCache()
+cache_bus.register('suggestions', suggestion_cache.invalidate_many)
+
+
+# ============================================================================
+# COMPUTE
+# ============================================================================
+def _excluded_ids_query(user_id: int):
+    """Bản thân + bạn bè hiện tại + những người đang có lời mời pending (2 chiều)."""
+    return union(
+        select(friendship.c.friend_id).where(friendship.c.user_id == user_id),
+        select(FriendRequest.receiver_id).where(FriendRequest.sender_id == user_id,
+                                                FriendRequest.status == 'pending'),
+        select(FriendRequest.sender_id).where(FriendRequest.receiver_id == user_id,
+                                              FriendRequest.status == 'pending'),
+        select(db.literal(user_id)),
+    )
+
+
+def _mutual_counts(user_id: int, limit: int) -> List[Tuple[int, int]]:
+    """Friends-of-friends: đếm số bạn chung qua 2 bước trên bảng friendship (1 query)."""
+    f1 = friendship.alias('f1')
+    f2 = friendship.alias('f2')
+    mutual = func.count().label('mutual')
+    rows = db.session.execute(
+        select(f2.c.friend_id, mutual)
+        .select_from(f1.join(f2, f1.c.friend_id == f2.c.user_id))
+        .where(f1.c.user_id == user_id, f2.c.friend_id.notin_(_excluded_ids_query(user_id)))
+        .group_by(f2.c.friend_id)
+        .order_by(mutual.desc())
+        .limit(limit)
+    ).all()
+    return [(r[0], r[1]) for r in rows]
+
+
+def _similar_interest_ids(user_id: int, limit: int) -> List[int]:
+    """Fallback cho user chưa có bạn: người có điểm cao ở các tag user quan tâm nhất."""
+    top_tags = [r.tag_id for r in UserTagScore.query.filter_by(user_id=user_id)
+                .order_by(UserTagScore.score.desc()).limit(3).all()]
+    if not top_tags:
+        return []
+    rows = db.session.query(UserTagScore.user_id)\
+        .filter(UserTagScore.tag_id.in_(top_tags), UserTagScore.user_id.notin_(_excluded_ids_query(user_id)))\
+        .group_by(UserTagScore.user_id)\
+        .order_by(func.sum(UserTagScore.score).desc())\
+        .limit(limit).all()
+    return [r[0] for r in rows]
+
+
+def _interest_vectors(user_ids: List[int]) -> Dict[int, np.ndarray]:
+    """Load vector sở thích của nhiều user trong 1 query."""
+    grouped: Dict[int, list] = {uid: [] for uid in user_ids}
+    if user_ids:
+        for row in UserTagScore.query.filter(UserTagScore.user_id.in_(user_ids)).all():
+            grouped[row.user_id].append(row)
+    return {uid: build_user_interest_vector(rows) for uid, rows in grouped.items()}
+
+
+def compute_suggestions(user_id: int) -> Dict[int, list]:
+    mutual = _mutual_counts(user_id, SUGGESTION_CANDIDATES)
+    candidates = {cid: [count, 0.0] for cid, count in mutual}
+    if len(candidates) < SUGGESTION_CANDIDATES:
+        for cid in _similar_interest_ids(user_id, SUGGESTION_CANDIDATES - len(candidates)):
+            candidates.setdefault(cid, [0, 0.0])
+
+    me = get_user_interest_vector(user_id)
+    for cid, vec in _interest_vectors(list(candidates)).items():
+        candidates[cid][1] = _cosine(me, vec)
+    return candidates
+
+
+def suggest_friends(user_id: int, limit: int = 3) -> List[User]:
+    """Top `limit` gợi ý kết bạn, mỗi User được gắn thêm thuộc tính mutual_friends."""
+    candidates = suggestion_cache.get(user_id)
+    if candidates is None:
+        candidates = compute_suggestions(user_id)
+        suggestion_cache.set(user_id, candidates)
+
+    ranked = sorted(candidates.items(),
+                    key=lambda kv: kv[1][0] + SIMILARITY_WEIGHT * kv[1][1], reverse=True)[:limit]
+    users = {u.id: u for u in User.query.filter(User.id.in_([cid for cid, _ in ranked])).all()}
+    result = []
+    for cid, (mutual, _) in ranked:
+        if cid in users:
+            users[cid].mutual_friends = mutual
+            result.append(users[cid])
+    return result
+
+
+# ============================================================================
+# INCREMENTAL REFRESH (gọi sau khi commit thay đổi đồ thị bạn bè)
+# ============================================================================
+def _friend_ids(user_id: int) -> List[int]:
+    return [r[0] for r in db.session.query(friendship.c.friend_id).filter(friendship.c.user_id == user_id).all()]
+
+
+def on_friendship_changed(user_a: int, user_b: int, delta: int) -> None:
+    """
+    delta = +1 khi A và B vừa thành bạn, -1 khi hủy kết bạn.
+    Bạn của A có thêm/bớt 1 bạn chung với B (và ngược lại); A, B tính lại từ đầu.
+    """
+    suggestion_cache.invalidate(user_a)
+    suggestion_cache.invalidate(user_b)
+
+    touched = {user_a, user_b}
+    for me, other in ((user_a, user_b), (user_b, user_a)):
+        other_vec = None
+        other_friends = set(_friend_ids(other))
+        for fid in _friend_ids(me):
+            if fid == other or fid in other_friends:
+                continue  # Đã là bạn của nhau thì không nằm trong danh sách gợi ý
+            touched.add(fid)
+            similarity = None
+            if delta > 0 and suggestion_cache.get(fid) is not None:
+                if other_vec is None:
+                    other_vec = get_user_interest_vector(other)
+                similarity = _cosine(get_user_interest_vector(fid), other_vec)
+            suggestion_cache.adjust_mutual(fid, other, delta, similarity)
+    cache_bus.notify_others('suggestions', sorted(touched))
+
+
+def on_request_changed(sender_id: int, receiver_id: int, pending: bool = True) -> None:
+    """
+    Lời mời mới -> 2 người không còn là gợi ý của nhau.
+    Lời mời bị từ chối (pending=False) -> 2 người lại là ứng viên của nhau, tính lại danh sách của cả 2.
+    """
+    if pending:
+        suggestion_cache.discard(sender_id, receiver_id)
+        suggestion_cache.discard(receiver_id, sender_id)
+    else:
+        suggestion_cache.invalidate(sender_id)
+        suggestion_cache.invalidate(receiver_id)
+    cache_bus.notify_others('suggestions', [sender_id, receiver_id])
@@ -0,0 +1,356 @@
+import datetime
+import json
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from app.extensions import db, socketio
+from app.models import Message, Room
+from app.ai_summary import MAP_REDUCE_STAGES, PAPER_STAGES, SeaLionDialogueSystem
+
+# ============================================================================
+# CẤU HÌNH
+# ============================================================================
+SUMMARY_WINDOW = 40          # Số tin mới gửi nguyên văn cho AI mỗi lần tóm tắt (phần cũ hơn nằm trong Room.summary)
+SUMMARY_JOB_TTL = 600        # Giây giữ job đã xong để client mất socket còn tra được qua HTTP
+SUMMARY_JOB_KEY_PREFIX = 'summary'   # Tiền tố key job trên shared store
+SUMMARY_JOB_CLAIM_RETRIES = 3        # Số lần thử lại khi job đang chạy cùng key vừa xong / hết hạn
+SUMMARY_UP_TO_DATE_MSG = "📌 Không có tin nhắn mới, đây là bản tóm tắt gần nhất."
+SUMMARY_SHORT_MSG = {
+    'paper': "🦁 SeaLion (Paper Mode) đã phân tích sâu hội thoại!",
+    'normal': "⚡ AI Recap (Fast Mode) đã tóm tắt nhanh!",
+    'long': "📚 AI Recap (Map-Reduce) đã tóm tắt cả đoạn chat dài!",
+}
+SUMMARY_STAGES = {'paper': PAPER_STAGES, 'normal': 1, 'long': MAP_REDUCE_STAGES}
+
+# Mode 'long': cửa sổ tùy chọn (N giờ gần nhất và/hoặc N tin gần nhất), chia chunk rồi map-reduce
+LONG_WINDOW_MAX_MESSAGES = 1000
+LONG_WINDOW_MAX_HOURS = 7 * 24
+
+# Tồn quá nhiều tin chưa tóm tắt: chỉ tóm tắt SUMMARY_BACKLOG_MAX tin mới nhất, phần cũ hơn bỏ qua
+SUMMARY_BACKLOG_MAX = LONG_WINDOW_MAX_MESSAGES
+
+# (số giờ hoặc None, số tin tối đa); chỉ dùng cho mode 'long'
+Window = Optional[Tuple[Optional[int], int]]
+
+
+def parse_window(hours, limit) -> Tuple[Optional[int], int]:
+    """Kẹp tham số cửa sổ của request vào giới hạn cho phép"""
+    hours = min(max(hours, 1), LONG_WINDOW_MAX_HOURS) if hours else None
+    limit = min(max(limit or LONG_WINDOW_MAX_MESSAGES, 1), LONG_WINDOW_MAX_MESSAGES)
+    return hours, limit
+
+
+# ============================================================================
+# TÓM TẮT (cần app context)
+# ============================================================================
+def stored_summary(room: Room, mode: str) -> Optional[Dict]:
+    """Kết quả đã lưu nếu phòng không có tin mới kể từ lần tóm tắt trước (không gọi AI)."""
+    previous_summary, last_summarized_id = room.get_summary(mode)
+    if previous_summary and Message.latest_id(room.id) <= last_summarized_id:
+        return {"short": SUMMARY_UP_TO_DATE_MSG, "full": previous_summary, "cached": True}
+    return None
+
+
+def summarize_window(room_id: int, window: Tuple[Optional[int], int], on_stage: Callable = None) -> Dict:
+    """
+    [NEW] Recap cửa sổ dài bằng map-reduce (không lưu vào Room.summary: mỗi cửa sổ một kết quả).
+    Chunk trùng giữa các cửa sổ chồng nhau lấy lại kết quả map từ llm_cache.
+    """
+    hours, limit = window
+    since = datetime.datetime.utcnow() - datetime.timedelta(hours=hours) if hours else None
+    messages = Message.window(room_id, since=since, limit=limit)
+    if not messages:
+        return {"short": "Chưa có tin nhắn", "full": "Chưa có nội dung để tóm tắt"}
+    chat_history = [{"id": msg.id, "speaker": msg.author.username, "text": msg.body} for msg in messages]
+    final_report = SeaLionDialogueSystem().map_reduce_process(chat_history, on_stage=on_stage)
+    return {"short": SUMMARY_SHORT_MSG['long'], "full": final_report, "message_count": len(messages)}
+
+
+def _unsummarized_messages(room_id: int, after_id: int) -> List[Message]:
+    """
+    Tin có id > after_id, cũ -> mới, tối đa SUMMARY_BACKLOG_MAX tin mới nhất
+    (phòng bỏ lâu không tóm tắt không kéo cả nghìn tin vào RAM / prompt AI).
+    """
+    return Message.window(room_id, limit=SUMMARY_BACKLOG_MAX, after_id=after_id)
+
+
+def summarize_room(room_id: int, mode: str, on_stage: Callable = None, window: Window = None) -> Dict:
+    """
+    [TỐI ƯU] Tóm tắt cuốn chiếu: chỉ gửi tin mới hơn bản tóm tắt trước rồi gộp vào bản đó;
+    kết quả + id tin cuối cùng được lưu lại vào Room.summary.
+    Tồn nhiều hơn SUMMARY_WINDOW tin mới: phần cũ hơn được nén bằng map-reduce (chunk có cache)
+    rồi ghép vào bản tóm tắt trước, SUMMARY_WINDOW tin cuối vẫn gửi nguyên văn.
+    Tồn quá SUMMARY_BACKLOG_MAX tin: chỉ tóm tắt phần mới nhất, id đã tóm tắt vẫn tiến tới tin cuối
+    nên phần cũ hơn không bị đọc lại ở lần sau.
+    """
+    room = db.session.get(Room, room_id)
+    if room is None:
+        return {"short": "Lỗi AI", "full": "Phòng không còn tồn tại."}
+    if mode == 'long':
+        return summarize_window(room.id, window or parse_window(None, None), on_stage)
+    cached = stored_summary(room, mode)
+    if cached:
+        return cached
+
+    previous_summary, last_summarized_id = room.get_summary(mode)
+    messages = _unsummarized_messages(room.id, last_summarized_id)
+    if not messages:
+        return {"short": "Chưa có tin nhắn", "full": "Chưa có nội dung để tóm tắt"}
+
+    sealion = SeaLionDialogueSystem()
+    backlog, recent = messages[:-SUMMARY_WINDOW], messages[-SUMMARY_WINDOW:]
+    if backlog:
+        backlog_report = sealion.map_reduce_process(
+            [{"id": msg.id, "speaker": msg.author.username, "text": msg.body} for msg in backlog],
+            on_stage=(lambda index, name: on_stage(0, f'backlog_{name}')) if on_stage else None)
+        if sealion.is_error(backlog_report):
+            return {"short": SUMMARY_SHORT_MSG[mode], "full": backlog_report}
+        previous_summary = f"{previous_summary}\n\n{backlog_report}" if previous_summary else backlog_report
+
+    chat_history = [{"speaker": msg.author.username, "text": msg.body} for msg in recent]
+    if mode == 'paper':
+        # Paper Version: Deep Processing (Normalize -> Coref -> Topic)
+        final_report = sealion.process(chat_history, previous_summary, on_stage=on_stage)
+    else:
+        # Normal Version: Fast Summarization
+        final_report = sealion.simple_process(chat_history, previous_summary, on_stage=on_stage)
+
+    # Kết quả lỗi không được lưu, lần sau tóm tắt lại từ bản cũ
+    if not sealion.is_error(final_report):
+        room.set_summary(mode, final_report, messages[-1].id)
+        db.session.commit()
+    return {"short": SUMMARY_SHORT_MSG[mode], "full": final_report}
+
+
+# ============================================================================
+# JOB NỀN
+# ============================================================================
+class SummaryJob:
+    __slots__ = ('id', 'room_id', 'mode', 'window', 'requesters', 'status', 'stage', 'stage_name',
+                 'result', 'finished_at')
+
+    def __init__(self, room_id: int, mode: str, user_id: Optional[int], window: Window = None,
+                 job_id: str = None):
+        self.id = job_id or uuid.uuid4().hex
+        self.room_id = room_id
+        self.mode = mode
+        self.window = window
+        self.requesters: Set[int] = {user_id} if user_id is not None else set()
+        self.status = 'queued'      # queued -> running -> done | error
+        self.stage = 0
+        self.stage_name = None
+        self.result: Optional[Dict] = None
+        self.finished_at: Optional[float] = None
+
+    @property
+    def total_stages(self) -> int:
+        return SUMMARY_STAGES[self.mode]
+
+    @property
+    def key(self) -> Tuple:
+        """Yêu cầu trùng key khi job đang chạy thì dùng chung job."""
+        return self.room_id, self.mode, self.window
+
+    def to_dict(self) -> Dict:
+        data = {'job_id': self.id, 'room_id': self.room_id, 'mode': self.mode, 'status': self.status,
+                'stage': self.stage, 'stage_name': self.stage_name, 'total_stages': self.total_stages}
+        if self.window:
+            data['hours'], data['limit'] = self.window
+        if self.result is not None:
+            data.update(self.result)
+        return data
+
+    def to_state(self) -> Dict[str, str]:
+        """Trạng thái dạng chuỗi để lưu vào hash của shared store."""
+        return {'room_id': str(self.room_id), 'mode': self.mode, 'window': json.dumps(self.window),
+                'status': self.status, 'stage': str(self.stage), 'stage_name': self.stage_name or '',
+                'result': json.dumps(self.result)}
+
+    @classmethod
+    def from_state(cls, job_id: str, state: Dict[str, str], requesters: Set[int]) -> 'SummaryJob':
+        window = json.loads(state['window'])
+        job = cls(int(state['room_id']), state['mode'], None, tuple(window) if window else None, job_id)
+        job.requesters = requesters
+        job.status, job.stage = state['status'], int(state['stage'])
+        job.stage_name = state['stage_name'] or None
+        job.result = json.loads(state['result'])
+        return job
+
+
+class MemoryJobStore:
+    """Job trong RAM của worker (1 worker, hoặc nhiều worker có sticky session)."""
+
+    def __init__(self, ttl: float = SUMMARY_JOB_TTL):
+        self.ttl = ttl
+        self._jobs: Dict[str, SummaryJob] = {}
+        self._active: Dict[Tuple, SummaryJob] = {}   # (room_id, mode, window) -> job chưa xong
+        self._lock = threading.Lock()
+
+    def claim(self, job: SummaryJob) -> SummaryJob:
+        """Đăng ký job mới, hoặc trả về job đang chạy cùng key (đã thêm người yêu cầu)."""
+        with self._lock:
+            self._expire()
+            active = self._active.get(job.key)
+            if active is not None:
+                active.requesters |= job.requesters
+                return active
+            self._jobs[job.id] = job
+            self._active[job.key] = job
+            return job
+
+    def save(self, job: SummaryJob) -> None:
+        pass  # Cùng 1 object với job đang chạy
+
+    def finish(self, job: SummaryJob) -> None:
+        with self._lock:
+            job.finished_at = time.monotonic()
+            self._active.pop(job.key, None)
+
+    def load(self, job_id: str) -> Optional[SummaryJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def requesters(self, job: SummaryJob) -> Set[int]:
+        with self._lock:
+            return set(job.requesters)
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        for job_id in [j.id for j in self._jobs.values() if j.finished_at and now - j.finished_at > self.ttl]:
+            del self._jobs[job_id]
+
+
+class RedisJobStore:
+    """
+    Job dùng chung giữa các worker (route tra trạng thái vào worker nào cũng thấy, chống trùng toàn cụm). Key:
+      summary:job:<id>              hash  trạng thái (SummaryJob.to_state)
+      summary:job:<id>:requesters   set   user_id được xem / nhận event của job
+      summary:active:<room>:<mode>:<window>   string job_id đang chạy (SET NX: chỉ 1 worker chạy)
+    Mọi key có TTL, gia hạn mỗi lần lưu: worker chết giữa chừng thì job tự hết hạn, yêu cầu sau chạy lại.
+    client: redis.Redis (decode_responses=True) hoặc stand-in cùng API (vd: fakeredis).
+    """
+
+    def __init__(self, client, ttl: float = SUMMARY_JOB_TTL, prefix: str = SUMMARY_JOB_KEY_PREFIX):
+        self.client = client
+        self.ttl = int(ttl)
+        self.prefix = prefix
+
+    def _job_key(self, job_id: str) -> str:
+        return f'{self.prefix}:job:{job_id}'
+
+    def _active_key(self, job: SummaryJob) -> str:
+        window = '-'.join(str(v) for v in job.window) if job.window else 'all'
+        return f'{self.prefix}:active:{job.room_id}:{job.mode}:{window}'
+
+    def claim(self, job: SummaryJob) -> SummaryJob:
+        self.save(job)
+        for _ in range(SUMMARY_JOB_CLAIM_RETRIES):
+            if self.client.set(self._active_key(job), job.id, nx=True, ex=self.ttl):
+                return job
+            active_id = self.client.get(self._active_key(job))
+            active = self.load(active_id) if active_id else None
+            if active is not None and active.status in ('queued', 'running'):
+                self.client.delete(self._job_key(job.id), self._job_key(job.id) + ':requesters')
+                self.client.sadd(self._job_key(active.id) + ':requesters', *job.requesters)
+                active.requesters |= job.requesters
+                return active
+            self.client.delete(self._active_key(job))  # Job cũ đã xong / hết hạn mà key còn sót
+        return job
+
+    def save(self, job: SummaryJob) -> None:
+        key = self._job_key(job.id)
+        pipe = self.client.pipeline()
+        pipe.hset(key, mapping=job.to_state())
+        if job.requesters:
+            pipe.sadd(key + ':requesters', *job.requesters)
+        pipe.expire(key, self.ttl)
+        pipe.expire(key + ':requesters', self.ttl)
+        if job.status in ('queued', 'running'):
+            pipe.expire(self._active_key(job), self.ttl)
+        pipe.execute()
+
+    def finish(self, job: SummaryJob) -> None:
+        self.save(job)
+        if self.client.get(self._active_key(job)) == job.id:
+            self.client.delete(self._active_key(job))
+
+    def load(self, job_id: str) -> Optional[SummaryJob]:
+        state = self.client.hgetall(self._job_key(job_id))
+        if not state:
+            return None
+        return SummaryJob.from_state(job_id, state, self._requesters(job_id))
+
+    def requesters(self, job: SummaryJob) -> Set[int]:
+        return self._requesters(job.id)
+
+    def _requesters(self, job_id: str) -> Set[int]:
+        return {int(uid) for uid in self.client.smembers(self._job_key(job_id) + ':requesters')}
+
+
+class SummaryJobManager:
+    """
+    Chạy get_chat_summary như job nền thay vì giữ request HTTP suốt các lần gọi AI.
+    submit() trả về job ngay; greenlet nền đẩy 'summary_progress' (trước mỗi bước) và
+    'summary_done' tới user_<id> của mọi người đã yêu cầu. Yêu cầu trùng (room, mode, cửa sổ)
+    khi job đang chạy dùng chung job đó. Job lưu trong RAM của worker, hoặc trên Redis
+    (PRESENCE_REDIS_URL) khi chạy nhiều worker để route tra trạng thái vào worker nào cũng thấy.
+    """
+
+    def __init__(self, ttl: float = SUMMARY_JOB_TTL):
+        self.ttl = ttl
+        self.store = MemoryJobStore(ttl)
+        self.started = 0
+        self.deduplicated = 0
+
+    def init_app(self, app) -> None:
+        url = app.config.get('PRESENCE_REDIS_URL')
+        if url:
+            import redis
+            self.store = RedisJobStore(redis.Redis.from_url(url, decode_responses=True), self.ttl)
+
+    def submit(self, app, room_id: int, mode: str, user_id: int, window: Window = None) -> SummaryJob:
+        requested = SummaryJob(room_id, mode, user_id, window)
+        job = self.store.claim(requested)
+        if job is not requested:
+            self.deduplicated += 1
+            return job
+        self.started += 1
+        socketio.start_background_task(self._run, app, job)
+        return job
+
+    def get(self, job_id: str, user_id: int) -> Optional[SummaryJob]:
+        """Job nếu user là người đã yêu cầu (không lộ tóm tắt phòng cho người khác)."""
+        job = self.store.load(job_id)
+        return job if job is not None and user_id in job.requesters else None
+
+    def _emit(self, job: SummaryJob, event: str) -> None:
+        payload = job.to_dict()
+        for user_id in self.store.requesters(job):
+            socketio.emit(event, payload, to=f"user_{user_id}")
+
+    def _on_stage(self, job: SummaryJob, index: int, name: str) -> None:
+        job.status, job.stage, job.stage_name = 'running', index, name
+        self.store.save(job)
+        self._emit(job, 'summary_progress')
+
+    def _run(self, app, job: SummaryJob) -> None:
+        with app.app_context():
+            try:
+                result = summarize_room(job.room_id, job.mode,
+                                        on_stage=lambda index, name: self._on_stage(job, index, name),
+                                        window=job.window)
+                status = 'done'
+            except Exception as e:
+                db.session.rollback()
+                print(f"AI Error: {e}")
+                result = {"short": "Lỗi AI", "full": "Hệ thống đang bận, vui lòng thử lại sau."}
+                status = 'error'
+            finally:
+                db.session.remove()
+        job.result, job.status = result, status
+        self.store.finish(job)
+        self._emit(job, 'summary_done')
+
+
+summary_jobs = SummaryJobManager()
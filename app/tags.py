@@ -0,0 +1,130 @@
+import re
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Union
+from app.extensions import db
+
+# ============================================================================
+# DANH SÁCH TAGS CHUẨN (Dùng cho cả Giao diện và AI)
+# ============================================================================
+TAG_CHOICES = [
+    ('Travel', 'Travel ✈️'),
+    ('Food', 'Food 🍜'),
+    ('Coffee', 'Coffee ☕'),
+    ('Music', 'Music 🎵'),
+    ('Sports', 'Sports ⚽'),
+    ('Gaming', 'Gaming 🎮'),
+    ('Technology', 'Technology 💻'),
+    ('Movies', 'Movies 🎬'),
+    ('Reading', 'Reading 📚'),
+    ('Study', 'Study 📖'),
+    ('Camping', 'Camping ⛺'),
+    ('Shopping', 'Shopping 🛍️'),
+    ('Photography', 'Photography 📷'),
+    ('Billiards', 'Billiards 🎱'),
+    ('Just Chatting', 'Just Chatting 🗣️')
+]
+
+CANONICAL_TAGS = [tag[0] for tag in TAG_CHOICES]
+TAG_NAME_MAX_LENGTH = 50
+TAG_REGISTRY_RELOAD_INTERVAL = 30  # Giây, tránh reload liên tục khi gặp tag lạ
+
+
+# ============================================================================
+# NORMALIZER (dùng chung cho post, room, interests, user_tag_score)
+# ============================================================================
+def tag_key(raw: str) -> str:
+    """Khóa so khớp: bỏ '#', gộp khoảng trắng, không phân biệt hoa thường."""
+    return re.sub(r'\s+', ' ', raw.strip().lstrip('#')).strip().casefold()
+
+
+_CANONICAL_BY_KEY = {tag_key(name): name for name in CANONICAL_TAGS}
+
+
+def normalize_tag(raw: Optional[str]) -> Optional[str]:
+    """
+    Tên hiển thị chuẩn của 1 tag: 'travel', ' #Travel ' -> 'Travel'.
+    Tag ngoài danh sách chuẩn giữ nguyên chữ (đã gộp khoảng trắng). Rỗng -> None.
+    """
+    if not raw:
+        return None
+    key = tag_key(raw)
+    if not key:
+        return None
+    if key in _CANONICAL_BY_KEY:
+        return _CANONICAL_BY_KEY[key]
+    return re.sub(r'\s+', ' ', raw.strip().lstrip('#')).strip()[:TAG_NAME_MAX_LENGTH]
+
+
+def normalize_tags(raw: Union[str, Iterable[str], None]) -> List[str]:
+    """Chuỗi CSV hoặc list tag -> list tên chuẩn, bỏ trùng, giữ thứ tự."""
+    if not raw:
+        return []
+    items = raw.split(',') if isinstance(raw, str) else raw
+    result, seen = [], set()
+    for item in items:
+        name = normalize_tag(item)
+        if name and tag_key(name) not in seen:
+            seen.add(tag_key(name))
+            result.append(name)
+    return result
+
+
+# ============================================================================
+# REGISTRY (tag id <-> tên, cache trong process)
+# ============================================================================
+class TagRegistry:
+    """
+    Bảng tra tag_id <-> tên chuẩn, load 1 lần từ bảng tag (cần app context).
+    Gặp tên/id chưa biết thì load lại (tối đa 1 lần mỗi TAG_REGISTRY_RELOAD_INTERVAL giây).
+    version tăng mỗi lần load để các bảng tra phụ thuộc (vd: cột trong W) biết mà dựng lại.
+    """
+
+    def __init__(self):
+        self._ids_by_key: Dict[str, int] = {}
+        self._names: Dict[int, str] = {}
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        self.version = 0
+
+    def _load(self) -> None:
+        from app.models import Tag
+        rows = db.session.query(Tag.id, Tag.name, Tag.key).all()
+        with self._lock:
+            self._ids_by_key = {r.key: r.id for r in rows}
+            self._names = {r.id: r.name for r in rows}
+            self._loaded_at = time.monotonic()
+            self.version += 1
+
+    def _ensure_loaded(self, force: bool = False) -> None:
+        if self._loaded_at is None:
+            self._load()
+        elif force and time.monotonic() - self._loaded_at >= TAG_REGISTRY_RELOAD_INTERVAL:
+            self._load()
+
+    def ids(self, names: Union[str, Iterable[str], None]) -> List[int]:
+        """Tên tag (chưa chuẩn hóa cũng được) -> list tag_id. Tag không có trong bảng bị bỏ qua."""
+        keys = [tag_key(name) for name in normalize_tags(names)]
+        if not keys:
+            return []
+        self._ensure_loaded()
+        if any(k not in self._ids_by_key for k in keys):
+            self._ensure_loaded(force=True)
+        return [self._ids_by_key[k] for k in keys if k in self._ids_by_key]
+
+    def name(self, tag_id: int) -> Optional[str]:
+        self._ensure_loaded()
+        if tag_id not in self._names:
+            self._ensure_loaded(force=True)
+        return self._names.get(tag_id)
+
+    def names(self) -> Dict[int, str]:
+        self._ensure_loaded()
+        return dict(self._names)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._ids_by_key, self._names, self._loaded_at = {}, {}, None
+
+
+tag_registry = TagRegistry()
@@ -0,0 +1,128 @@
+import threading
+import time
+from typing import Dict, FrozenSet, Set
+from app.extensions import socketio
+from app.presence import WORKER_ID  # Mỗi worker chỉ biết người gõ trên worker đó, client gộp các frame theo source
+
+# ============================================================================
+# CẤU HÌNH
+# ============================================================================
+TYPING_TICK = 0.5           # Giây giữa 2 lần gửi frame "đang nhập" (tối đa 1 frame / phòng / tick)
+TYPING_TTL = 3.0            # Không nhận 'typing' trong khoảng này -> coi như đã ngừng nhập
+TYPING_MIN_INTERVAL = 0.25  # Rate limit mỗi sid: các 'typing' dày hơn bị bỏ qua
+TYPING_REFRESH = 2.0        # Phòng còn người gõ: gửi lại frame dù không đổi (client bỏ frame quá 5s không làm mới)
+
+
+class TypingAggregator:
+    """
+    Gom trạng thái "đang nhập" theo phòng thay vì fan-out mỗi phím gõ.
+    Handler chỉ cập nhật dict trong RAM (username -> hết hạn lúc nào); greenlet nền mỗi tick
+    dọn entry hết hạn và chỉ gửi 1 frame {'users': [...]} cho phòng nào có tập người gõ thay đổi.
+    Tập khác rỗng được gửi lại mỗi TYPING_REFRESH giây: worker chết giữa chừng (không kịp gửi frame rỗng)
+    thì client tự xóa người gõ của worker đó khi frame ngừng tới.
+    """
+
+    def __init__(self, tick: float = TYPING_TICK, ttl: float = TYPING_TTL,
+                 min_interval: float = TYPING_MIN_INTERVAL, refresh: float = TYPING_REFRESH):
+        self.tick = tick
+        self.ttl = ttl
+        self.min_interval = min_interval
+        self.refresh = refresh
+        self._typing: Dict[int, Dict[str, float]] = {}     # room_id -> {username: expires_at}
+        self._sent: Dict[int, FrozenSet[str]] = {}          # room_id -> tập đã gửi lần cuối
+        self._sent_at: Dict[int, float] = {}                # room_id -> lúc gửi frame khác rỗng gần nhất
+        self._dirty: Set[int] = set()
+        self._last_event: Dict[str, float] = {}             # sid -> lần 'typing' được nhận gần nhất
+        self._lock = threading.Lock()
+        self._started = False
+        self.frames_sent = 0
+
+    # ------------------------------------------------------------------
+    # EVENTS (gọi từ socket handler, không I/O)
+    # ------------------------------------------------------------------
+    def allow(self, sid: str) -> bool:
+        """Rate limit theo sid: False nếu sid vừa gửi 'typing' chưa quá min_interval."""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_event.get(sid, 0.0) < self.min_interval:
+                return False
+            self._last_event[sid] = now
+            return True
+
+    def typing(self, room_id: int, username: str) -> None:
+        with self._lock:
+            users = self._typing.setdefault(room_id, {})
+            if username not in users:
+                self._dirty.add(room_id)
+            users[username] = time.monotonic() + self.ttl
+
+    def stopped(self, room_id: int, username: str) -> None:
+        with self._lock:
+            users = self._typing.get(room_id)
+            if users and users.pop(username, None) is not None:
+                self._dirty.add(room_id)
+
+    def forget_sid(self, sid: str) -> None:
+        with self._lock:
+            self._last_event.pop(sid, None)
+
+    # ------------------------------------------------------------------
+    # TICK
+    # ------------------------------------------------------------------
+    def collect(self) -> Dict[int, list]:
+        """Dọn entry hết hạn, trả về {room_id: [username]} của các phòng cần gửi frame mới."""
+        now = time.monotonic()
+        frames = {}
+        with self._lock:
+            for room_id, users in list(self._typing.items()):
+                expired = [name for name, expires_at in users.items() if expires_at <= now]
+                for name in expired:
+                    del users[name]
+                if expired:
+                    self._dirty.add(room_id)
+                if not users:
+                    del self._typing[room_id]
+
+            # Frame khác rỗng đã gửi quá refresh giây -> gửi lại dù tập người gõ không đổi
+            stale = {room_id for room_id, sent_at in self._sent_at.items() if now - sent_at >= self.refresh}
+            for room_id in self._dirty | stale:
+                current = frozenset(self._typing.get(room_id, ()))
+                if current != self._sent.get(room_id, frozenset()) or room_id in stale:
+                    frames[room_id] = sorted(current)
+                    if current:
+                        self._sent[room_id] = current
+                        self._sent_at[room_id] = now
+                    else:
+                        self._sent.pop(room_id, None)
+                        self._sent_at.pop(room_id, None)
+            self._dirty.clear()
+        return frames
+
+    def flush(self) -> int:
+        from app.events import room_channel
+        frames = self.collect()
+        for room_id, users in frames.items():
+            socketio.emit('typing_status', {'room_id': room_id, 'users': users, 'source': WORKER_ID},
+                          to=room_channel(room_id))
+        self.frames_sent += len(frames)
+        return len(frames)
+
+    # ------------------------------------------------------------------
+    # BACKGROUND GREENLET
+    # ------------------------------------------------------------------
+    def _run(self) -> None:
+        while True:
+            socketio.sleep(self.tick)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Typing flush error: {e}")
+
+    def start(self) -> None:
+        if self._started:
+            return
+        self._started = True
+        socketio.start_background_task(self._run)
+
+
+typing_aggregator = TypingAggregator()
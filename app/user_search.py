@@ -0,0 +1,123 @@
+import re
+from typing import List, Optional
+from sqlalchemy import case, column, func, select, table, text
+from app.extensions import db
+from app.models import User, friendship
+
+# ============================================================================
+# CẤU HÌNH
+# ============================================================================
+SEARCH_LIMIT = 20            # Số kết quả tối đa mỗi lần tìm
+SEARCH_MAX_TOKENS = 5        # Bỏ bớt từ khóa thừa để query FTS không phình to
+USERNAME_WEIGHT = 10.0       # bm25: khớp username quan trọng hơn khớp email
+
+# Bảng ảo FTS5 (SQLite) do migration 2 tạo, không khai báo trong db.metadata
+# để db.create_all() không đụng tới.
+user_fts = table('user_fts', column('rowid'))
+
+# Backend theo từng engine: 'fts5' | 'trgm' | 'like' (kiểm tra 1 lần rồi nhớ lại)
+_backends = {}
+
+
+def _tokens(query: str) -> List[str]:
+    """Tách từ khóa giống tokenizer unicode61 (chữ + số, bỏ dấu câu, '_', '@', '.')."""
+    return re.findall(r'[^\W_]+', query.lower())[:SEARCH_MAX_TOKENS]
+
+
+def _escape_like(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _detect_backend() -> str:
+    engine = db.engine
+    if engine in _backends:
+        return _backends[engine]
+
+    backend = 'like'
+    try:
+        with engine.connect() as conn:
+            if engine.dialect.name == 'sqlite':
+                found = conn.execute(text(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_fts'"
+                )).first()
+                backend = 'fts5' if found else 'like'
+            elif engine.dialect.name == 'postgresql':
+                found = conn.execute(text(
+                    "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"
+                )).first()
+                backend = 'trgm' if found else 'like'
+    except Exception as e:
+        print(f"User search backend detection error: {e}")
+    _backends[engine] = backend
+    return backend
+
+
+def _mutual_count(viewer_id: int):
+    """Số bạn chung giữa viewer và từng User trong kết quả (correlated subquery, cùng 1 query)."""
+    f1 = friendship.alias('f1')
+    f2 = friendship.alias('f2')
+    return select(func.count()).select_from(
+        f1.join(f2, f1.c.friend_id == f2.c.friend_id)
+    ).where(f1.c.user_id == viewer_id, f2.c.user_id == User.id).scalar_subquery()
+
+
+# ============================================================================
+# BACKENDS (cùng trả về query (User, mutual) đã lọc + sắp xếp)
+# ============================================================================
+def _fts5_query(base, query: str):
+    tokens = _tokens(query)
+    if not tokens:
+        return None
+    match = ' '.join(f'"{tok}"*' for tok in tokens)  # Prefix match, mọi từ đều phải khớp
+    exact = case((func.lower(User.username) == query.lower(), 0), else_=1)
+    return base.join(user_fts, user_fts.c.rowid == User.id)\
+        .filter(text('user_fts MATCH :fts_match').bindparams(fts_match=match))\
+        .order_by(exact, text(f'bm25(user_fts, {USERNAME_WEIGHT}, 1.0)'), User.id)
+
+
+def _trgm_query(base, query: str):
+    # Index GIN gin_trgm_ops phục vụ được cả ILIKE '%q%', xếp hạng bằng similarity()
+    needle = query.lower()
+    pattern = f'%{_escape_like(needle)}%'
+    prefix = case((func.lower(User.username).like(f'{_escape_like(needle)}%', escape='\\'), 1.0), else_=0.0)
+    rank = prefix + func.similarity(func.lower(User.username), needle) * USERNAME_WEIGHT \
+        + func.similarity(func.lower(User.email), needle)
+    return base.filter(User.username.ilike(pattern, escape='\\') | User.email.ilike(pattern, escape='\\'))\
+        .order_by(rank.desc(), User.id)
+
+
+def _like_query(base, query: str):
+    # Fallback khi DB không có FTS5 / pg_trgm: chỉ prefix match. lower() bọc cột nên index unique
+    # của username / email không dùng được -> quét bảng, chấp nhận được vì chỉ là đường dự phòng
+    pattern = f'{_escape_like(query.lower())}%'
+    return base.filter(func.lower(User.username).like(pattern, escape='\\')
+                       | func.lower(User.email).like(pattern, escape='\\'))\
+        .order_by(func.length(User.username), User.id)
+
+
+_BACKEND_QUERIES = {'fts5': _fts5_query, 'trgm': _trgm_query, 'like': _like_query}
+
+
+# ============================================================================
+# PUBLIC API
+# ============================================================================
+def search_users(query: Optional[str], viewer_id: int, limit: int = SEARCH_LIMIT) -> List[User]:
+    """
+    Tìm user theo username / email (prefix, có xếp hạng), trừ bản thân viewer.
+    Mỗi User trả về được gắn thêm thuộc tính mutual_friends (giống suggest_friends).
+    """
+    query = (query or '').strip()
+    if not query:
+        return []
+
+    mutual = _mutual_count(viewer_id).label('mutual')
+    base = db.session.query(User, mutual).filter(User.id != viewer_id)
+    q = _BACKEND_QUERIES[_detect_backend()](base, query)
+    if q is None:
+        return []
+
+    results = []
+    for user, mutual_count in q.limit(limit).all():
+        user.mutual_friends = mutual_count
+        results.append(user)
+    return results
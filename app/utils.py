@@ -1,13 +1,20 @@
 import os
 import secrets
+from functools import wraps
 from PIL import Image
-from flask import current_app
+from flask import abort, current_app
+from flask_login import current_user
 import datetime
+import numpy as np
+from scipy import sparse
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
 from config import Config
 from app.extensions import db  # Lấy db từ nguồn gốc
 from app.models import UserTagScore # Lấy Model từ package models
+from app.interest_cache import interest_cache
+from app.interest_buffer import InterestScoreBuffer
+from app.tags import TAG_CHOICES, normalize_tag, tag_registry
 # -------------------------
 
 from sqlalchemy.sql import func
@@ -16,24 +23,7 @@ from sqlalchemy.sql import func
 MAX_INTEREST_SCORE = 20.0
 
 # --- 1. DANH SÁCH TAGS CHUẨN (Dùng cho cả Giao diện và AI) ---
-TAG_CHOICES = [
-    ('Travel', 'Travel ✈️'),
-    ('Food', 'Food 🍜'),
-    ('Coffee', 'Coffee ☕'),
-    ('Music', 'Music 🎵'),
-    ('Sports', 'Sports ⚽'),
-    ('Gaming', 'Gaming 🎮'),
-    ('Technology', 'Technology 💻'),
-    ('Movies', 'Movies 🎬'),
-    ('Reading', 'Reading 📚'),
-    ('Study', 'Study 📖'),
-    ('Camping', 'Camping ⛺'),
-    ('Shopping', 'Shopping 🛍️'),
-    ('Photography', 'Photography 📷'),
-    ('Billiards', 'Billiards 🎱'),
-    ('Just Chatting', 'Just Chatting 🗣️')
-]
-
+# [MOVED] TAG_CHOICES + normalizer nằm ở app/tags.py, import lại để code cũ vẫn dùng app.utils.TAG_CHOICES
 # --- 2. CẤU HÌNH AI & THUẬT TOÁN ---
 # (Code genai giữ nguyên...)
 
@@ -56,7 +46,7 @@ try:
     tfidf_matrix = vectorizer_matrix.fit_transform(docs)
     
     # [SỬA] Vì ta gộp chung, ma trận W sẽ tính độ tương đồng giữa TẤT CẢ các thẻ với nhau
-    W = cosine_similarity(tfidf_matrix, tfidf_matrix)
+    W = cosine_similarity(tfidf_matrix, tfidf_matrix).astype(np.float32)
     
     # Index map để tra cứu nhanh
     # Code cũ tách Interest/Tag riêng, code mới dùng chung Index map cho tiện
@@ -69,6 +59,16 @@ except Exception as e:
     INTEREST_INDEX = {}
     TAG_INDEX = {}
 
+def admin_required(view):
+    """[NEW] Chỉ admin (Config.ADMIN_USERNAMES) hoặc app đang chạy debug mới vào được; người khác nhận 404."""
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if not current_app.debug and (not current_user.is_authenticated
+                                      or current_user.username not in current_app.config.get('ADMIN_USERNAMES', ())):
+            abort(404)
+        return view(*args, **kwargs)
+    return wrapped
+
 # [NEW] Helper to save profile pictures
 def save_picture(form_picture):
     random_hex = secrets.token_hex(8)
@@ -142,45 +142,126 @@ def check_conflicts(activities, constraints):
             
     return conflicts
 
+# [NEW] Buffer ghi trễ (write-behind) cho điểm sở thích
+interest_buffer = InterestScoreBuffer(max_score=MAX_INTEREST_SCORE)
+
 # [NEW] Hàm tự động học: Cập nhật trọng số khi User tương tác
 def auto_update_user_interest(user_id, tags_list, weight_increment=1.0):
     """
     user_id: ID người dùng
-    tags_list: List các tag của bài viết/nhóm mà user vừa tương tác
+    tags_list: List tag_id (int) hoặc tên tag của bài viết/nhóm mà user vừa tương tác
     weight_increment: Mức độ tăng điểm (Ví dụ: Click xem = 0.5, Join nhóm = 2.0)
+
+    [WRITE-BEHIND] Không đụng DB ở đây: điểm được cộng dồn trong RAM theo (user, tag_id)
+    và greenlet nền ghi xuống bảng user_tag_score (kẹp 0..MAX_INTEREST_SCORE bằng SQL).
+    Tên tag đi qua normalizer chung ('travel', '#Travel' -> 'Travel'), tag lạ bị bỏ qua.
     """
     if not tags_list: return
+    tag_ids = [t for t in tags_list if isinstance(t, int)]
+    names = [t for t in tags_list if isinstance(t, str)]
+    if names:
+        tag_ids.extend(tag_registry.ids(names))
+    interest_buffer.add(user_id, tag_ids, weight_increment)
 
-    for tag in tags_list:
-        tag_clean = tag.strip().lower()
-        if not tag_clean: continue
+# [NEW] Bảng tra tag_id -> cột trong W / INTEREST_INDEX (-1 = tag không có trong knowledge base)
+_tag_columns = {'version': None, 'lookup': np.full(1, -1, dtype=np.int64)}
 
-        # Tìm xem user đã có điểm cho tag này chưa
-        record = UserTagScore.query.filter_by(user_id=user_id, tag=tag_clean).first()
-        
-        if record:
-            new_score = record.score + weight_increment
-            # [LOGIC MỚI] Kẹp giá trị trong khoảng từ 0 đến MAX
-            # max(0.0, ...) -> Không cho xuống dưới 0
-            # min(..., MAX) -> Không cho vượt quá MAX
-            record.score = max(0.0, min(new_score, MAX_INTEREST_SCORE))
-            # Chỉ cập nhật thời gian nếu là hành động tích cực (tăng điểm)
-            if weight_increment > 0:
-                record.last_interaction = datetime.datetime.utcnow()
-        else:
-            # Nếu chưa có record mà lại trừ điểm thì bỏ qua (hoặc tạo mới = 0)
-            if weight_increment > 0:
-                initial_score = min(weight_increment, MAX_INTEREST_SCORE)
-                new_record = UserTagScore(user_id=user_id, tag=tag_clean, score=initial_score)
-                db.session.add(new_record)
-    
-    db.session.commit()
+def _tag_column_lookup():
+    if _tag_columns['version'] != tag_registry.version:
+        names = tag_registry.names()
+        lookup = np.full(max(names, default=0) + 1, -1, dtype=np.int64)
+        for tag_id, name in names.items():
+            lookup[tag_id] = TAG_INDEX.get(name, -1)
+        _tag_columns['lookup'], _tag_columns['version'] = lookup, tag_registry.version
+    return _tag_columns['lookup']
+
+def tag_columns(tags):
+    """
+    tags: list tag_id (int) hoặc tên tag -> np.ndarray cột tương ứng trong W (-1 nếu không có).
+    Đường chính là int (tra mảng numpy), tên chỉ để tương thích code cũ.
+    """
+    if any(isinstance(t, str) for t in tags):
+        lookup = _tag_column_lookup()
+        return np.array([TAG_INDEX.get(normalize_tag(t), -1) if isinstance(t, str)
+                         else (lookup[t] if 0 <= t < len(lookup) else -1) for t in tags], dtype=np.int64)
+
+    ids = np.asarray(tags, dtype=np.int64)
+    lookup = _tag_column_lookup()
+    if ids.size and ids.max() >= len(lookup):
+        tag_registry.name(int(ids.max()))  # Tag mới tạo sau lần load trước -> thử load lại
+        lookup = _tag_column_lookup()
+    cols = np.full(ids.size, -1, dtype=np.int64)
+    known = (ids >= 0) & (ids < len(lookup))
+    cols[known] = lookup[ids[known]]
+    return cols
+
+# [NEW] Vector sở thích của user, căn theo INTEREST_INDEX
+def build_user_interest_vector(user_scores):
+    """
+    user_scores: list UserTagScore hoặc dict {tag_id/tên tag: score}
+    Trả về np.ndarray (float32) độ dài len(INTEREST_INDEX), tag không có trong
+    knowledge base bị bỏ qua.
+    """
+    vec = np.zeros(len(INTEREST_INDEX), dtype=np.float32)
+    if not user_scores: return vec
+
+    if isinstance(user_scores, dict):
+        keys, values = list(user_scores.keys()), list(user_scores.values())
+    else:
+        keys = [u.tag_id if u.tag_id is not None else u.tag for u in user_scores]
+        values = [u.score for u in user_scores]
+    cols = tag_columns(keys)
+    mask = cols >= 0
+    vec[cols[mask]] = np.asarray([v or 0.0 for v in values], dtype=np.float32)[mask]
+    return vec
+
+# [NEW] Lấy vector sở thích qua cache, chỉ query user_tag_score khi cache miss
+def get_user_interest_vector(user_id):
+    vector = interest_cache.get(user_id)
+    if vector is None:
+        user_scores = UserTagScore.query.filter_by(user_id=user_id).all()
+        vector = interest_cache.set(user_id, build_user_interest_vector(user_scores))
+    return vector
+
+# [NEW] Ma trận thưa item x tag (1 = item có tag đó)
+def build_item_tag_matrix(items_tags):
+    """
+    items_tags: list các list tag_id (hoặc tên tag), mỗi phần tử ứng với 1 post/room
+    Trả về scipy.sparse.csr_matrix shape (len(items_tags), len(TAG_INDEX))
+    """
+    rows, tags = [], []
+    for row, item in enumerate(items_tags):
+        for t in set(item):
+            rows.append(row)
+            tags.append(t)
+    cols = tag_columns(tags)
+    mask = cols >= 0
+    # Bỏ cặp (row, col) trùng để ma trận luôn nhị phân
+    pairs = np.unique(np.stack([np.asarray(rows, dtype=np.int64)[mask], cols[mask]]), axis=1)
+    data = np.ones(pairs.shape[1], dtype=np.float32)
+    return sparse.csr_matrix((data, (pairs[0], pairs[1])), shape=(len(items_tags), len(TAG_INDEX)), dtype=np.float32)
+# [NEW] Chấm điểm hàng loạt bằng 1 phép toán ma trận
+def score_items_batch(user_vector, item_matrix):
+    """
+    score(item) = max over (W · diag(user_scores)) giới hạn trong các tag của item.
+    - best_per_tag[t] = max_i W[i][t] * user_scores[i]  (mỗi tag lấy sở thích khớp nhất)
+    - score(item)     = max_{t in item} best_per_tag[t]
+    Mọi giá trị đều >= 0 nên nhân với ma trận nhị phân rồi lấy max là đủ.
+    """
+    n_items = item_matrix.shape[0]
+    if W is None or n_items == 0 or not user_vector.any():
+        return np.zeros(n_items, dtype=np.float32)
+
+    best_per_tag = (W * user_vector[:, None]).max(axis=0)
+    scores = item_matrix.multiply(best_per_tag).max(axis=1).toarray().ravel()
+    return np.round(scores, 2)
 
 # [UPDATED] Hàm tính điểm có xét đến trọng số cá nhân
 def score_from_matrix_personalized(user_id, item_tags, user_scores_cache=None):
     """
     user_id: ID người dùng để lấy bảng điểm cá nhân
     item_tags: Tags của bài post hoặc room cần chấm điểm
+    Chấm nhiều item cùng lúc thì dùng score_items_batch (nhanh hơn nhiều).
     """
     if W is None: return 0.0
 
@@ -189,48 +270,8 @@ def score_from_matrix_personalized(user_id, item_tags, user_scores_cache=None):
         user_scores = user_scores_cache
     else:
         user_scores = UserTagScore.query.filter_by(user_id=user_id).all()
-        
-    if not user_scores: return 0.0
 
-    # 1. Lấy tất cả các tag mà user này CÓ ĐIỂM trong database
-    user_scores = UserTagScore.query.filter_by(user_id=user_id).all()
     if not user_scores: return 0.0 # User mới tinh chưa có sở thích
 
-    # Tạo dictionary {tag: score} của user
-    # Ví dụ: {'du lịch': 5.0, 'code': 1.0}
-    user_interest_map = {u.tag: u.score for u in user_scores}
-    
-    rows = []
-    # Duyệt qua các sở thích user ĐÃ CÓ trong DB
-    for u_tag, u_score in user_interest_map.items():
-        # Map tag của user vào Index của Ma trận AI (nếu có trong knowledge base)
-        # Lưu ý: Ta dùng thuật toán matching gần đúng của AI hoặc exact match
-        # Ở đây giả sử dùng exact match với keys trong INTEREST_INDEX của utils
-        if u_tag not in INTEREST_INDEX: continue 
-        
-        ii = INTEREST_INDEX[u_tag]
-        row = []
-        
-        for t in item_tags:
-            if t in TAG_INDEX:
-                # CÔNG THỨC MỚI:
-                # Điểm = (Độ tương đồng ngữ nghĩa AI) * (Điểm quan tâm cá nhân của User)
-                # Ví dụ: AI thấy "Du lịch" ~ "Biển" (0.8). User thích "Du lịch" (Score 5).
-                # => Điểm match = 0.8 * 5 = 4.0
-                ai_similarity = W[ii][TAG_INDEX[t]]
-                weighted_score = ai_similarity * u_score
-                row.append(weighted_score)
-        
-        if row: rows.append(row)
-
-    if not rows: return 0.0
-
-    # [FIX SUGGESTION] Thay vì chia trung bình, hãy lấy điểm cao nhất tìm được
-    # Logic: Nếu bài viết có 1 tag trúng "tủ" (điểm 10) và 3 tag không liên quan (điểm 0)
-    # Trung bình = 2.5 (Thấp -> Sai) | Max = 10 (Cao -> Đúng)
-    
-    # Lấy max của từng dòng, sau đó lấy max của toàn bộ các dòng
-    max_scores = [max(r) for r in rows]
-    final_score = max(max_scores) if max_scores else 0.0
-
-    return round(final_score, 2)
\ No newline at end of file
+    user_vector = build_user_interest_vector(user_scores)
+    return float(score_items_batch(user_vector, build_item_tag_matrix([item_tags]))[0])
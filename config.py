@@ -29,4 +29,39 @@ class Config:
     
     # SeaLion AI
     SEALION_API_KEY = os.environ.get('SEALION_API_KEY') 
-    SEALION_BASE_URL = "https://api.sea-lion.ai/v1"
\ No newline at end of file
+    SEALION_BASE_URL = "https://api.sea-lion.ai/v1"
+
+    # Username được xem các endpoint số liệu nội bộ (/api/*/stats), cách nhau bởi dấu phẩy.
+    # Bỏ trống = chỉ mở khi chạy debug.
+    ADMIN_USERNAMES = [u.strip() for u in (os.environ.get('ADMIN_USERNAMES') or '').split(',') if u.strip()]
+
+    # Cache kết quả LLM: luôn có tầng RAM; LLM_CACHE_PATH (file SQLite) bật thêm tầng đĩa,
+    # giữ qua restart và dùng chung giữa các worker trên cùng máy. Vd: LLM_CACHE_PATH=instance/llm_cache.sqlite
+    LLM_CACHE_PATH = os.environ.get('LLM_CACHE_PATH')
+    LLM_CACHE_TTL = int(os.environ.get('LLM_CACHE_TTL') or 6 * 3600)
+
+    # Gateway gọi LLM dùng chung: số lời gọi chạy song song tối đa / process, hạn chót mỗi lời gọi (giây)
+    LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY') or 4)
+    LLM_TIMEOUT = float(os.environ.get('LLM_TIMEOUT') or 60)
+
+    # Socket.IO nhiều worker: số worker gunicorn + message queue để emit từ worker này
+    # (route HTTP, background task) tới được client đang nối vào worker khác.
+    # Vd: SOCKETIO_MESSAGE_QUEUE=redis://localhost:6379/0, WEB_CONCURRENCY=4
+    SOCKETIO_WORKERS = int(os.environ.get('WEB_CONCURRENCY') or 1)
+    SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+    # Nhiều worker không có sticky session -> client chỉ dùng websocket (long-polling cần sticky)
+    SOCKETIO_WEBSOCKET_ONLY = SOCKETIO_WORKERS > 1
+
+    # Presence + job tóm tắt AI dùng chung giữa các worker (vd: redis://localhost:6379/0).
+    # Bỏ trống = in-process (mặc định dùng luôn Redis của message queue nếu có)
+    PRESENCE_REDIS_URL = os.environ.get('PRESENCE_REDIS_URL') or (
+        SOCKETIO_MESSAGE_QUEUE if (SOCKETIO_MESSAGE_QUEUE or '').startswith('redis') else None)
+
+    # Số id tin nhắn xin trước mỗi lần (1 commit id_sequence / block) khi chạy 1 worker.
+    # Nhiều worker: id lấy từ bộ đếm INCR trên PRESENCE_REDIS_URL để vẫn tăng theo thứ tự gửi
+    # trên toàn cụm (catch-up, số chưa đọc, tóm tắt đều so sánh id > mốc).
+    MESSAGE_ID_BLOCK = int(os.environ.get('MESSAGE_ID_BLOCK') or 100)
+
+    # Migration chạy đúng 1 lần trước khi gunicorn fork worker (Dockerfile: `flask migrate && gunicorn`).
+    # 1 worker (dev, socketio.run) thì create_app tự chạy. RUN_MIGRATIONS=1 / 0 để ép bật / tắt.
+    RUN_MIGRATIONS = os.environ.get('RUN_MIGRATIONS', '0' if SOCKETIO_WORKERS > 1 else '1') == '1'
@@ -0,0 +1,9 @@
+# Cấu hình gunicorn (Dockerfile: flask migrate && gunicorn -c gunicorn.conf.py run:app)
+# Số worker lấy từ config (WEB_CONCURRENCY). Nhiều hơn 1 worker thì phải có SOCKETIO_MESSAGE_QUEUE,
+# và worker không tự chạy migration (RUN_MIGRATIONS) -> luôn chạy `flask migrate` trước.
+import os
+from config import Config
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '10000')}"
+worker_class = 'eventlet'
+workers = Config.SOCKETIO_WORKERS
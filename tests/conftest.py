@@ -0,0 +1,3 @@
+# Giống run.py: eventlet phải patch trước mọi import khác (message queue Redis cần socket đã patch)
+import eventlet
+eventlet.monkey_patch()
@@ -0,0 +1,310 @@
+"""
+Nhiều worker gunicorn: tin gửi trên worker A phải tới client đang nối vào worker B qua message queue.
+Worker A là app thật (create_app), worker B là 1 server Socket.IO khác cùng queue. Redis được thay bằng
+fakeredis (cùng 1 FakeServer cho queue + presence), mỗi worker chạy eventlet.wsgi trên 1 cổng riêng.
+"""
+import os
+import tempfile
+
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'multi_worker.db')
+os.environ['WEB_CONCURRENCY'] = '2'
+os.environ['SOCKETIO_MESSAGE_QUEUE'] = 'redis://queue.test:6379/0'
+
+import eventlet
+import eventlet.wsgi
+import fakeredis
+import pytest
+import redis
+import socketio as socketio_client
+from flask import Flask
+from flask_socketio import SocketIO, join_room
+
+QUEUE_URL = os.environ['SOCKETIO_MESSAGE_QUEUE']
+
+
+def _serve(wsgi_app) -> str:
+    sock = eventlet.listen(('127.0.0.1', 0))
+    eventlet.spawn(eventlet.wsgi.server, sock, wsgi_app, log_output=False)
+    return f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+
+def _wait_for(predicate, timeout: float = 3.0) -> bool:
+    for _ in range(int(timeout / 0.05)):
+        if predicate():
+            return True
+        eventlet.sleep(0.05)
+    return predicate()
+
+
+def _login(app, user_id):
+    http = app.test_client()
+    with http.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+    return http
+
+
+@pytest.fixture(scope='module')
+def workers():
+    server = fakeredis.FakeServer()
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(redis.Redis, 'from_url',
+                   classmethod(lambda cls, url, **kwargs: fakeredis.FakeRedis(server=server, **kwargs)))
+        from app import create_app
+        from app.events import room_channel
+        from app.extensions import db
+        from app.migrations import run_migrations
+        from app.models import Room, User
+
+        app = create_app()
+        assert not app.config['RUN_MIGRATIONS']  # Nhiều worker: migration là bước riêng trước gunicorn
+        with app.app_context():
+            run_migrations()
+            # interests khác rỗng: đã qua onboarding, route HTTP không bị redirect
+            user = User(username='alice', email='alice@example.com', password='x', interests='travel')
+            bob = User(username='bob', email='bob@example.com', password='x', interests='travel')
+            carol = User(username='carol', email='carol@example.com', password='x', interests='travel')
+            db.session.add_all([user, bob, carol])
+            db.session.commit()
+            room = Room(name='trip', creator_id=user.id, is_private=True)
+            room.members.append(user)
+            room.members.append(bob)
+            db.session.add(room)
+            db.session.commit()
+            user_id, room_id, bob_id, carol_id = user.id, room.id, bob.id, carol.id
+
+        app_b = Flask('worker_b')
+        app_b.config['SECRET_KEY'] = 'worker-b'
+        socketio_b = SocketIO(app_b, async_mode='eventlet', message_queue=QUEUE_URL)
+
+        @socketio_b.on('join')
+        def join(data):
+            join_room(room_channel(data['room_id']))
+
+        http = _login(app, user_id)
+        yield {'app': app, 'url_a': _serve(app), 'url_b': _serve(app_b), 'room_id': room_id,
+               'user_id': user_id, 'bob_id': bob_id, 'carol_id': carol_id,
+               'cookie': http.get_cookie('session').value}
+
+
+def test_message_sent_on_worker_a_reaches_client_on_worker_b(workers):
+    received = []
+    client_a, client_b = socketio_client.Client(), socketio_client.Client()
+    client_b.on('receive_message', received.append)
+    try:
+        client_b.connect(workers['url_b'], transports=['polling'])
+        client_b.emit('join', {'room_id': workers['room_id']})
+        client_a.connect(workers['url_a'], headers={'Cookie': f"session={workers['cookie']}"},
+                         transports=['polling'])
+        client_a.emit('join', {'room_id': workers['room_id']})
+        eventlet.sleep(0.3)
+
+        client_a.emit('send_message', {'room_id': workers['room_id'], 'msg': 'hello from A'})
+
+        assert _wait_for(lambda: received)
+        assert received[0]['msg'] == 'hello from A'
+        assert received[0]['username'] == 'alice'
+    finally:
+        client_a.disconnect()
+        client_b.disconnect()
+
+
+def test_presence_is_shared_between_workers(workers):
+    from app.presence import RedisPresence, presence
+    assert isinstance(presence.backend, RedisPresence)
+    other_worker = RedisPresence(presence.backend.client, worker_id='worker-b')
+    other_worker.heartbeat()
+    assert other_worker.join(workers['room_id'], 42, 'bob', 'sid-on-b')
+    assert presence.online_users(workers['room_id']).get(42) == 'bob'
+
+
+def test_summary_jobs_are_shared_between_workers(workers):
+    from app.presence import presence
+    from app.summary_jobs import RedisJobStore, SummaryJob, summary_jobs
+    assert isinstance(summary_jobs.store, RedisJobStore)
+    store_a = summary_jobs.store
+    store_b = RedisJobStore(presence.backend.client)
+    room_id = workers['room_id']
+
+    job = SummaryJob(room_id, 'normal', 1)
+    assert store_a.claim(job) is job
+    # Cùng phòng + mode trên worker khác: dùng chung job đang chạy, không chạy lần 2
+    shared = store_b.claim(SummaryJob(room_id, 'normal', 2))
+    assert shared.id == job.id
+    assert store_a.requesters(job) == {1, 2}
+
+    job.status, job.result = 'done', {'short': 'ok', 'full': 'summary'}
+    store_a.finish(job)
+    loaded = store_b.load(job.id)  # Route tra trạng thái vào worker B vẫn thấy kết quả
+    assert loaded.status == 'done' and loaded.to_dict()['full'] == 'summary'
+    assert store_b.claim(SummaryJob(room_id, 'normal', 2)).id != job.id
+
+
+def test_message_ids_follow_send_order_across_workers(workers):
+    from app.extensions import db
+    from app.message_writer import MessageWriter, message_writer
+    from app.models import Message, ReadCursor
+    from app.presence import presence
+    room_id, alice_id, bob_id = workers['room_id'], workers['user_id'], workers['bob_id']
+    with workers['app'].app_context():
+        writer_b = MessageWriter()  # Worker B, cùng bộ đếm id trên Redis
+        writer_b.use_shared_ids(presence.backend.client)
+        sent = [(message_writer if i % 2 == 0 else writer_b).enqueue(room_id, 'trip', bob_id, 'bob', f'm{i}')['id']
+                for i in range(6)]
+        assert sent == sorted(sent) and len(set(sent)) == len(sent)
+
+        writer_b.flush()  # Worker B ghi xuống DB trước tin cũ hơn của worker A
+        message_writer.flush()
+
+        # Client đã thấy tới tin thứ 2: catch-up trả đúng 4 tin gửi sau, không sót tin của worker nào
+        assert [m.id for m in Message.since(room_id, sent[1])] == sent[2:]
+        db.session.add(ReadCursor(user_id=alice_id, room_id=room_id, last_read_message_id=sent[1]))
+        db.session.commit()
+        assert ReadCursor.unread_counts([(alice_id, room_id)])[(alice_id, room_id)] == 4
+
+
+def test_membership_change_on_another_worker_invalidates_cache(workers):
+    import json
+    from app.cache_bus import CACHE_BUS_CHANNEL
+    from app.extensions import db
+    from app.membership_cache import membership_cache
+    from app.models import Room, User
+    from app.presence import presence
+    room_id, carol_id = workers['room_id'], workers['carol_id']
+    with workers['app'].app_context():
+        assert carol_id not in membership_cache.get(room_id)  # Worker A đã cache danh sách cũ
+
+        # Worker B duyệt carol vào phòng private rồi báo invalidate
+        db.session.get(Room, room_id).members.append(db.session.get(User, carol_id))
+        db.session.commit()
+        presence.backend.client.publish(CACHE_BUS_CHANNEL, json.dumps(
+            {'source': 'worker-b', 'cache': 'membership', 'key': room_id}))
+
+        assert _wait_for(lambda: carol_id in membership_cache.get(room_id))
+
+
+def test_new_member_does_not_see_history_as_unread(workers):
+    from app.extensions import db
+    from app.message_writer import message_writer
+    from app.models import Room
+    from app.read_cursors import read_cursors
+    carol_id, bob_id = workers['carol_id'], workers['bob_id']
+    app = workers['app']
+    with app.app_context():
+        room = Room(name='beach', creator_id=bob_id, is_private=False)
+        db.session.add(room)
+        db.session.commit()
+        room_id = room.id
+        for i in range(3):
+            message_writer.enqueue(room_id, 'beach', bob_id, 'bob', f'old {i}')
+        message_writer.flush()
+
+    assert _login(app, carol_id).get('/chat/beach').status_code == 200  # Phòng public: tự vào
+
+    with app.app_context():
+        assert read_cursors.unread_counts(carol_id, [room_id]) == {room_id: 0}
+        message_writer.enqueue(room_id, 'beach', bob_id, 'bob', 'new')
+        message_writer.flush()
+        assert read_cursors.unread_counts(carol_id, [room_id]) == {room_id: 1}
+        read_cursors.flush_cursors()  # Sau khi greenlet nền ghi cursor xuống DB vẫn ra cùng kết quả
+        assert read_cursors.unread_counts(carol_id, [room_id]) == {room_id: 1}
+
+
+def test_system_message_from_http_route_reaches_room(workers):
+    from app.extensions import db
+    from app.models import Room
+    app, bob_id = workers['app'], workers['bob_id']
+    with app.app_context():
+        room = Room(name='lake', creator_id=workers['user_id'], is_private=False, allow_auto_join=False)
+        db.session.add(room)
+        db.session.commit()
+        room_id = room.id
+
+    received = []
+    client_b = socketio_client.Client()
+    client_b.on('receive_message', received.append)
+    try:
+        client_b.connect(workers['url_b'], transports=['polling'])
+        client_b.emit('join', {'room_id': room_id})
+        eventlet.sleep(0.3)
+
+        _login(app, bob_id).post(f'/chat/join_request/{room_id}')  # Worker A xử lý HTTP
+
+        assert _wait_for(lambda: received)
+        assert received[0]['msg'] == 'System: bob wants to join this room.'
+    finally:
+        client_b.disconnect()
+
+
+@pytest.mark.parametrize('deleted_during', ['take', 'insert'])
+def test_deleted_room_messages_in_flight_are_not_kept(workers, deleted_during):
+    from app.extensions import db
+    from app.message_writer import MessageWriter
+    from app.models import Message, Room
+
+    class DeletingWriter(MessageWriter):
+        def _take(self):
+            batch = super()._take()
+            if batch and deleted_during == 'take':  # Xóa phòng ngay sau khi batch rời hàng đợi
+                self.discard_room(batch[0][0]['room_id'])
+            return batch
+
+        def _done(self):
+            if self._inflight and deleted_during == 'insert':  # Xóa phòng khi INSERT vừa commit
+                self.discard_room(self._inflight[0][0]['room_id'])
+            return super()._done()
+
+    app, bob_id = workers['app'], workers['bob_id']
+    with app.app_context():
+        room = Room(name=f'deleted_during_{deleted_during}', creator_id=bob_id)
+        db.session.add(room)
+        db.session.commit()
+
+        writer = DeletingWriter()
+        for i in range(3):
+            writer.enqueue(room.id, room.name, bob_id, 'bob', f'm{i}')
+        writer.flush()
+
+        assert Message.query.filter_by(room_id=room.id).count() == 0
+        assert writer.pending_count() == 0
+
+
+def test_deleted_room_name_is_forgotten_on_every_worker(workers):
+    import json
+    from app.cache_bus import CACHE_BUS_CHANNEL
+    from app.events import room_names
+    from app.extensions import db
+    from app.models import Room
+    from app.presence import presence
+    app, bob_id = workers['app'], workers['bob_id']
+    with app.app_context():
+        rooms = [Room(name=name, creator_id=bob_id) for name in ('picnic', 'camping')]
+        db.session.add_all(rooms)
+        db.session.commit()
+        picnic_id, camping_id = rooms[0].id, rooms[1].id
+    room_names.update({picnic_id: 'picnic', camping_id: 'camping'})  # Đã có người join trên worker này
+
+    _login(app, bob_id).post(f'/chat/delete/{picnic_id}')  # Xóa trên worker này
+    assert picnic_id not in room_names
+
+    # Worker B xóa phòng 'camping' -> worker này bỏ tên qua cache bus
+    presence.backend.client.publish(CACHE_BUS_CHANNEL, json.dumps(
+        {'source': 'worker-b', 'cache': 'room_names', 'key': camping_id}))
+    assert _wait_for(lambda: camping_id not in room_names)
+
+
+def test_friendship_change_on_another_worker_invalidates_suggestions(workers):
+    import json
+    from app.cache_bus import CACHE_BUS_CHANNEL
+    from app.presence import presence
+    from app.suggestion_engine import suggestion_cache
+    alice_id, bob_id, carol_id = workers['user_id'], workers['bob_id'], workers['carol_id']
+    for user_id in (alice_id, bob_id, carol_id):
+        suggestion_cache.set(user_id, {})  # Worker này đã tính sẵn gợi ý
+
+    # Worker B: bob kết bạn với carol -> gửi danh sách user bị ảnh hưởng
+    presence.backend.client.publish(CACHE_BUS_CHANNEL, json.dumps(
+        {'source': 'worker-b', 'cache': 'suggestions', 'key': [bob_id, carol_id]}))
+
+    assert _wait_for(lambda: suggestion_cache.get(bob_id) is None and suggestion_cache.get(carol_id) is None)
+    assert suggestion_cache.get(alice_id) == {}
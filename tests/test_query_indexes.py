@@ -0,0 +1,32 @@
+"""
+Các query nóng (app/query_checks.py: HOT_QUERIES) phải dùng đúng index sau khi migrate,
+cả với DB mới lẫn DB cũ được nâng cấp (bản friendus.db đi kèm repo, chép ra thư mục tạm).
+"""
+import os
+import shutil
+
+import pytest
+from sqlalchemy import create_engine
+
+REPO_DB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'friendus.db')
+
+
+@pytest.fixture(params=['empty', 'upgraded'])
+def migrated_engine(request, tmp_path):
+    from app.migrations import run_migrations
+    path = tmp_path / 'indexes.db'
+    if request.param == 'upgraded':
+        if not os.path.exists(REPO_DB):
+            pytest.skip('friendus.db not present')
+        shutil.copy(REPO_DB, path)
+    engine = create_engine(f'sqlite:///{path}')
+    run_migrations(engine)
+    yield engine
+    engine.dispose()
+
+
+def test_hot_queries_use_their_index(migrated_engine):
+    from app.query_checks import check_hot_query_indexes
+    missing = {name: f'{index} not in plan: {plan}'
+               for name, index, ok, plan in check_hot_query_indexes(migrated_engine) if not ok}
+    assert not missing